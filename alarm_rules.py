@@ -0,0 +1,210 @@
+# alarm_rules.py
+import operator
+import time
+from array import array
+from collections import namedtuple
+
+from bms_state import FRAME_SIGNALS
+
+# Event emitted on every rule edge: active=True when the rule trips,
+# active=False when it clears.
+RuleEvent = namedtuple("RuleEvent", "rule active value timestamp")
+
+_OPERATORS = {
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+
+class Rule:
+    """
+    A host-side threshold rule on one signal (see bms_state.FRAME_SIGNALS for
+    the names, e.g. "cell3", "cell_min", "ntc_spread", "pack_gap").
+
+      Rule("cell_undervoltage", "cell_min", "<", 3.0, delay=0.5, hysteresis=0.05)
+
+    trips once cell_min has stayed below 3.0 V for 500 ms, and clears once it
+    is back above 3.05 V (for clear_delay seconds, 0 by default).
+    """
+
+    __slots__ = ("name", "signal", "op", "threshold", "hysteresis", "delay", "clear_delay")
+
+    def __init__(self, name, signal, op, threshold, hysteresis=0.0, delay=0.0, clear_delay=0.0):
+        """
+        :param name: unique rule name, reported in RuleEvent.rule
+        :param signal: signal name the rule watches
+        :param op: one of "<", "<=", ">", ">="
+        :param threshold: trip threshold, in the signal's unit
+        :param hysteresis: distance past the threshold needed to clear
+        :param delay: seconds the trip condition must hold before the rule trips
+        :param clear_delay: seconds the clear condition must hold before it clears
+        """
+        if op not in _OPERATORS:
+            raise ValueError(f"Unsupported operator {op!r} in rule {name!r}")
+        self.name = name
+        self.signal = signal
+        self.op = op
+        self.threshold = threshold
+        self.hysteresis = hysteresis
+        self.delay = delay
+        self.clear_delay = clear_delay
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(**d)
+
+    def __repr__(self):
+        return f"Rule({self.name!r}, {self.signal!r}, {self.op!r}, {self.threshold!r})"
+
+
+class RuleSet:
+    """
+    Rules compiled once: trip/clear predicates are bound to plain functions
+    and indexed by the CAN IDs whose frames can change their signal, so a
+    frame only visits the rules that depend on it. A RuleSet holds no
+    runtime state and can be shared by the RuleEngine of every pack.
+    """
+
+    def __init__(self, rules, frame_signals=FRAME_SIGNALS):
+        """
+        :param rules: iterable of Rule
+        :param frame_signals: CAN ID -> signal names (another frame layout
+                              for a pack variant, see pack_variants.py)
+        """
+        self.rules = tuple(rules)
+        names = [rule.name for rule in self.rules]
+        if len(set(names)) != len(names):
+            raise ValueError("Rule names must be unique")
+
+        by_signal = {}
+        for index, rule in enumerate(self.rules):
+            by_signal.setdefault(rule.signal, []).append(index)
+
+        unknown = set(by_signal) - {s for sigs in frame_signals.values() for s in sigs}
+        if unknown:
+            raise ValueError(f"Unknown signal(s) in rules: {', '.join(sorted(unknown))}")
+
+        # CAN ID -> indexes of the rules to evaluate
+        self.by_frame = {}
+        for can_id, signals in frame_signals.items():
+            indexes = sorted({i for s in signals for i in by_signal.get(s, ())})
+            if indexes:
+                self.by_frame[can_id] = tuple(indexes)
+
+        self.trip = tuple(_trip_predicate(rule) for rule in self.rules)
+        self.clear = tuple(_clear_predicate(rule) for rule in self.rules)
+
+
+class RuleEngine:
+    """
+    Evaluates a RuleSet against one BMSState and emits edge-triggered
+    RuleEvents. Per-rule runtime state (active flag, pending edge start time)
+    is kept in flat arrays indexed like RuleSet.rules.
+    """
+
+    def __init__(self, ruleset, state, on_event=None):
+        """
+        :param ruleset: a compiled RuleSet (or an iterable of Rule)
+        :param state: the BMSState the rules read from
+        :param on_event: callback RuleEvent -> None, called on every edge
+        """
+        if not isinstance(ruleset, RuleSet):
+            ruleset = RuleSet(ruleset)
+        self.ruleset = ruleset
+        self.state = state
+        self.on_event = on_event
+
+        n = len(ruleset.rules)
+        self._get = tuple(state.getter(rule.signal) for rule in ruleset.rules)
+        self._active = bytearray(n)
+        self._pending = array("d", [-1.0]) * n  # start of a pending edge, -1 if none
+
+    @property
+    def active(self):
+        """Names of the rules that are currently tripped."""
+        rules = self.ruleset.rules
+        return [rules[i].name for i, a in enumerate(self._active) if a]
+
+    def evaluate(self, can_id, now=None):
+        """
+        Re-evaluate the rules depending on a frame with `can_id`.
+        Returns the list of RuleEvents produced (usually empty).
+        """
+        indexes = self.ruleset.by_frame.get(can_id)
+        if indexes is None:
+            return []
+        if now is None:
+            now = time.monotonic()
+
+        rs = self.ruleset
+        rules = rs.rules
+        active = self._active
+        pending = self._pending
+        events = []
+
+        for i in indexes:
+            value = self._get[i]()
+            if value is None:
+                continue
+            if active[i]:
+                changing = rs.clear[i](value)
+                delay = rules[i].clear_delay
+            else:
+                changing = rs.trip[i](value)
+                delay = rules[i].delay
+
+            if not changing:
+                pending[i] = -1.0
+                continue
+            if pending[i] < 0.0:
+                pending[i] = now
+            if now - pending[i] < delay:
+                continue
+
+            pending[i] = -1.0
+            active[i] ^= 1
+            events.append(RuleEvent(rules[i].name, bool(active[i]), value, now))
+
+        if events and self.on_event:
+            for event in events:
+                self.on_event(event)
+        return events
+
+    def rebound(self, ruleset, state):
+        """
+        New engine for another state object or frame layout (see
+        BMSPcanListener._rebuild_pipeline), keeping the active rules and
+        pending edges so that a tripped rule still clears with an event.
+        """
+        engine = RuleEngine(ruleset, state, on_event=self.on_event)
+        old = {rule.name: i for i, rule in enumerate(self.ruleset.rules)}
+        for i, rule in enumerate(engine.ruleset.rules):
+            j = old.get(rule.name)
+            if j is not None:
+                engine._active[i] = self._active[j]
+                engine._pending[i] = self._pending[j]
+        return engine
+
+    def reset(self):
+        """Clear every rule without emitting events."""
+        for i in range(len(self._active)):
+            self._active[i] = 0
+            self._pending[i] = -1.0
+
+
+def _trip_predicate(rule):
+    compare = _OPERATORS[rule.op]
+    threshold = rule.threshold
+    return lambda value: compare(value, threshold)
+
+
+def _clear_predicate(rule):
+    # The clear condition is the opposite comparison, shifted by the
+    # hysteresis away from the trip region.
+    if rule.op in ("<", "<="):
+        level = rule.threshold + rule.hysteresis
+        return lambda value: value >= level
+    level = rule.threshold - rule.hysteresis
+    return lambda value: value <= level
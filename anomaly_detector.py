@@ -0,0 +1,319 @@
+# anomaly_detector.py
+import math
+import threading
+from collections import namedtuple
+
+try:
+    import numpy as np
+except ImportError:  # numpy makes step() one vectorized pass; the fallback loops
+    np = None
+
+# One anomaly edge. kind is "jump" (a cell left its own recent behaviour) or
+# "drift" (its smoothed deviation stands out from its siblings'); z is the
+# score that crossed the threshold, deviation the cell's offset from the pack
+# median in volts (instantaneous for a jump, smoothed for a drift).
+AnomalyEvent = namedtuple("AnomalyEvent", "pack cell kind active z deviation timestamp")
+
+KINDS = ("jump", "drift")
+MAD_SCALE = 1.4826  # MAD -> standard deviation for normally distributed values
+
+# Per-cell state arrays: (attribute, initial value, numpy dtype, one row per KINDS entry)
+_FIELDS = (
+    ("mean", 0.0, "float64", False),
+    ("var", 0.0, "float64", False),
+    ("count", 0, "int64", False),
+    ("z", 0.0, "float64", True),
+    ("active", False, "bool", True),
+    ("_streak", 0, "int32", True),
+    ("_staged", math.nan, "float64", False),
+)
+
+
+class AnomalyDetector:
+    """
+    Online early warning for cells that move away from their siblings, well
+    before the BMS hard limits (0x206) trip. Once per measurement cycle each
+    cell's deviation from its pack median, d = v - median(v), updates an
+    exponentially weighted mean and variance (O(1) memory per cell):
+
+      - jump:  z = (d - mean) / std, the cell suddenly behaves unlike itself
+      - drift: z = (mean - median(mean)) / (1.4826 * MAD(mean)), the cell's
+               smoothed deviation stands out from the pack, e.g. a cell
+               self-discharging a few mV per day
+
+    Comparing to the pack median removes what all cells share (load, charge,
+    temperature). A cell goes active after `confirm` consecutive cycles with
+    |z| >= z_on and clears after `confirm` cycles with |z| < z_off; nothing
+    fires during the first `warmup` cycles of a cell.
+
+    The state is kept as (packs x cells) arrays so that step() updates every
+    cell of every pack at once; several listeners (one per pack) may share a
+    detector through observe(). Without numpy the same update runs as loops.
+    """
+
+    def __init__(self, num_packs=1, num_cells=13, alpha=0.02, z_on=4.0, z_off=2.5,
+                 confirm=3, warmup=50, min_std=0.002, on_event=None):
+        """
+        :param num_packs: number of packs (rows of the state arrays)
+        :param num_cells: cells per pack
+        :param alpha: EWMA weight of a new cycle (~1/alpha cycles of memory)
+        :param z_on: |z| at which a cell turns anomalous
+        :param z_off: |z| below which it clears again (hysteresis)
+        :param confirm: consecutive cycles needed for either edge
+        :param warmup: cycles a cell must have been seen before it can fire
+        :param min_std: floor of the spreads in volts, so that a perfectly
+                        quiet pack does not turn 1 mV into a huge z
+        :param on_event: callback AnomalyEvent -> None, called on every edge
+        """
+        if not 0.0 < alpha < 1.0:
+            raise ValueError("alpha must be between 0 and 1")
+        if z_off > z_on:
+            raise ValueError("z_off must not exceed z_on")
+        self.num_packs = num_packs
+        self.alpha = alpha
+        self.z_on = z_on
+        self.z_off = z_off
+        self.confirm = confirm
+        self.warmup = warmup
+        self.min_std = min_std
+        self.on_event = on_event
+        self.steps = 0
+        self._lock = threading.Lock()
+        self.resize(num_cells)
+
+    def resize(self, num_cells, pack=None):
+        """
+        Start over with `num_cells` cells for one pack (e.g. after its variant
+        changed), or for every pack if `pack` is None. The other packs keep
+        their statistics; the arrays are as wide as the largest pack, and
+        the cells a smaller pack lacks are never updated.
+        """
+        with self._lock:
+            if pack is None:
+                self.pack_cells = [num_cells] * self.num_packs
+                self.num_cells = num_cells
+                self._allocate()
+                return
+            self.pack_cells[pack] = num_cells
+            if max(self.pack_cells) != self.num_cells:
+                self._regrid(max(self.pack_cells))
+            self._reset_pack(pack)
+
+    def _allocate(self):
+        shape = (self.num_packs, self.num_cells)
+        for name, fill, dtype, per_kind in _FIELDS:
+            if np is not None:
+                setattr(self, name, np.full(((len(KINDS),) if per_kind else ()) + shape, fill, dtype))
+            else:
+                grid = [[fill] * self.num_cells for _ in range(self.num_packs)]
+                if per_kind:
+                    grid = [[list(row) for row in grid] for _ in KINDS]
+                setattr(self, name, grid)
+        self._seen = 0  # bit per pack staged since the last step
+
+    def _regrid(self, width):
+        """Change the number of cell columns, keeping the values that still fit."""
+        keep = min(width, self.num_cells)
+        for name, fill, _, per_kind in _FIELDS:
+            old = getattr(self, name)
+            if np is not None:
+                new = np.full(old.shape[:-1] + (width,), fill, dtype=old.dtype)
+                new[..., :keep] = old[..., :keep]
+            elif per_kind:
+                new = [[row[:keep] + [fill] * (width - keep) for row in grid] for grid in old]
+            else:
+                new = [row[:keep] + [fill] * (width - keep) for row in old]
+            setattr(self, name, new)
+        self.num_cells = width
+
+    def _reset_pack(self, pack):
+        for name, fill, _, per_kind in _FIELDS:
+            values = getattr(self, name)
+            if np is not None:
+                if per_kind:
+                    values[:, pack] = fill
+                else:
+                    values[pack] = fill
+            else:
+                for grid in (values if per_kind else (values,)):
+                    grid[pack][:] = [fill] * self.num_cells
+        self._seen &= ~(1 << pack)
+
+    def observe(self, pack, voltages, now):
+        """
+        Stage one pack's cell voltages (None / NaN for missing cells) and run
+        step() once every pack has reported, or when a pack reports again
+        before the others (a silent pack then simply keeps its statistics).
+        Thread-safe. Returns the events of the step, if one ran.
+        """
+        events = []
+        with self._lock:
+            if self._seen >> pack & 1:
+                events = self._step_staged(now)
+            row = self._staged[pack]
+            for i in range(min(len(voltages), self.num_cells)):
+                v = voltages[i]
+                row[i] = math.nan if v is None else v
+            self._seen |= 1 << pack
+            if self._seen == (1 << self.num_packs) - 1:
+                events += self._step_staged(now)
+        if events and self.on_event:
+            for event in events:
+                self.on_event(event)
+        return events
+
+    def _step_staged(self, now):
+        events = self._step(self._staged, now)
+        if np is not None:
+            self._staged.fill(np.nan)
+        else:
+            for row in self._staged:
+                row[:] = [math.nan] * self.num_cells
+        self._seen = 0
+        return events
+
+    def step(self, voltages, now=None):
+        """
+        Update every cell of every pack from a (packs x cells) array of
+        voltages (NaN for missing cells). Returns the AnomalyEvents produced.
+        """
+        if np is not None:
+            voltages = np.asarray(voltages, dtype=np.float64).reshape(self.num_packs, self.num_cells)
+        with self._lock:
+            events = self._step(voltages, now)
+        if events and self.on_event:
+            for event in events:
+                self.on_event(event)
+        return events
+
+    def _step(self, v, now):
+        self.steps += 1
+        if np is None:
+            return self._step_python(v, now)
+
+        a = self.alpha
+        floor = self.min_std
+        with np.errstate(invalid="ignore"):
+            seen = ~np.isnan(v)
+            d = v - _median_rows(v, seen.sum(axis=1))[:, None]
+            # a pack needs 3 cells for its median to mean anything
+            upd = seen & (seen.sum(axis=1) >= 3)[:, None]
+            first = upd & (self.count == 0)
+            delta = d - self.mean
+            jump = np.where(upd & ~first, delta / np.sqrt(self.var + floor * floor), 0.0)
+            self.var = np.where(upd & ~first, (1.0 - a) * (self.var + a * delta * delta), self.var)
+            self.mean = np.where(first, d, np.where(upd, self.mean + a * delta, self.mean))
+            self.count += upd
+
+            m = np.where(upd, self.mean, np.nan)
+            n = upd.sum(axis=1)
+            center = _median_rows(m, n)[:, None]
+            mad = _median_rows(np.abs(m - center), n)[:, None]
+            drift = np.where(upd, (self.mean - center) / (MAD_SCALE * mad + floor), 0.0)
+
+        z = self.z
+        z[0] = jump
+        z[1] = drift
+        active = self.active
+        flipping = np.where(active, np.abs(z) < self.z_off, np.abs(z) >= self.z_on)
+        flipping &= upd & ((self.count >= self.warmup) | active)
+        streak = self._streak
+        streak[:] = np.where(flipping, streak + 1, 0)
+        fired = streak >= self.confirm
+        if not fired.any():
+            return []
+
+        events = []
+        for k, p, c in zip(*np.nonzero(fired)):
+            active[k, p, c] = not active[k, p, c]
+            streak[k, p, c] = 0
+            deviation = d[p, c] if k == 0 else self.mean[p, c]
+            events.append(AnomalyEvent(int(p), int(c), KINDS[k], bool(active[k, p, c]),
+                                       float(z[k, p, c]), float(deviation), now))
+        return events
+
+    def _step_python(self, voltages, now):
+        a = self.alpha
+        floor = self.min_std
+        events = []
+        for p in range(self.num_packs):
+            row = [v if v is not None and v == v else None for v in voltages[p]]
+            cells = [i for i, v in enumerate(row) if v is not None]
+            skipped = range(self.num_cells) if len(cells) < 3 else \
+                [i for i, v in enumerate(row) if v is None]
+            for k in range(len(KINDS)):  # as in the numpy path: no score, no streak
+                for i in skipped:
+                    self.z[k][p][i] = 0.0
+                    self._streak[k][p][i] = 0
+            if len(cells) < 3:
+                continue
+            center = _median([row[i] for i in cells])
+            mean, var, count = self.mean[p], self.var[p], self.count[p]
+            d = {}
+            jump = {}
+            for i in cells:
+                d[i] = row[i] - center
+                if count[i] == 0:
+                    mean[i] = d[i]
+                    jump[i] = 0.0
+                else:
+                    delta = d[i] - mean[i]
+                    jump[i] = delta / math.sqrt(var[i] + floor * floor)
+                    var[i] = (1.0 - a) * (var[i] + a * delta * delta)
+                    mean[i] += a * delta
+                count[i] += 1
+
+            m_center = _median([mean[i] for i in cells])
+            mad = _median([abs(mean[i] - m_center) for i in cells])
+            scale = MAD_SCALE * mad + floor
+            for i in cells:
+                for k, score in enumerate((jump[i], (mean[i] - m_center) / scale)):
+                    self.z[k][p][i] = score
+                    active = self.active[k][p][i]
+                    if active:
+                        flipping = abs(score) < self.z_off
+                    else:
+                        flipping = abs(score) >= self.z_on and count[i] >= self.warmup
+                    streak = self._streak[k][p]
+                    streak[i] = streak[i] + 1 if flipping else 0
+                    if streak[i] < self.confirm:
+                        continue
+                    streak[i] = 0
+                    self.active[k][p][i] = not active
+                    events.append(AnomalyEvent(p, i, KINDS[k], not active, score,
+                                               d[i] if k == 0 else mean[i], now))
+        return events
+
+    def active_cells(self, pack=None):
+        """(pack, cell, kind) of the anomalies currently active."""
+        packs = range(self.num_packs) if pack is None else (pack,)
+        return [(p, c, KINDS[k]) for p in packs for k in range(len(KINDS))
+                for c in range(self.num_cells) if self.active[k][p][c]]
+
+    def as_dict(self, pack=0):
+        """Scores and active anomalies of one pack (plain lists)."""
+        return {
+            "jump": [float(z) for z in self.z[0][pack]],
+            "drift": [float(z) for z in self.z[1][pack]],
+            "deviation": [float(m) for m in self.mean[pack]],
+            "active": [[c, kind] for _, c, kind in self.active_cells(pack)],
+        }
+
+
+def _median_rows(x, n):
+    """
+    Median of each row of `x` over its `n` non-NaN values (NaN when n == 0).
+    np.sort puts NaNs last, so the middle elements are at (n-1)//2 and n//2;
+    unlike np.nanmedian this does not warn about empty rows, and plain
+    indexing is much cheaper than nanmedian on a few short rows.
+    """
+    s = np.sort(x, axis=1)
+    rows = np.arange(len(s))
+    mid = 0.5 * (s[rows, np.maximum((n - 1) // 2, 0)] + s[rows, n // 2])
+    return np.where(n > 0, mid, np.nan)
+
+
+def _median(values):
+    s = sorted(values)
+    n = len(s)
+    return 0.5 * (s[(n - 1) // 2] + s[n // 2])
@@ -0,0 +1,491 @@
+# archive.py
+import argparse
+import bisect
+import json
+import math
+import os
+import random
+import struct
+import threading
+import time
+import zlib
+from array import array
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import accumulate, repeat
+from operator import xor
+
+from bms_state import FD_DLC_LEN
+from data_handler import BMSPcanListener
+from metrics import Registry
+from profiling import HdrHistogram
+
+# File layout:
+#   MAGIC
+#   column blobs, chunk after chunk
+#   index: zlib(JSON) - columns, and per chunk the time range and the
+#          [times_offset, times_len, values_offset, values_len, count, kind]
+#          of every column (columns updated by the same frames share one
+#          times blob; version 1 files have no per-chunk kind)
+#   _TAIL: index offset + MAGIC
+#
+# A numeric column blob is zlib(shuffle(delta(microseconds))) followed by
+# zlib(shuffle(xor(float64 bits))): consecutive samples share most of their
+# bits, the byte shuffle groups the zero bytes together and zlib squeezes
+# them. Text columns (serial number, versions) are zlib(JSON) of [t, value].
+# A column's kind is set by its first non-None value; a numeric column that
+# later receives text is promoted to TEXT, its earlier chunks stay numeric.
+MAGIC = b"BMSARC01"
+VERSION = 2
+_TAIL = struct.Struct("<Q8s")
+DEFAULT_CHUNK_SECONDS = 60.0
+
+NUMERIC = "f"
+TEXT = "s"
+
+
+def _shuffle(raw, width=8):
+    """Byte-transpose fixed-width words: all first bytes, then all second..."""
+    return b"".join(raw[k::width] for k in range(width))
+
+
+def _unshuffle(raw, width=8):
+    n = len(raw) // width
+    out = bytearray(len(raw))
+    for k in range(width):
+        out[k::width] = raw[k * n:(k + 1) * n]
+    return out
+
+
+def _encode_times(times):
+    us = [round(t * 1e6) for t in times]
+    deltas = array("q", [us[0]] + [b - a for a, b in zip(us, us[1:])])
+    return zlib.compress(_shuffle(deltas.tobytes()))
+
+
+def _decode_times(blob):
+    deltas = array("q")
+    deltas.frombytes(_unshuffle(zlib.decompress(blob)))
+    return array("d", map((1e-6).__mul__, accumulate(deltas)))
+
+
+def _encode_values(values):
+    bits = array("Q")
+    bits.frombytes(array("d", [math.nan if v is None else v for v in values]).tobytes())
+    xored = array("Q", [bits[0]] + [b ^ a for a, b in zip(bits, bits[1:])])
+    return zlib.compress(_shuffle(xored.tobytes()))
+
+
+def _decode_values(blob):
+    xored = array("Q")
+    xored.frombytes(_unshuffle(zlib.decompress(blob)))
+    values = array("d")
+    values.frombytes(array("Q", accumulate(xored, xor)).tobytes())
+    return values
+
+
+class ArchiveWriter:
+    """
+    Appends decoded signals to a columnar archive, in chunks of
+    `chunk_seconds`. append() only buffers; each finished chunk is encoded,
+    compressed and written by a background thread (zlib releases the GIL),
+    so it can be called from the CAN reader thread. A chunk that cannot be
+    written is reported once and counted in `failed_chunks`; close() still
+    writes the index of the others, then raises.
+    """
+
+    def __init__(self, path, chunk_seconds=DEFAULT_CHUNK_SECONDS):
+        self.path = path
+        self.chunk_seconds = chunk_seconds
+        self.columns = {}  # signal -> NUMERIC / TEXT
+        self.chunks = []   # index entries, filled by the writer thread
+        self.samples = 0
+        self.failed_chunks = 0
+        self.error = None  # first exception of the writer thread
+
+        self._file = open(path, "wb")
+        self._file.write(MAGIC)
+        self._buffers = {}  # signal -> (times, values)
+        self._chunk_end = None
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="archive")
+        self._pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def append(self, timestamp, values):
+        """
+        Record {signal: value} at `timestamp` (seconds since the epoch).
+        None marks a signal as invalid (stored as NaN / null).
+        """
+        with self._lock:
+            if self._chunk_end is None:
+                self._chunk_end = timestamp + self.chunk_seconds
+            elif timestamp >= self._chunk_end:
+                self._flush()
+                self._chunk_end = timestamp + self.chunk_seconds
+            buffers = self._buffers
+            for name, value in values.items():
+                column = buffers.get(name)
+                if column is None:
+                    column = buffers[name] = ([], [])
+                column[0].append(timestamp)
+                column[1].append(value)
+            self.samples += len(values)
+
+    def flush(self):
+        """Encode and write the buffered samples as a chunk now."""
+        with self._lock:
+            self._flush()
+            pending, self._pending = self._pending, []
+        for future in pending:
+            self._check(future)
+
+    def close(self):
+        if self._file is None:
+            return
+        self.flush()
+        self._executor.shutdown()
+        index_offset = self._file.tell()
+        columns = {name: kind or NUMERIC for name, kind in self.columns.items()}
+        self._file.write(zlib.compress(json.dumps({
+            "version": VERSION,
+            "chunk_seconds": self.chunk_seconds,
+            "columns": columns,
+            "chunks": self.chunks,
+        }).encode("utf-8")))
+        self._file.write(_TAIL.pack(index_offset, MAGIC))
+        self._file.close()
+        self._file = None
+        if self.error is not None:
+            raise RuntimeError(f"{self.failed_chunks} chunk(s) of {self.path} could not "
+                               f"be written") from self.error
+
+    def _flush(self):
+        if not self._buffers:
+            return
+        buffers = self._buffers
+        self._buffers = {}
+        pending = []
+        for future in self._pending:
+            if future.done():
+                self._check(future)
+            else:
+                pending.append(future)
+        pending.append(self._executor.submit(self._write_chunk, buffers))
+        self._pending = pending
+
+    def _check(self, future):
+        """Wait for a chunk write; record (and report once) its failure."""
+        error = future.exception()
+        if error is None:
+            return
+        self.failed_chunks += 1
+        if self.error is None:
+            print(f"Archive {self.path}: chunk lost ({error!r})")
+            self.error = error
+
+    def _write_chunk(self, buffers):
+        f = self._file
+        t0 = min(times[0] for times, _ in buffers.values())
+        t1 = max(times[-1] for times, _ in buffers.values())
+        cols = {}
+        times_blobs = {}  # (count, first, last) -> [(times, (offset, length))]
+        for name, (times, values) in buffers.items():
+            kind = self.columns.get(name)
+            if kind != TEXT and any(isinstance(v, str) for v in values):
+                kind = self.columns[name] = TEXT
+            elif kind is None and any(v is not None for v in values):
+                kind = self.columns[name] = NUMERIC
+            else:
+                self.columns.setdefault(name, None)  # only None so far: NaN
+            if kind == TEXT:
+                t_ref = (0, 0)
+                v_blob = zlib.compress(json.dumps(list(zip(times, values))).encode("utf-8"))
+            else:
+                same = times_blobs.setdefault((len(times), times[0], times[-1]), [])
+                t_ref = next((ref for other, ref in same if other == times), None)
+                if t_ref is None:
+                    t_blob = _encode_times(times)
+                    t_ref = (f.tell(), len(t_blob))
+                    same.append((times, t_ref))
+                    f.write(t_blob)
+                v_blob = _encode_values(values)
+            cols[name] = [t_ref[0], t_ref[1], f.tell(), len(v_blob), len(values), kind or NUMERIC]
+            f.write(v_blob)
+        self.chunks.append({"t0": t0, "t1": t1, "cols": cols})
+
+
+class ArchiveReader:
+    """
+    Random access to an archive written by ArchiveWriter. Only the chunks
+    overlapping the requested time range, and in them only the requested
+    columns, are read and decompressed - in parallel across chunks.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.size = os.path.getsize(path)
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a BMS archive")
+            f.seek(self.size - _TAIL.size)
+            index_offset, magic = _TAIL.unpack(f.read(_TAIL.size))
+            if magic != MAGIC:
+                raise ValueError(f"{path} has no index (writer not closed?)")
+            f.seek(index_offset)
+            index = json.loads(zlib.decompress(f.read(self.size - _TAIL.size - index_offset)))
+        self.chunk_seconds = index["chunk_seconds"]
+        self.columns = index["columns"]
+        self.chunks = index["chunks"]
+        self._starts = [chunk["t0"] for chunk in self.chunks]
+
+    @property
+    def signals(self):
+        return list(self.columns)
+
+    @property
+    def start(self):
+        return self.chunks[0]["t0"] if self.chunks else None
+
+    @property
+    def end(self):
+        return max(chunk["t1"] for chunk in self.chunks) if self.chunks else None
+
+    def chunks_between(self, start=None, end=None):
+        """Indices of the chunks overlapping [start, end]."""
+        first = 0
+        if start is not None:
+            # chunks are in time order; step back one in case it spans `start`
+            first = max(0, bisect.bisect_right(self._starts, start) - 1)
+        indices = []
+        for i in range(first, len(self.chunks)):
+            chunk = self.chunks[i]
+            if end is not None and chunk["t0"] > end:
+                break
+            if start is None or chunk["t1"] >= start:
+                indices.append(i)
+        return indices
+
+    def read_chunk(self, i, signals=None):
+        """{signal: (times, values)} of chunk `i`."""
+        cols = self.chunks[i]["cols"]
+        names = cols if signals is None else [s for s in signals if s in cols]
+        out = {}
+        decoded_times = {}  # shared times blobs are decoded once
+        with open(self.path, "rb") as f:
+            for name in names:
+                t_offset, t_len, v_offset, v_len = cols[name][:4]
+                kind = cols[name][5] if len(cols[name]) > 5 else self.columns[name]
+                f.seek(v_offset)
+                v_blob = f.read(v_len)
+                if kind == TEXT:
+                    pairs = json.loads(zlib.decompress(v_blob))
+                    out[name] = (array("d", [t for t, _ in pairs]), [v for _, v in pairs])
+                    continue
+                times = decoded_times.get(t_offset)
+                if times is None:
+                    f.seek(t_offset)
+                    times = decoded_times[t_offset] = _decode_times(f.read(t_len))
+                values = _decode_values(v_blob)
+                if self.columns[name] == TEXT:  # numeric chunks of a promoted column
+                    values = [None if v != v else v for v in values]
+                out[name] = (times, values)
+        return out
+
+    def read(self, signals=None, start=None, end=None, workers=4, executor=None):
+        """
+        {signal: (times, values)} for [start, end] (both optional), times as
+        array('d') of epoch seconds, values as array('d') (NaN = invalid) or
+        a list for text columns.
+
+        Chunks are decoded by a pool of `workers` threads, or by `executor`
+        if given - a ProcessPoolExecutor also parallelizes the delta / XOR
+        decoding, which holds the GIL (zlib itself does not).
+        """
+        indices = self.chunks_between(start, end)
+        if executor is not None:
+            parts = list(executor.map(self.read_chunk, indices, repeat(signals)))
+        elif workers > 1 and len(indices) > 1:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                parts = list(pool.map(self.read_chunk, indices, repeat(signals)))
+        else:
+            parts = [self.read_chunk(i, signals) for i in indices]
+
+        result = {}
+        for part in parts:
+            for name, (times, values) in part.items():
+                lo = 0 if start is None else bisect.bisect_left(times, start)
+                hi = len(times) if end is None else bisect.bisect_right(times, end)
+                if name not in result:
+                    result[name] = (array("d"), [] if self.columns[name] == TEXT else array("d"))
+                result[name][0].extend(times[lo:hi])
+                result[name][1].extend(values[lo:hi])
+        return result
+
+    def raw_size(self):
+        """Size of the stored samples uncompressed (8-byte time + 8-byte value)."""
+        return 16 * sum(col[4] for chunk in self.chunks for col in chunk["cols"].values())
+
+
+def read_trc(path):
+    """
+    Frames of a PCAN-View / PCAN-Basic trace file (.trc, versions 1.x and
+    2.x), as (timestamp, can_id, data). Timestamps are epoch seconds when the
+    file has a $STARTTIME, else seconds from the start of the recording.
+    Only data frames are returned (no RTR, error or status lines).
+    """
+    version = "1.1"
+    start = 0.0
+    columns = None
+    with open(path, "r", encoding="latin-1") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith(";"):
+                if line.startswith(";$FILEVERSION="):
+                    version = line.split("=", 1)[1]
+                elif line.startswith(";$STARTTIME="):
+                    # OLE automation date: days since 1899-12-30
+                    start = (float(line.split("=", 1)[1]) - 25569.0) * 86400.0
+                elif line.startswith(";$COLUMNS="):
+                    columns = line.split("=", 1)[1].split(",")
+                continue
+
+            fields = line.split()
+            if version.startswith("1"):
+                # "1)  1059.9  Rx  0200  8  0F A0 ..." (1.0 has no Rx/Tx column)
+                if not fields[0].endswith(")") or "ERROR" in fields or "RTR" in fields:
+                    continue
+                i = 3 if fields[2] in ("Rx", "Tx") else 2
+                offset_ms = float(fields[1])
+                can_id = int(fields[i], 16)
+                length = int(fields[i + 1])
+                data = bytes(int(b, 16) for b in fields[i + 2:i + 2 + length])
+            else:
+                cols = columns or ["N", "O", "T", "I", "d", "l", "D"]
+                if "R" not in cols and "-" in fields:
+                    fields = [x for x in fields if x != "-"]
+                row = dict(zip(cols, fields))
+                if row.get("T") not in ("DT", "FD", "FB", "FE", "BI"):
+                    continue
+                offset_ms = float(row["O"])
+                can_id = int(row["I"], 16)
+                if "L" in row:
+                    length = FD_DLC_LEN[int(row["L"])]
+                else:
+                    length = int(row["l"])
+                first = cols.index("D")
+                data = bytes(int(b, 16) for b in fields[first:first + length])
+            yield start + offset_ms / 1000.0, can_id, data
+
+
+def convert(frames, out_path, chunk_seconds=DEFAULT_CHUNK_SECONDS):
+    """
+    Decode recorded frames ((timestamp, can_id, data) tuples, e.g. from
+    read_trc) with a hardware-less BMSPcanListener and write the signals
+    each frame changes to an archive. Returns the number of frames decoded.
+    """
+    listener = BMSPcanListener(registry=Registry())
+    decoded = 0
+    with ArchiveWriter(out_path, chunk_seconds) as writer:
+        for timestamp, can_id, data in frames:
+            if listener.decode_payload(can_id, data, timestamp) is not None:
+                writer.append(timestamp, listener.frame_changes(can_id))
+                decoded += 1
+    return decoded
+
+
+def record(out_path, seconds=None, chunk_seconds=DEFAULT_CHUNK_SECONDS, **listener_kwargs):
+    """Record live traffic into an archive until `seconds` elapse or Ctrl+C."""
+    with ArchiveWriter(out_path, chunk_seconds) as writer:
+        listener = BMSPcanListener(archive=writer, **listener_kwargs)
+        listener.start()
+        try:
+            deadline = None if seconds is None else time.monotonic() + seconds
+            while deadline is None or time.monotonic() < deadline:
+                time.sleep(0.2)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            listener.stop()
+
+
+def benchmark(path, source_size=None, queries=200, window=60.0, workers=4):
+    """
+    Compression ratio and random-access latency of an archive: `queries`
+    reads of a random `window`-second range, then one full read decoded
+    serially, by threads and by processes.
+    """
+    reader = ArchiveReader(path)
+    result = {
+        "archive_bytes": reader.size,
+        "chunks": len(reader.chunks),
+        "ratio_vs_samples": reader.raw_size() / reader.size,
+    }
+    if source_size:
+        result["ratio_vs_source"] = source_size / reader.size
+    if not reader.chunks:
+        return result
+
+    latency = HdrHistogram()
+    span = max(0.0, reader.end - reader.start - window)
+    for _ in range(queries):
+        t = reader.start + random.random() * span
+        t_start = time.perf_counter_ns()
+        reader.read(start=t, end=t + window, workers=workers)
+        latency.record(time.perf_counter_ns() - t_start)
+    s = latency.summary()
+    result["window_read_p50_ms"] = s["p50_ns"] / 1e6
+    result["window_read_p99_ms"] = s["p99_ns"] / 1e6
+
+    for name, n in (("full_read_serial_s", 1), ("full_read_threads_s", workers)):
+        t_start = time.perf_counter()
+        reader.read(workers=n)
+        result[name] = time.perf_counter() - t_start
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        t_start = time.perf_counter()
+        reader.read(executor=pool)
+        result["full_read_processes_s"] = time.perf_counter() - t_start
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Columnar BMS signal archives")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("convert", help="decode a .trc recording into an archive")
+    p.add_argument("trc")
+    p.add_argument("archive")
+    p.add_argument("--chunk", type=float, default=DEFAULT_CHUNK_SECONDS, help="chunk length (s)")
+    p = sub.add_parser("record", help="record live traffic into an archive")
+    p.add_argument("archive")
+    p.add_argument("--seconds", type=float)
+    p.add_argument("--chunk", type=float, default=DEFAULT_CHUNK_SECONDS, help="chunk length (s)")
+    p = sub.add_parser("info", help="signals, time range and chunks of an archive")
+    p.add_argument("archive")
+    p = sub.add_parser("bench", help="compression ratio and random-access latency")
+    p.add_argument("archive")
+    p.add_argument("--source", help="original recording, for the ratio against it")
+    p.add_argument("--window", type=float, default=60.0)
+    p.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        n = convert(read_trc(args.trc), args.archive, args.chunk)
+        print(f"{n} frames decoded into {args.archive}")
+    elif args.command == "record":
+        record(args.archive, args.seconds, args.chunk)
+    elif args.command == "info":
+        reader = ArchiveReader(args.archive)
+        print(f"{len(reader.chunks)} chunks, {reader.size} bytes, "
+              f"{reader.start} .. {reader.end}")
+        print(", ".join(reader.signals))
+    else:
+        source_size = os.path.getsize(args.source) if args.source else None
+        for key, value in benchmark(args.archive, source_size, window=args.window,
+                                    workers=args.workers).items():
+            print(f"{key:<24}{value:.3f}" if isinstance(value, float) else f"{key:<24}{value}")
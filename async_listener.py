@@ -0,0 +1,241 @@
+# async_listener.py
+import asyncio
+import platform
+import time
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from PCANBasic import PCAN_ERROR_OK, PCAN_ERROR_QRCVEMPTY
+from bus_health import OVERRUN
+
+# A raw frame as delivered by AsyncBMSListener.frames()
+Frame = namedtuple("Frame", "can_id data timestamp")
+
+MAX_BATCH = 256  # frames drained per loop callback before yielding to other tasks
+
+
+class AsyncBMSListener:
+    """
+    asyncio front-end for a BMSPcanListener:
+
+        listener = BMSPcanListener()
+        async with AsyncBMSListener(listener) as bms:
+            async for snap in bms.snapshots():
+                ...
+
+    Where the PCAN receive event is a selectable file descriptor (Linux /
+    macOS), reading is driven by loop.add_reader() and runs on the event
+    loop itself. Otherwise a single-thread executor does the blocking reads
+    and hands frames to the loop. In both cases decoding happens on the loop
+    thread, so BMSPcanListener.state is only ever touched from there.
+
+    Read errors go through the listener's error handling on the loop thread
+    as well (health, overrun accounting, bus-off / re-plug recovery); the
+    back-off is a call_later() in reader mode, a wait on the executor
+    thread otherwise. A re-opened channel has a new receive fd, which is
+    registered again.
+
+    Any number of frames() / snapshots() consumers can run concurrently.
+    """
+
+    def __init__(self, listener, frame_queue_size=4096, poll_interval=0.05):
+        """
+        :param listener: a BMSPcanListener that has not been started
+        :param frame_queue_size: per-consumer frame queue bound; frames for a
+                                 full queue are dropped (see dropped_frames)
+        :param poll_interval: seconds between staleness checks
+        """
+        self.listener = listener
+        self.frame_queue_size = frame_queue_size
+        self.poll_interval = poll_interval
+        self.mode = None  # "reader" (add_reader) or "executor"
+        self.dropped_frames = 0
+
+        self._loop = None
+        self._closing = False
+        self._frame_queues = set()
+        self._snapshot_events = set()
+        self._executor = None
+        self._reader_future = None
+        self._reader_fd = None  # fd registered with add_reader()
+        self._retry = None      # call_later() handle: recovery or polling
+        self._poll_task = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._closing = False
+        self.listener._stop.clear()
+        self.listener.open()
+        self.listener._start_dispatcher()
+
+        if self._try_add_reader():
+            self.mode = "reader"
+            self._drain()  # frames that arrived before the reader was armed
+        else:
+            self.mode = "executor"
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pcan-reader")
+            self._reader_future = self._loop.run_in_executor(self._executor, self._blocking_reader)
+
+        self._poll_task = asyncio.create_task(self._poll_stale())
+
+    async def stop(self):
+        self._closing = True
+        self.listener._stop.set()  # interrupts an error back-off wait
+        if self._retry is not None:
+            self._retry.cancel()
+            self._retry = None
+        self._disarm()
+        if self._reader_future is not None:
+            await self._reader_future
+            self._reader_future = None
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+            self._poll_task = None
+        self.listener._stop_dispatcher()
+        self.listener.close()
+
+    async def frames(self):
+        """Async iterator over every received frame (as Frame tuples)."""
+        queue = asyncio.Queue(self.frame_queue_size)
+        self._frame_queues.add(queue)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self._frame_queues.discard(queue)
+
+    async def snapshots(self):
+        """
+        Async iterator over bms_data snapshots (plain dicts). Latest-only: a
+        consumer that is busy skips the intermediate states.
+        """
+        event = asyncio.Event()
+        self._snapshot_events.add(event)
+        try:
+            while True:
+                await event.wait()
+                event.clear()
+                yield self.listener.state.as_dict()
+        finally:
+            self._snapshot_events.discard(event)
+
+    def _try_add_reader(self):
+        fd = self.listener.fd
+        if fd is None or fd <= 0 or platform.system() == "Windows":
+            return False  # on Windows the receive event is a HANDLE, not an fd
+        try:
+            self._loop.add_reader(fd, self._drain)
+        except (NotImplementedError, ValueError, OSError):
+            return False
+        self._reader_fd = fd
+        return True
+
+    def _disarm(self):
+        if self._reader_fd is not None:
+            self._loop.remove_reader(self._reader_fd)
+            self._reader_fd = None
+
+    def _drain(self):
+        """add_reader callback: read what the driver has queued."""
+        self._retry = None
+        listener = self.listener
+        read = listener.read_function()
+        for _ in range(MAX_BATCH):
+            result, msg, _ = read(listener.channel)
+            if result == PCAN_ERROR_OK:
+                self._deliver(msg)
+            elif result == PCAN_ERROR_QRCVEMPTY:
+                if self._reader_fd is None:  # re-opened without a selectable fd: poll
+                    self._retry = self._loop.call_later(self.poll_interval, self._drain)
+                return
+            else:
+                kind, delay = self._note_error(result)
+                if delay is not None:
+                    # stop reading (the fd may stay readable) until the back-off is over
+                    self._disarm()
+                    self._retry = self._loop.call_later(delay, self._recover, kind)
+                    return
+                # overrun: frames are still queued, keep reading
+        # More frames pending: continue on the next loop iteration
+        self._loop.call_soon(self._drain)
+
+    def _note_error(self, result):
+        """
+        Loop thread: the listener's error bookkeeping for a failed read.
+        Returns (error class, back-off delay or None to keep reading).
+        """
+        listener = self.listener
+        kind = listener._note_error(result)
+        return kind, None if kind == OVERRUN else listener._backoff.next()
+
+    def _recover(self, kind):
+        """Reader mode, after the back-off: recover, then register the fd again."""
+        self._retry = None
+        if self._closing:
+            return
+        self.listener._recover(kind)
+        self._try_add_reader()
+        self._drain()
+
+    def _blocking_reader(self):
+        """Executor fallback: blocking read loop handing frames to the loop."""
+        listener = self.listener
+        read = listener.read_function()
+        call = self._loop.call_soon_threadsafe
+        while not self._closing:
+            result, msg, _ = read(listener.channel)
+            if result == PCAN_ERROR_OK:
+                call(self._deliver, msg)
+            elif result == PCAN_ERROR_QRCVEMPTY:
+                time.sleep(0.001)
+            else:
+                # bookkeeping and recovery run on the loop thread, like the
+                # decoding; only the back-off wait blocks this thread
+                kind, delay = self._on_loop(self._note_error, result)
+                if delay is not None and not listener._stop.wait(delay):
+                    self._on_loop(listener._recover, kind)
+
+    def _on_loop(self, func, *args):
+        """Executor thread: run func(*args) on the loop thread and wait for it."""
+        future = Future()
+
+        def run():
+            try:
+                future.set_result(func(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+        self._loop.call_soon_threadsafe(run)
+        return future.result()
+
+    def _deliver(self, msg):
+        listener = self.listener
+        can_id, data = listener.frame_fields(msg)
+        frame = Frame(can_id, data, time.monotonic())
+        if listener.health.state != "ok":
+            listener._backoff.reset()
+            listener._set_health("ok")
+        listener._handle_message(msg)
+
+        for queue in self._frame_queues:
+            try:
+                queue.put_nowait(frame)
+            except asyncio.QueueFull:
+                self.dropped_frames += 1
+        for event in self._snapshot_events:
+            event.set()
+
+    async def _poll_stale(self):
+        while True:
+            self.listener.poll(time.monotonic())
+            await asyncio.sleep(self.poll_interval)
@@ -0,0 +1,328 @@
+# bms_state.py
+from array import array
+from collections.abc import Mapping
+
+NUM_CELLS = 13
+NUM_NTC = 3
+
+# Limits for variable-size packs (CAN FD firmware, see FD_MEASUREMENT_ID)
+MAX_CELLS = 28
+MAX_NTC = 4
+
+# Cell frames: CAN ID -> (index of the first cell, number of cells)
+CELL_FRAMES = {
+    0x200: (0, 4),
+    0x201: (4, 4),
+    0x202: (8, 4),
+    0x203: (12, 1),
+}
+
+# CAN FD firmware: one 64-byte frame with every cell voltage and NTC reading
+#   data[0] = cell count N, data[1] = NTC count M,
+#   then N x u16 cell mV and M x u16 raw NTC counts, all big-endian.
+# Pack values and alarms still come in 0x205 / 0x206.
+FD_MEASUREMENT_ID = 0x210
+
+# CAN FD data length codes -> payload length
+FD_DLC_LEN = (0, 1, 2, 3, 4, 5, 6, 7, 8, 12, 16, 20, 24, 32, 48, 64)
+
+# Slots of BMSState.pack (all decoded from 0x205)
+PACK_SUM = 0
+VMIN = 1
+VMAX = 2
+VBATT = 3
+PACK_FIELDS = ("pack_sum", "vmin", "vmax", "vbatt")
+
+# Alarm bits packed into BMSState.alarm_bits (decoded from 0x206)
+ALARM_VMIN = 0x01
+ALARM_VMAX = 0x02
+ALARM_TMIN = 0x04
+ALARM_TMAX = 0x08
+ALARM_VBATT = 0x10
+ALARM_SN_ERROR = 0x20
+ALARM_BITS = (
+    ("vmin", ALARM_VMIN),
+    ("vmax", ALARM_VMAX),
+    ("tmin", ALARM_TMIN),
+    ("tmax", ALARM_TMAX),
+    ("vbatt", ALARM_VBATT),
+    ("sn_error", ALARM_SN_ERROR),
+)
+
+# Flat signal names, used by rules, exporters and recordings.
+# Cells and NTCs are 1-based like on the dashboard ("cell1".."cell13").
+DERIVED_SIGNALS = ("cell_sum", "cell_min", "cell_max", "cell_spread", "pack_gap", "ntc_spread")
+
+
+def cell_signal(index):
+    return f"cell{index + 1}"
+
+
+def ntc_signal(index):
+    return f"ntc{index + 1}"
+
+
+def _build_frame_signals():
+    derived_cells = ("cell_sum", "cell_min", "cell_max", "cell_spread", "pack_gap")
+    frames = {}
+    for can_id, (first, count) in CELL_FRAMES.items():
+        frames[can_id] = tuple(cell_signal(i) for i in range(first, first + count)) + derived_cells
+    frames[0x204] = tuple(ntc_signal(i) for i in range(NUM_NTC)) + ("ntc_spread",)
+    frames[0x205] = PACK_FIELDS + ("pack_gap",)
+    frames[0x206] = tuple(f"alarm_{name}" for name, _ in ALARM_BITS)
+    frames[FD_MEASUREMENT_ID] = (
+        tuple(cell_signal(i) for i in range(MAX_CELLS))
+        + tuple(ntc_signal(i) for i in range(MAX_NTC))
+        + derived_cells + ("ntc_spread",)
+    )
+    frames[0x300] = ("serial_number",)
+    frames[0x301] = ("hw_version", "sw_version")
+    return frames
+
+
+# CAN ID -> names of the signals a frame with that ID may change
+FRAME_SIGNALS = _build_frame_signals()
+
+
+class BMSState:
+    """
+    Compact storage for the decoded BMS values.
+
+    Numeric values live unboxed in array('d') buffers that are allocated once,
+    so a frame update only writes doubles in place. Instead of storing None,
+    every buffer has an integer validity mask (bit i set => slot i was received).
+    The six BMS alarms are packed into a single int (see ALARM_*).
+
+    The old nested-dict shape is still available through view(), which is what
+    BMSPcanListener hands to on_update() as bms_data.
+    """
+
+    __slots__ = (
+        "voltages", "ntc", "ntc_raw", "pack",
+        "cell_valid", "ntc_valid", "pack_valid",
+        "alarm_bits", "alarms_valid",
+        "serial_number", "hw_version", "sw_version",
+        "derived", "soc", "loss", "stale_ids", "frame_signals", "_view",
+    )
+
+    def __init__(self, num_cells=NUM_CELLS, num_ntc=NUM_NTC):
+        """
+        :param num_cells: number of cell voltage slots (13 for the 13S pack)
+        :param num_ntc: number of NTC slots
+        """
+        self.voltages = array("d", bytes(8 * num_cells))
+        self.ntc = array("d", bytes(8 * num_ntc))      # °C
+        self.ntc_raw = array("l", [0]) * num_ntc       # ADC counts, as received
+        self.pack = array("d", bytes(8 * len(PACK_FIELDS)))
+        self.cell_valid = 0
+        self.ntc_valid = 0
+        self.pack_valid = 0
+        self.alarm_bits = 0
+        self.alarms_valid = False
+        self.serial_number = None
+        self.hw_version = None
+        self.sw_version = None
+        self.derived = None  # DerivedMetrics attached by the listener, if any
+        self.soc = None  # soc.SOCEstimator attached by the listener, if any
+        self.loss = None  # frame_loss.FrameLossTracker attached by the listener, if any
+        self.stale_ids = set()  # CAN IDs whose last frame is older than the timeout
+        self.frame_signals = FRAME_SIGNALS  # the pack variant's layout, set by the listener
+        self._view = None
+
+    @property
+    def num_cells(self):
+        return len(self.voltages)
+
+    @property
+    def num_ntc(self):
+        return len(self.ntc)
+
+    def clear(self):
+        """Forget every value (buffers are kept, only the masks are reset)."""
+        self.stale_ids.clear()
+        self.cell_valid = 0
+        self.ntc_valid = 0
+        self.pack_valid = 0
+        self.alarm_bits = 0
+        self.alarms_valid = False
+        self.serial_number = None
+        self.hw_version = None
+        self.sw_version = None
+
+    def resized(self, num_cells, num_ntc):
+        """
+        New state for a pack with another cell / NTC count, keeping the pack
+        values, alarms and identity. Cells and NTCs start out invalid.
+        """
+        state = BMSState(num_cells, num_ntc)
+        state.pack[:] = self.pack
+        state.pack_valid = self.pack_valid
+        state.alarm_bits = self.alarm_bits
+        state.alarms_valid = self.alarms_valid
+        state.serial_number = self.serial_number
+        state.hw_version = self.hw_version
+        state.sw_version = self.sw_version
+        state.stale_ids = set(self.stale_ids)
+        state.frame_signals = self.frame_signals
+        state.loss = self.loss  # counts the channel, not the pack layout
+        return state
+
+    def detach(self):
+        """
+        Drop the objects attached to a state that has been replaced (see
+        resized()): they point back at it, and without these cycles the
+        old state is freed at once instead of by the cyclic collector.
+        """
+        self.derived = None
+        self.soc = None
+        self.loss = None
+        self._view = None
+
+    def cell(self, index):
+        """Cell voltage at index, or None if it was never received."""
+        if self.cell_valid >> index & 1:
+            return self.voltages[index]
+        return None
+
+    def alarm(self, bit):
+        """True if the given ALARM_* bit is currently set."""
+        return bool(self.alarm_bits & bit)
+
+    def getter(self, name):
+        """
+        Return a zero-argument callable reading signal `name` from this state
+        (None while the signal is not valid). Resolve it once, call it often.
+        """
+        if name.startswith("cell") and name[4:].isdigit():
+            index = int(name[4:]) - 1
+            if not 0 <= index < MAX_CELLS:
+                raise KeyError(name)
+            if index >= self.num_cells:
+                return lambda: None  # not present on this pack variant
+            voltages = self.voltages
+            return lambda: voltages[index] if self.cell_valid >> index & 1 else None
+        if name.startswith("ntc") and name[3:].isdigit():
+            index = int(name[3:]) - 1
+            if not 0 <= index < MAX_NTC:
+                raise KeyError(name)
+            if index >= self.num_ntc:
+                return lambda: None
+            ntc = self.ntc
+            return lambda: ntc[index] if self.ntc_valid >> index & 1 else None
+        if name in _PACK_INDEX:
+            index = _PACK_INDEX[name]
+            pack = self.pack
+            return lambda: pack[index] if self.pack_valid >> index & 1 else None
+        if name.startswith("alarm_"):
+            bit = dict(ALARM_BITS).get(name[6:])
+            if bit is None:
+                raise KeyError(name)
+            return lambda: bool(self.alarm_bits & bit) if self.alarms_valid else None
+        if name in DERIVED_SIGNALS:
+            return lambda: None if self.derived is None else getattr(self.derived, name)
+        if name in _INFO_FIELDS:
+            return lambda: getattr(self, name)
+        raise KeyError(name)
+
+    def signal_names(self):
+        """Every name accepted by getter(), in a stable order."""
+        names = [cell_signal(i) for i in range(self.num_cells)]
+        names += [ntc_signal(i) for i in range(self.num_ntc)]
+        names += PACK_FIELDS
+        names += [f"alarm_{name}" for name, _ in ALARM_BITS]
+        names += DERIVED_SIGNALS
+        names += _INFO_FIELDS
+        return names
+
+    def snapshot(self):
+        """Flat dict signal name -> value of every currently valid signal."""
+        snap = {}
+        for name in self.signal_names():
+            value = self.getter(name)()
+            if value is not None:
+                snap[name] = value
+        return snap
+
+    def view(self):
+        """Return the (cached) dict-shaped compatibility view over this state."""
+        if self._view is None:
+            self._view = BMSDataView(self)
+        return self._view
+
+    def as_dict(self):
+        """Plain-dict snapshot in the historical bms_data shape."""
+        return {key: self._field(key) for key in _VIEW_KEYS}
+
+    def _field(self, key):
+        if key == "voltages":
+            return _masked_list(self.voltages, self.cell_valid)
+        if key == "ntc":
+            return _masked_list(self.ntc, self.ntc_valid)
+        if key == "alarms":
+            bits = self.alarm_bits
+            return {name: bool(bits & bit) for name, bit in ALARM_BITS}
+        if key in _PACK_INDEX:
+            index = _PACK_INDEX[key]
+            if self.pack_valid >> index & 1:
+                return self.pack[index]
+            return None
+        if key == "serial_number":
+            return self.serial_number
+        if key == "hw_version":
+            return self.hw_version
+        if key == "sw_version":
+            return self.sw_version
+        if key == "stale":
+            return [name for can_id in sorted(self.stale_ids)
+                    for name in self.frame_signals.get(can_id, ())]
+        if key == "derived":
+            if self.derived is None:
+                return None
+            return self.derived.as_dict()
+        if key == "soc":
+            if self.soc is None:
+                return None
+            return self.soc.as_dict()
+        if key == "loss":
+            if self.loss is None:
+                return None
+            return self.loss.as_dict()
+        raise KeyError(key)
+
+
+class BMSDataView(Mapping):
+    """
+    Read-only mapping with the same keys and value shapes as the original
+    bms_data dict ("voltages" -> list with None for missing cells, "alarms" ->
+    dict of bools, ...). Values are materialized on access only.
+    """
+
+    __slots__ = ("state",)
+
+    def __init__(self, state):
+        self.state = state
+
+    def __getitem__(self, key):
+        return self.state._field(key)
+
+    def __iter__(self):
+        return iter(_VIEW_KEYS)
+
+    def __len__(self):
+        return len(_VIEW_KEYS)
+
+    def __repr__(self):
+        return f"BMSDataView({self.state.as_dict()!r})"
+
+
+_INFO_FIELDS = ("serial_number", "hw_version", "sw_version")
+_PACK_INDEX = {name: i for i, name in enumerate(PACK_FIELDS)}
+_VIEW_KEYS = (
+    "voltages", "ntc", "pack_sum", "vmin", "vmax", "vbatt", "alarms",
+    "serial_number", "hw_version", "sw_version", "derived", "soc", "loss", "stale",
+)
+
+
+def _masked_list(values, mask):
+    return [v if mask >> i & 1 else None for i, v in enumerate(values)]
+
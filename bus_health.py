@@ -0,0 +1,100 @@
+# bus_health.py
+import time
+
+from PCANBasic import (
+    PCAN_ERROR_OK, PCAN_ERROR_QRCVEMPTY, PCAN_ERROR_QOVERRUN, PCAN_ERROR_OVERRUN,
+    PCAN_ERROR_BUSLIGHT, PCAN_ERROR_BUSHEAVY, PCAN_ERROR_BUSPASSIVE, PCAN_ERROR_BUSOFF,
+    PCAN_ERROR_ILLHANDLE, PCAN_ERROR_NODRIVER, PCAN_ERROR_REGTEST,
+    PCAN_ERROR_INITIALIZE, PCAN_ERROR_ILLOPERATION,
+)
+
+# Status classes returned by classify()
+OK = "ok"
+EMPTY = "empty"
+OVERRUN = "overrun"
+BUS_WARNING = "bus_warning"
+BUS_OFF = "bus_off"
+DISCONNECTED = "disconnected"
+OTHER = "other"
+ERROR_CLASSES = (OVERRUN, BUS_WARNING, BUS_OFF, DISCONNECTED, OTHER)
+
+# Channel health states (BusHealth.state), with a numeric code for gauges
+HEALTH_CODES = {"ok": 0, "warning": 1, "bus_off": 2, "disconnected": 3}
+
+_DISCONNECTED_MASK = (
+    PCAN_ERROR_ILLHANDLE | PCAN_ERROR_NODRIVER | PCAN_ERROR_REGTEST
+    | PCAN_ERROR_INITIALIZE | PCAN_ERROR_ILLOPERATION
+)
+_OVERRUN_MASK = PCAN_ERROR_QOVERRUN | PCAN_ERROR_OVERRUN
+_WARNING_MASK = PCAN_ERROR_BUSLIGHT | PCAN_ERROR_BUSHEAVY | PCAN_ERROR_BUSPASSIVE
+
+
+def classify(status):
+    """
+    Map a PCANBasic status (possibly several bits combined) to one class,
+    the most severe first: disconnected > bus_off > overrun > bus_warning.
+    """
+    if status == PCAN_ERROR_OK:
+        return OK
+    if status == PCAN_ERROR_QRCVEMPTY:
+        return EMPTY
+    if status & _DISCONNECTED_MASK:
+        return DISCONNECTED
+    if status & PCAN_ERROR_BUSOFF:
+        return BUS_OFF
+    if status & _OVERRUN_MASK:
+        return OVERRUN
+    if status & _WARNING_MASK:
+        return BUS_WARNING
+    return OTHER
+
+
+class Backoff:
+    """Exponential back-off delay: initial, 2*initial, ... capped at maximum."""
+
+    def __init__(self, initial=0.01, maximum=2.0):
+        self.initial = initial
+        self.maximum = maximum
+        self.delay = initial
+
+    def next(self):
+        delay = self.delay
+        self.delay = min(self.delay * 2, self.maximum)
+        return delay
+
+    def reset(self):
+        self.delay = self.initial
+
+
+class BusHealth:
+    """
+    Health of one CAN channel as seen by the reader loop: current state
+    ("ok", "warning", "bus_off", "disconnected"), error counters per class,
+    recovery counters and the last error status.
+    """
+
+    def __init__(self):
+        self.state = "ok"
+        self.since = time.monotonic()
+        self.last_status = PCAN_ERROR_OK
+        self.errors = {name: 0 for name in ERROR_CLASSES}
+        self.resets = 0
+        self.reopens = 0
+
+    def set_state(self, state):
+        """Change state; returns True if it actually changed."""
+        if state == self.state:
+            return False
+        self.state = state
+        self.since = time.monotonic()
+        return True
+
+    def as_dict(self):
+        return {
+            "state": self.state,
+            "since": self.since,
+            "last_status": self.last_status,
+            "errors": dict(self.errors),
+            "resets": self.resets,
+            "reopens": self.reopens,
+        }
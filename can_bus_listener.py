@@ -0,0 +1,286 @@
+# can_bus_listener.py
+import errno
+import threading
+import time
+
+import can
+
+from PCANBasic import (
+    PCAN_ERROR_OK, PCAN_ERROR_QRCVEMPTY, PCAN_ERROR_QXMTFULL, PCAN_ERROR_ILLOPERATION,
+    PCAN_MESSAGE_EXTENDED, PCAN_MESSAGE_RTR, PCAN_MESSAGE_FD, PCAN_MESSAGE_BRS,
+)
+from bms_state import FD_DLC_LEN, FRAME_SIGNALS
+from bus_health import OVERRUN, BUS_WARNING, BUS_OFF
+from data_handler import BMSPcanListener
+
+MAX_BATCH = 256  # frames drained per wake-up before polling staleness again
+
+# The BMS IDs: what the kernel lets through by default
+BMS_IDS = tuple(FRAME_SIGNALS)
+
+# SocketCAN error frames (linux/can/error.h): class bits in the CAN ID,
+# controller status in data[1]
+CAN_ERR_CRTL = 0x004
+CAN_ERR_BUSOFF = 0x040
+CAN_ERR_RESTARTED = 0x100
+CAN_ERR_CRTL_OVERFLOW = 0x01 | 0x02  # RX / TX buffer overflow
+CAN_ERR_CRTL_WARNING = 0x04 | 0x08 | 0x10 | 0x20  # RX / TX warning, passive
+CAN_ERR_CRTL_ACTIVE = 0x40
+
+
+class _BusWriter:
+    """
+    PCANBasic.Write / WriteFD on top of the listener's can.Bus, so that
+    tx_scheduler.TxScheduler sends through python-can unchanged.
+    """
+
+    def __init__(self, listener):
+        self.listener = listener
+
+    def Write(self, channel, msg):
+        rtr = bool(msg.MSGTYPE & PCAN_MESSAGE_RTR.value)
+        return self._send(can.Message(
+            arbitration_id=msg.ID,
+            is_extended_id=bool(msg.MSGTYPE & PCAN_MESSAGE_EXTENDED.value),
+            is_remote_frame=rtr,
+            dlc=msg.LEN,
+            data=None if rtr else bytes(msg.DATA[:msg.LEN]),
+        ))
+
+    def WriteFD(self, channel, msg):
+        rtr = bool(msg.MSGTYPE & PCAN_MESSAGE_RTR.value)
+        length = FD_DLC_LEN[msg.DLC]
+        return self._send(can.Message(
+            arbitration_id=msg.ID,
+            is_extended_id=bool(msg.MSGTYPE & PCAN_MESSAGE_EXTENDED.value),
+            is_remote_frame=rtr,
+            is_fd=bool(msg.MSGTYPE & PCAN_MESSAGE_FD.value),
+            bitrate_switch=bool(msg.MSGTYPE & PCAN_MESSAGE_BRS.value),
+            dlc=length,
+            data=None if rtr else bytes(msg.DATA[:length]),
+        ))
+
+    def _send(self, message):
+        try:
+            self.listener.bus.send(message, timeout=0)
+        except can.CanOperationError as e:
+            # a full socket / queue is retried by the scheduler, anything else fails
+            if e.error_code in (None, errno.ENOBUFS, errno.EAGAIN):
+                return PCAN_ERROR_QXMTFULL
+            return PCAN_ERROR_ILLOPERATION
+        return PCAN_ERROR_OK
+
+
+class CanBusListener(BMSPcanListener):
+    """
+    BMSPcanListener on a python-can bus instead of the PCAN-Basic library:
+    the Linux SocketCAN driver (PEAK adapters are supported by the mainline
+    peak_usb / peak_pci drivers) or python-can's in-process "virtual"
+    interface, which needs no hardware:
+
+        listener = CanBusListener("virtual", "bms-test", on_update=...)
+        listener.start()
+        sender = can.Bus(interface="virtual", channel="bms-test")
+
+    Only the BMS IDs are received: the filters are installed in the kernel
+    on SocketCAN, so the rest of the bus traffic never reaches Python. Frames
+    are decoded at their kernel receive timestamp. The reader blocks on the
+    socket and, once woken, drains up to MAX_BATCH queued frames before
+    checking staleness and the stop flag again.
+
+    The bit rate is configured on the interface (ip link set can0 type can
+    bitrate 500000 [dbitrate 2000000 fd on]), not here. Bus-off, error
+    passive and overflow are read from SocketCAN error frames; the kernel
+    restarts the controller itself if the interface has restart-ms set.
+    """
+
+    def __init__(self, interface="socketcan", channel="can0", fd=False,
+                 filter_ids=BMS_IDS, poll_timeout=0.05, bus_options=None, **options):
+        """
+        :param interface: python-can interface name, "socketcan" or "virtual"
+        :param channel: interface channel, e.g. "can0", "vcan0" or any name
+                        shared by virtual buses
+        :param fd: receive CAN FD frames (and send FD frames)
+        :param filter_ids: standard IDs to receive, None for every frame
+        :param poll_timeout: longest blocking wait, in seconds, between
+                             staleness checks and stop requests
+        :param bus_options: extra keyword arguments for can.Bus
+        :param options: BMSPcanListener options (on_update, rules, ...)
+        """
+        # only the truthiness of fd_bitrate matters here (cycle IDs, FD transmit)
+        super().__init__(fd_bitrate=fd or None, **options)
+        self.interface = interface
+        self.channel = channel
+        self.channel_name = f"{interface} channel {channel}"
+        self.filters = None if filter_ids is None else [
+            {"can_id": can_id, "can_mask": 0x7FF, "extended": False} for can_id in filter_ids
+        ]
+        self.poll_timeout = poll_timeout
+        self.bus_options = dict(bus_options or {})
+        self.bus = None
+        self._last_error = None
+        self._clock_offset = 0.0  # listener clock - wall clock (kernel timestamps)
+
+    def open(self):
+        """
+        Open the bus without starting the reader thread (used by start() and
+        by async_listener.AsyncBMSListener).
+        """
+        try:
+            self._open_bus()
+        except (can.CanError, OSError) as e:
+            raise RuntimeError(f"Error opening {self.channel_name}: {e}") from e
+
+    def _open_bus(self):
+        self.bus = can.Bus(
+            interface=self.interface,
+            channel=self.channel,
+            fd=bool(self.fd_bitrate),
+            can_filters=self.filters,
+            **self.bus_options
+        )
+        self.pcan = _BusWriter(self)  # transmit path for TxScheduler
+        try:
+            self.fd = self.bus.fileno()  # selectable socket for add_reader()
+        except NotImplementedError:
+            self.fd = None
+        self._clock_offset = self.clock() - time.time()
+
+    def close(self):
+        """
+        Shut the bus down.
+        """
+        if self.bus is not None:
+            self.bus.shutdown()
+            self.bus = None
+            print(f"{self.channel_name} closed cleanly.")
+
+    def start(self):
+        """
+        Open the bus and start the background reading thread.
+        """
+        self.open()
+        print(f"CanBusListener started on {self.channel_name}"
+              f"{' in CAN FD mode' if self.fd_bitrate else ''}.")
+
+        self._start_dispatcher()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._start_tx()
+
+    def _run(self):
+        """
+        Background loop: block until a frame arrives, then decode it and
+        everything queued behind it (at most MAX_BATCH frames).
+        """
+        while not self._stop.is_set():
+            self.poll(time.monotonic())
+            # re-anchor the kernel timestamps once per batch (NTP may step the wall clock)
+            self._clock_offset = self.clock() - time.time()
+
+            if self.bus is None:  # a re-open failed: back off and retry
+                self._handle_error(PCAN_ERROR_ILLOPERATION)
+                continue
+            try:
+                msg = self.bus.recv(self.poll_timeout)
+            except can.CanError as e:
+                self._last_error = e
+                self._handle_error(PCAN_ERROR_ILLOPERATION)
+                continue
+            if msg is None:
+                self._m_qrcvempty.value += 1
+                continue
+            if self.health.state in ("disconnected", "bus_off"):
+                self._backoff.reset()
+                self._set_health("ok")
+
+            handle = self._handle_message
+            read = self._read or self._read_frame
+            handle(msg)
+            for _ in range(MAX_BATCH - 1):
+                result, msg, _ = read(self.channel)
+                if result != PCAN_ERROR_OK:
+                    if result != PCAN_ERROR_QRCVEMPTY:
+                        self._handle_error(result)
+                    break
+                handle(msg)
+
+    def read_function(self):
+        """Non-blocking read with the PCANBasic.Read return shape."""
+        return self._read_frame
+
+    def _read_frame(self, channel):
+        if self.bus is None:
+            return PCAN_ERROR_ILLOPERATION, None, None
+        try:
+            msg = self.bus.recv(0)
+        except can.CanError as e:
+            self._last_error = e
+            return PCAN_ERROR_ILLOPERATION, None, None
+        if msg is None:
+            return PCAN_ERROR_QRCVEMPTY, None, None
+        return PCAN_ERROR_OK, msg, None
+
+    def frame_fields(self, msg):
+        return msg.arbitration_id, bytes(msg.data)
+
+    def _decode(self, msg):
+        """
+        Decode one received can.Message (see decode_payload).
+        """
+        if msg.is_error_frame:
+            self._on_error_frame(msg)
+            return None
+        if msg.is_extended_id or msg.is_remote_frame:
+            self._m_frames_other.value += 1
+            return None
+        now = msg.timestamp + self._clock_offset if msg.timestamp else self.clock()
+        return self._decode_checked(msg.arbitration_id, bytes(msg.data), now)
+
+    def _on_error_frame(self, msg):
+        """
+        Controller state changes reported by SocketCAN as error frames.
+        """
+        class_bits = msg.arbitration_id
+        if class_bits & CAN_ERR_BUSOFF:
+            kind = BUS_OFF
+        elif class_bits & CAN_ERR_CRTL and len(msg.data) > 1 and msg.data[1] & CAN_ERR_CRTL_OVERFLOW:
+            kind = OVERRUN
+        elif class_bits & CAN_ERR_CRTL and len(msg.data) > 1 and msg.data[1] & CAN_ERR_CRTL_WARNING:
+            kind = BUS_WARNING
+        else:
+            if class_bits & CAN_ERR_RESTARTED or (
+                    class_bits & CAN_ERR_CRTL and len(msg.data) > 1
+                    and msg.data[1] & CAN_ERR_CRTL_ACTIVE):
+                self._set_health("ok")
+            return
+        self.health.errors[kind] += 1
+        self._m_status[kind].value += 1
+        if kind == OVERRUN:
+            self.loss.overrun(msg.timestamp + self._clock_offset if msg.timestamp else self.clock())
+        elif kind == BUS_OFF:
+            self._set_health("bus_off")
+        elif kind == BUS_WARNING:
+            self._set_health("warning")
+
+    def _reopen(self):
+        """
+        Re-create the bus, e.g. after the interface went down or the adapter
+        was re-plugged. Returns True on success.
+        """
+        if self.bus is not None:
+            self.bus.shutdown()
+            self.bus = None
+        try:
+            self._open_bus()
+        except (can.CanError, OSError) as e:
+            self._last_error = e
+            return False
+        self.health.reopens += 1
+        self._m_reopens.value += 1
+        print(f"{self.channel_name} re-opened.")
+        return True
+
+    def _get_error_text(self, error_code):
+        return str(self._last_error) if self._last_error is not None else f"status 0x{error_code:X}"
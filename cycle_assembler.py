@@ -0,0 +1,225 @@
+# cycle_assembler.py
+import math
+from collections import namedtuple
+
+from bms_state import FRAME_SIGNALS
+
+# Frames making up one BMS measurement cycle
+CYCLE_IDS = (0x200, 0x201, 0x202, 0x203, 0x204, 0x205, 0x206)
+
+DEFAULT_TIMEOUT = 0.5  # seconds without a frame before its signals are stale
+
+# One complete cycle: `stamps` maps each CAN ID to its receive time,
+# `data` is whatever the assembler's snapshot callable returned.
+MeasurementCycle = namedtuple("MeasurementCycle", "pack seq start end stamps data")
+
+
+class TimerWheel:
+    """
+    Hashed timing wheel: schedule() and cancel() are O(1), advance() costs
+    O(ticks elapsed + timers expired). Rescheduling a key simply supersedes
+    its previous deadline; old entries are dropped when their slot is visited.
+    A key rescheduled within the same tick adds no entry, so the wheel holds
+    at most one entry per key and tick whatever the frame rate.
+    """
+
+    def __init__(self, tick=0.01, slots=256):
+        """
+        :param tick: wheel resolution in seconds
+        :param slots: number of slots (one revolution = tick * slots seconds)
+        """
+        self.tick = tick
+        self._slots = [[] for _ in range(slots)]
+        self._deadline = {}  # key -> deadline in ticks
+        self._current = None  # last tick processed by advance()
+
+    def __len__(self):
+        return len(self._deadline)
+
+    def __contains__(self, key):
+        return key in self._deadline
+
+    def schedule(self, key, deadline):
+        """(Re)arm the timer `key` to expire at time `deadline` (seconds)."""
+        t = math.ceil(deadline / self.tick)
+        if self._current is not None and t <= self._current:
+            t = self._current + 1
+        if self._deadline.get(key) == t:
+            return  # same tick: the entry already in the slot stands for it
+        self._deadline[key] = t
+        self._slots[t % len(self._slots)].append((t, key))
+
+    def cancel(self, key):
+        self._deadline.pop(key, None)
+
+    def advance(self, now):
+        """Move the wheel to time `now` and return the keys that expired."""
+        target = int(now / self.tick)
+        current = self._current
+        if current is None:
+            # first call: start from the earliest timer scheduled so far
+            current = min(self._deadline.values(), default=target) - 1
+        if target <= current:
+            return []
+
+        n = len(self._slots)
+        deadlines = self._deadline
+        expired = []
+        # After a long pause one full revolution visits every slot
+        for t in range(current + 1, min(target, current + n) + 1):
+            slot = self._slots[t % n]
+            if not slot:
+                continue
+            keep = []
+            for entry in slot:
+                due, key = entry
+                if deadlines.get(key) != due:
+                    continue  # cancelled or rescheduled since
+                if due <= target:
+                    expired.append(key)
+                    del deadlines[key]
+                else:
+                    keep.append(entry)
+            slot[:] = keep
+        self._current = target
+        return expired
+
+
+class CycleAssembler:
+    """
+    Groups the 0x200..0x206 frames of each pack into complete measurement
+    cycles and tracks signal staleness.
+
+      - feed() is called for every decoded frame. When every ID of the cycle
+        has been seen once, on_cycle(MeasurementCycle) is called exactly once
+        and a new cycle starts. An ID repeating before the cycle is complete,
+        or a cycle spanning more than `timeout`, restarts the cycle (counted
+        in `incomplete`).
+      - reject() is called instead for a cycle frame the decoder rejected:
+        it takes its place in the cycle, but that cycle is then dropped
+        (counted in `incomplete`) instead of completing.
+      - Every (pack, ID) has a deadline `timeout` seconds after its last frame,
+        kept in a TimerWheel. poll() expires them and calls
+        on_stale(pack, can_id, True); the next frame with that ID calls
+        on_stale(pack, can_id, False).
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, cycle_ids=CYCLE_IDS,
+                 on_cycle=None, on_stale=None, snapshot=None, tick=0.01,
+                 frame_signals=FRAME_SIGNALS):
+        """
+        :param timeout: staleness timeout in seconds
+        :param cycle_ids: CAN IDs that make up one cycle
+        :param on_cycle: callback MeasurementCycle -> None
+        :param on_stale: callback (pack, can_id, stale) -> None
+        :param snapshot: callable pack -> data stored in MeasurementCycle.data
+        :param tick: timer wheel resolution in seconds
+        :param frame_signals: CAN ID -> signal names, for stale_signals()
+                              (another frame layout for pack variants)
+        """
+        self.timeout = timeout
+        self.cycle_ids = tuple(cycle_ids)
+        self.on_cycle = on_cycle
+        self.on_stale = on_stale
+        self.snapshot = snapshot
+        self.frame_signals = frame_signals
+
+        self._bit = {can_id: 1 << i for i, can_id in enumerate(cycle_ids)}
+        self._full = (1 << len(cycle_ids)) - 1
+        slots = max(16, int(timeout / tick) * 2)
+        self._wheel = TimerWheel(tick=tick, slots=slots)
+
+        # pack -> [seen mask, start time, {can_id: stamp}, sequence number, rejected]
+        self._cycles = {}
+        self._stale = set()  # (pack, can_id) currently stale
+
+        self.completed = 0
+        self.incomplete = 0
+
+    def feed(self, can_id, now, pack=0):
+        """Account for a frame with `can_id` received at `now` (seconds)."""
+        bit = self._bit.get(can_id)
+        if bit is None:
+            return None
+
+        key = (pack, can_id)
+        self._wheel.schedule(key, now + self.timeout)
+        if key in self._stale:
+            self._stale.discard(key)
+            if self.on_stale:
+                self.on_stale(pack, can_id, False)
+
+        cycle = self._cycle(pack, bit, now)
+        cycle[0] |= bit
+        cycle[2][can_id] = now
+        if cycle[0] != self._full:
+            return None
+        if cycle[4]:
+            self._restart(cycle, now)
+            return None
+
+        data = self.snapshot(pack) if self.snapshot else None
+        record = MeasurementCycle(pack, cycle[3], cycle[1], now, cycle[2], data)
+        cycle[0] = 0
+        cycle[2] = {}
+        cycle[3] += 1
+        self.completed += 1
+        if self.on_cycle:
+            self.on_cycle(record)
+        return record
+
+    def reject(self, can_id, now, pack=0):
+        """
+        A frame with `can_id` arrived at `now` but could not be decoded: the
+        cycle it belongs to will not complete. Staleness is not refreshed,
+        since none of its signals were.
+        """
+        bit = self._bit.get(can_id)
+        if bit is None:
+            return
+        cycle = self._cycle(pack, bit, now)
+        cycle[0] |= bit
+        cycle[4] = True
+        if cycle[0] == self._full:
+            self._restart(cycle, now)
+
+    def _cycle(self, pack, bit, now):
+        """The cycle of `pack` a frame with `bit` belongs to, restarted if needed."""
+        cycle = self._cycles.get(pack)
+        if cycle is None:
+            cycle = self._cycles[pack] = [0, now, {}, 0, False]
+        elif cycle[0] & bit or (cycle[0] and now - cycle[1] > self.timeout):
+            # restart: the previous cycle lost a frame
+            self._restart(cycle, now)
+        if not cycle[0]:
+            cycle[1] = now
+        return cycle
+
+    def _restart(self, cycle, now):
+        self.incomplete += 1
+        cycle[0] = 0
+        cycle[1] = now
+        cycle[2] = {}
+        cycle[4] = False
+
+    def poll(self, now):
+        """Expire deadlines up to `now`; returns the newly stale (pack, can_id)."""
+        expired = self._wheel.advance(now)
+        for key in expired:
+            self._stale.add(key)
+            if self.on_stale:
+                self.on_stale(key[0], key[1], True)
+        return expired
+
+    def is_stale(self, can_id, pack=0):
+        return (pack, can_id) in self._stale
+
+    def stale_ids(self, pack=0):
+        return sorted(can_id for p, can_id in self._stale if p == pack)
+
+    def stale_signals(self, pack=0):
+        """Names of the signals carried by currently stale frames."""
+        names = []
+        for can_id in self.stale_ids(pack):
+            names.extend(self.frame_signals.get(can_id, ()))
+        return names
@@ -3,7 +3,61 @@ import threading
 import time
 import select
 import sys
+import struct
+from functools import lru_cache
 from PCANBasic import *
+from bms_state import (
+    ALARM_BITS, BMSState, FRAME_SIGNALS, FD_DLC_LEN, FD_MEASUREMENT_ID, MAX_CELLS, MAX_NTC,
+    PACK_SUM, VMIN, VMAX, VBATT,
+)
+from derived_metrics import DerivedMetrics
+from soc import SOCEstimator
+from anomaly_detector import KINDS as ANOMALY_KINDS
+from frame_loss import FrameLossTracker
+from alarm_rules import RuleEngine, RuleSet
+from ntc_calibration import default_table
+from cycle_assembler import CycleAssembler, CYCLE_IDS, DEFAULT_TIMEOUT
+from metrics import REGISTRY
+from profiling import StageProfiler
+from tx_scheduler import TxScheduler
+from bus_health import (
+    BusHealth, Backoff, classify, ERROR_CLASSES, HEALTH_CODES,
+    OVERRUN, BUS_WARNING, BUS_OFF, DISCONNECTED,
+)
+
+# Big-endian 16-bit fields used by the BMS frames
+_U16X4 = struct.Struct(">4H")
+_U16X3 = struct.Struct(">3H")
+
+# CAN FD: 500 kbit/s nominal, 2 Mbit/s data phase, 80 MHz clock
+PCAN_BR_FD_500K_2M = b"f_clock_mhz=80,nom_brp=10,nom_tseg1=12,nom_tseg2=3,nom_sjw=1,data_brp=4,data_tseg1=7,data_tseg2=2,data_sjw=1"
+
+# Frames of one measurement cycle sent by the CAN FD firmware
+FD_CYCLE_IDS = (FD_MEASUREMENT_ID, 0x205, 0x206)
+
+# Message types that never carry a BMS frame: the BMS only sends standard
+# 11-bit data frames, so an extended 0x200 is somebody else's frame
+_NOT_BMS_DATA = (
+    PCAN_MESSAGE_RTR.value | PCAN_MESSAGE_EXTENDED.value
+    | PCAN_MESSAGE_ERRFRAME.value | PCAN_MESSAGE_STATUS.value
+)
+
+# Static frames (serial number, versions): repeats are not decoded again
+DEDUP_IDS = (0x300, 0x301)
+
+
+@lru_cache(maxsize=None)
+def _u16_block(count):
+    """Precompiled struct for `count` big-endian u16 fields."""
+    return struct.Struct(f">{count}H")
+
+
+def frame_payload(msg):
+    """Payload bytes of a TPCANMsg (LEN) or TPCANMsgFD (DLC)."""
+    if isinstance(msg, TPCANMsgFD):
+        return bytes(msg.DATA[:FD_DLC_LEN[msg.DLC]])
+    return bytes(msg.DATA[:msg.LEN])
+
 
 class BMSPcanListener:
     """
@@ -11,7 +65,7 @@ class BMSPcanListener:
       - Opens a PCAN-USB channel on macOS using PCANBasic.
       - Spawns a background thread that continuously reads frames.
       - Parses each relevant BMS frame (0x200..0x301).
-      - Updates an internal dictionary bms_data.
+      - Updates a compact BMSState (bms_data is a dict-shaped view over it).
       - Calls on_update(bms_data) for the GUI to refresh.
     """
 
@@ -19,69 +73,357 @@ class BMSPcanListener:
         self,
         channel=PCAN_USBBUS1,
         baudrate=PCAN_BAUD_500K,
-        on_update=None
+        on_update=None,
+        rules=None,
+        on_rule_event=None,
+        ntc_table=None,
+        on_cycle=None,
+        stale_timeout=DEFAULT_TIMEOUT,
+        registry=REGISTRY,
+        publisher=None,
+        fd_bitrate=None,
+        tx_periodic=(),
+        request_identity=False,
+        dedup_ids=DEDUP_IDS,
+        dedup_keepalive=1.0,
+        archive=None,
+        history=None,
+        database=None,
+        dispatcher=None,
+        capture=None,
+        variants=None,
+        soc_table=None,
+        cell_ntc=None,
+        anomalies=None,
+        anomaly_pack=0,
+        on_anomaly_event=None,
+        frame_periods=None
     ):
         """
         :param channel: which PCAN USB channel to open, e.g. PCAN_USBBUS1
         :param baudrate: e.g. PCAN_BAUD_500K
         :param on_update: callback function bms_data -> None 
                           (called whenever a new BMS frame is parsed)
+        :param rules: optional host-side alarm rules (list of alarm_rules.Rule
+                      or a compiled RuleSet), evaluated after each frame
+        :param on_rule_event: callback RuleEvent -> None, called when a rule
+                              trips or clears
+        :param ntc_table: ntc_calibration.NTCTable converting raw NTC counts
+                          to °C (defaults to a 10k/B3435 NTC on a 12-bit ADC)
+        :param on_cycle: callback MeasurementCycle -> None, called once per
+                         complete 0x200..0x206 cycle (data = bms_data as a dict)
+        :param stale_timeout: seconds after which a frame's signals are stale
+        :param registry: metrics.Registry receiving the listener health metrics
+        :param publisher: optional snapshot_stream.SnapshotPublisher; the
+                          signals changed by each frame are published to it
+        :param fd_bitrate: CAN FD bit rate string (e.g. PCAN_BR_FD_500K_2M) to
+                           open the channel in FD mode and decode the 64-byte
+                           FD_MEASUREMENT_ID frame; None for classic CAN
+        :param tx_periodic: frames to transmit periodically once started, as
+                            (can_id, data, period_seconds) tuples (heartbeats)
+        :param request_identity: send remote requests for 0x300 / 0x301 on
+                                 start, for firmware that only answers requests
+        :param dedup_ids: CAN IDs whose frames are skipped (no decode, no
+                          on_update) when the payload repeats the last one
+        :param dedup_keepalive: seconds after which a repeated payload is
+                                decoded anyway, so downstream sees it refreshed
+        :param archive: optional archive.ArchiveWriter; the signals changed by
+                        each frame are appended to it with a wall-clock stamp
+        :param history: optional history_index.HistoryIndex, fed the same way
+        :param database: optional sqlite_sink.SQLiteSink, fed the same way
+        :param dispatcher: optional dispatcher.Dispatcher fanning every
+                           decoded frame out to in-process subscribers
+                           (started and stopped with the listener)
+        :param capture: optional trigger_capture.TriggerCapture; every frame
+                        goes into its ring, and the raw frames around a
+                        rising 0x206 alarm bit or a tripping host rule are
+                        saved to disk
+        :param variants: pack variant definitions (pack_variants.VariantSet,
+                         or the path of a definition file): frames are decoded
+                         by the generated decoders of the variant matching the
+                         0x301 versions, the fallback variant until then
+        :param soc_table: soc.SOCTable (OCV curves) to estimate the per-cell
+                          and pack state of charge, published as
+                          bms_data["soc"]; None to skip the estimation
+        :param cell_ntc: NTC index per cell for the SOC temperature
+                         compensation (default: mean of the NTCs)
+        :param anomalies: optional anomaly_detector.AnomalyDetector, fed the
+                          cell voltages once per complete measurement cycle
+                          (may be shared by the listeners of several packs)
+        :param anomaly_pack: this listener's pack index in the detector
+        :param on_anomaly_event: callback AnomalyEvent -> None, called for the
+                                 edges of the detector steps this listener runs
+        :param frame_periods: {can_id: period in seconds} of the measurement
+                              frames, for the frame loss accounting; periods
+                              not given are learned from the traffic
         """
 
         self.channel = channel
+        self.channel_name = f"PCAN channel {channel.value}"  # for status messages
         self.baudrate = baudrate
+        self.fd_bitrate = fd_bitrate
         self.on_update = on_update
+        self.registry = registry
+        self.tx_periodic = list(tx_periodic)
+        self.request_identity_on_start = request_identity
+        self.tx = None  # TxScheduler, created once there is something to send
+        self.ntc_table = ntc_table if ntc_table is not None else default_table()
+
+        # Decoded BMS values (see bms_state.py). bms_data is kept as a
+        # read-only view with the historical dict shape for on_update().
+        self.state = BMSState()
+        self.bms_data = self.state.view()
 
-        # BMS data dictionary – fields from your readme
-        self.bms_data = {
-            "voltages": [None]*13,        # Cell voltages V1..V13
-            "ntc": [None]*3,             # Temperatures from NTC1..NTC3
-            "pack_sum": None,            # Vpack (sum of all cells)
-            "vmin": None,
-            "vmax": None,
-            "vbatt": None,
-            "alarms": {
-                "vmin": False,
-                "vmax": False,
-                "tmin": False,
-                "tmax": False,
-                "vbatt": False,
-                "sn_error": False
-            },
-            "serial_number": None,       # from 0x300
-            "hw_version": None,          # from 0x301
-            "sw_version": None           # from 0x301
+        # Frame layout: the built-in parsers, or a pack variant's generated
+        # decoders (see pack_variants.py and _apply_variant)
+        if isinstance(variants, str):
+            from pack_variants import load_variants
+            variants = load_variants(variants)
+        self.variants = variants
+        self.variant = None
+        self.frame_signals = FRAME_SIGNALS
+        self._decoders = {}  # can_id -> generated decoder
+
+        # Cell spread, pack_sum consistency and rolling per-cell stats,
+        # published as bms_data["derived"]
+        self.derived = DerivedMetrics(self.state)
+        self.state.derived = self.derived
+
+        # Per-cell / pack state of charge from OCV curves (see soc.py)
+        self.soc_table = soc_table
+        self.cell_ntc = cell_ntc
+        self.soc = None
+        if soc_table is not None:
+            self.soc = SOCEstimator(self.state, soc_table, cell_ntc)
+            self.state.soc = self.soc
+
+        # Host-side threshold rules (see alarm_rules.py)
+        self.rule_engine = None
+        if rules is not None:
+            self.rule_engine = RuleEngine(rules, self.state, on_event=on_rule_event)
+
+        # Per-cell drift / jump detection, once per cycle (see anomaly_detector.py)
+        self.anomalies = anomalies
+        self.anomaly_pack = anomaly_pack
+        self.on_anomaly_event = on_anomaly_event
+
+        # Complete measurement cycles and per-ID staleness (see cycle_assembler.py)
+        self.on_cycle = on_cycle
+        self.assembler = CycleAssembler(
+            timeout=stale_timeout,
+            cycle_ids=FD_CYCLE_IDS if fd_bitrate else CYCLE_IDS,
+            on_cycle=self._on_cycle if on_cycle or anomalies is not None else None,
+            on_stale=self._on_stale,
+            snapshot=(lambda pack: self.state.as_dict()) if on_cycle else None,
+            frame_signals=self.frame_signals
+        )
+
+        # Missing frames inferred from the cycle timing and driver overruns,
+        # published as bms_data["loss"] (see frame_loss.py)
+        self.loss = FrameLossTracker(self.assembler.cycle_ids, frame_periods,
+                                     on_loss=self._on_frame_loss)
+        self.state.loss = self.loss
+
+        # Out-of-process subscribers (see snapshot_stream.py)
+        self.publisher = publisher
+        self._frame_getters = {}  # can_id -> ((signal, getter), ...)
+        if publisher is not None and publisher.snapshot is None:
+            publisher.snapshot = self.state.snapshot
+
+        # Repeated static frames (see _is_duplicate)
+        self.dedup_keepalive = dedup_keepalive
+        self._dedup = {can_id: [None, 0.0] for can_id in dedup_ids}  # -> [payload, decoded at]
+        dedup_frames = registry.counter(
+            "bms_dedup_frames_total", "Frames of deduplicated IDs, by CAN ID and result",
+            ("id", "result"))
+        self._m_dedup = {
+            can_id: (dedup_frames.labels(f"0x{can_id:03X}", "hit"),
+                     dedup_frames.labels(f"0x{can_id:03X}", "miss"))
+            for can_id in dedup_ids
         }
 
+        # Columnar recording (see archive.py)
+        self.archive = archive
+        # Min/max/mean pyramid for time-range queries (see history_index.py)
+        self.history = history
+        # SQL-queryable copy, written by its own thread (see sqlite_sink.py)
+        self.database = database
+        self._recorders = tuple(r for r in (archive, history, database) if r is not None)
+        # Any number of in-process consumers, off the reader thread (see dispatcher.py)
+        self.dispatcher = dispatcher
+        self._owns_dispatcher = False
+        # Raw frames around alarms (see trigger_capture.py)
+        self.capture = capture
+        self._capture_alarms = 0  # alarm bits already seen active
+
+        # Health metrics (served by metrics.MetricsServer)
+        self._m_frames = registry.counter(
+            "bms_frames_total", "CAN frames read from the bus, by CAN ID", ("id",))
+        self._frame_counters = {}  # can_id -> counter child, filled on first frame
+        self._m_frames_other = self._m_frames.labels("other")  # bounded label set
+        self._m_decode_errors = registry.counter(
+            "bms_decode_errors_total", "Frames rejected as malformed or whose decoding raised an exception")
+        self._decode_error_ids = set()
+        read_status = registry.counter(
+            "bms_read_status_total", "PCANBasic.Read results other than OK", ("status",))
+        self._m_qrcvempty = read_status.labels("qrcvempty")
+        self._m_status = {kind: read_status.labels(kind) for kind in ERROR_CLASSES}
+        self._m_bus_state = registry.gauge(
+            "bms_bus_state", "Channel health: 0=ok 1=warning 2=bus_off 3=disconnected")
+        recoveries = registry.counter(
+            "bms_bus_recoveries_total", "Bus-off resets and channel re-opens", ("action",))
+        self._m_resets = recoveries.labels("reset")
+        self._m_reopens = recoveries.labels("reopen")
+        self._m_decode = registry.histogram(
+            "bms_decode_seconds", "Time spent decoding one frame (parse + derived + rules)")
+        self._m_callback = registry.histogram(
+            "bms_callback_seconds", "Time spent in the on_update callback")
+        self._m_missing = registry.counter(
+            "bms_frames_missing_total", "Frames inferred missing from the cycle timing, by CAN ID and cause",
+            ("id", "cause"))
+        self._m_outages = registry.counter(
+            "bms_frame_outages_total", "Silences longer than the loss tracker's max_gap")
+        anomaly_events = registry.counter(
+            "bms_anomaly_events_total", "Cells turning anomalous, by kind", ("kind",))
+        self._m_anomaly_events = {kind: anomaly_events.labels(kind) for kind in ANOMALY_KINDS}
+        self._m_anomalies = registry.gauge(
+            "bms_anomalies_active", "Cells currently flagged by the anomaly detector")
+        self._m_resizes = registry.counter(
+            "bms_state_resizes_total", "State rebuilds for a new cell / NTC count (FD firmware)")
+        self._layouts_seen = set()  # (cells, NTCs) already reported
+
+        # Stage profiling hooks, installed by enable_profiling() only
+        self.profiler = None
+        self._read = None
+
+        # Bus health and error back-off (see bus_health.py)
+        self.health = BusHealth()
+        self._backoff = Backoff()
+
+        # Frame timestamps; soak.py swaps in a simulated clock
+        self.clock = time.monotonic
+
         self._stop = threading.Event()
         self._thread = None
 
-        # Create a PCANBasic instance
-        self.pcan = PCANBasic()
+        # PCANBasic instance, created by open() so that a listener can also
+        # decode recorded frames (decode_payload) without the driver installed
+        self.pcan = None
         self.fd = None  # will store the file descriptor for select()
 
-    def start(self):
+        if variants is not None and variants.default is not None:
+            self._apply_variant(variants.default)
+
+    def open(self):
         """
-        Initialize the PCAN channel and start background reading thread.
+        Initialize the PCAN channel without starting the reader thread
+        (used by start() and by async_listener.AsyncBMSListener).
         """
-        # Initialize the channel at the given baudrate
-        result = self.pcan.Initialize(self.channel, self.baudrate)
+        if self.pcan is None:
+            self.pcan = PCANBasic()
+        result = self._initialize()
         if result != PCAN_ERROR_OK:
             err_text = self._get_error_text(result)
             raise RuntimeError(f"Error initializing PCAN channel: {err_text}")
 
+    def _initialize(self):
+        """
+        Initialize the channel and fetch its receive event; returns the status.
+        """
+        # Initialize the channel at the given baudrate (or FD bit rate)
+        if self.fd_bitrate:
+            result = self.pcan.InitializeFD(self.channel, self.fd_bitrate)
+        else:
+            result = self.pcan.Initialize(self.channel, self.baudrate)
+        if result != PCAN_ERROR_OK:
+            return result
+
+        # Let the driver restart the controller after a bus-off on its own
+        self.pcan.SetValue(self.channel, PCAN_BUSOFF_AUTORESET, PCAN_PARAMETER_ON)
+
+        # Reception may have been left disabled by another application
+        res = self.pcan.GetValue(self.channel, PCAN_RECEIVE_STATUS)
+        if res[0] == PCAN_ERROR_OK and res[1] == PCAN_PARAMETER_OFF:
+            print(f"{self.channel_name}: reception was disabled, enabling it.")
+            self.pcan.SetValue(self.channel, PCAN_RECEIVE_STATUS, PCAN_PARAMETER_ON)
+
         # Retrieve a file descriptor for 'select' calls
         res = self.pcan.GetValue(self.channel, PCAN_RECEIVE_EVENT)
         if res[0] == PCAN_ERROR_OK:
             self.fd = res[1]
         else:
             self.fd = None
+        return result
+
+    def close(self):
+        """
+        Uninitialize the channel.
+        """
+        result = self.pcan.Uninitialize(self.channel)
+        if result != PCAN_ERROR_OK:
+            err_text = self._get_error_text(result)
+            print(f"Error uninitializing PCAN channel: {err_text}")
+        else:
+            print("PCAN channel uninitialized cleanly.")
+
+    def start(self):
+        """
+        Initialize the PCAN channel and start background reading thread.
+        """
+        self.open()
 
-        print(f"BMSPcanListener started on channel {self.channel.value} at {self.baudrate.value}.")
+        if self.fd_bitrate:
+            print(f"BMSPcanListener started on channel {self.channel.value} in CAN FD mode.")
+        else:
+            print(f"BMSPcanListener started on channel {self.channel.value} at {self.baudrate.value}.")
 
+        self._start_dispatcher()
         self._stop.clear()
         self._thread = threading.Thread(target=self._run, daemon=True)
         self._thread.start()
+        self._start_tx()
+
+    def _start_dispatcher(self):
+        """
+        Start the dispatcher's fan-out thread, unless it already runs (then
+        whoever started it also stops it).
+        """
+        self._owns_dispatcher = self.dispatcher is not None and not self.dispatcher.running
+        if self._owns_dispatcher:
+            self.dispatcher.start()
+
+    def _stop_dispatcher(self):
+        """Deliver what is queued and stop the dispatcher, if start() started it."""
+        if self._owns_dispatcher:
+            self._owns_dispatcher = False
+            self.dispatcher.stop()
+
+    def _start_tx(self):
+        """
+        Start the transmit side if there is something to send: heartbeats
+        and identity requests. A listen-only session gets no transmit thread.
+        """
+        for can_id, data, period in self.tx_periodic:
+            self._transmitter().add_periodic(can_id, data, period)
+        if self.request_identity_on_start:
+            self.request_identity()
+
+    def _transmitter(self):
+        """The TxScheduler, created and started on first use."""
+        if self.tx is None:
+            self.tx = TxScheduler(self.pcan, self.channel, fd=bool(self.fd_bitrate),
+                                  registry=self.registry)
+            self.tx.start()
+        return self.tx
+
+    def request_identity(self):
+        """
+        Ask the BMS for its serial number (0x300) and HW/SW version (0x301)
+        with remote frames. Requires a started listener.
+        """
+        tx = self._transmitter()
+        tx.send(0x300, rtr=True, dlc=8)
+        tx.send(0x301, rtr=True, dlc=8)
 
     def stop(self):
         """
@@ -90,13 +432,12 @@ class BMSPcanListener:
         self._stop.set()
         if self._thread:
             self._thread.join()
+        if self.tx:
+            self.tx.stop()
+            self.tx = None
+        self._stop_dispatcher()
 
-        result = self.pcan.Uninitialize(self.channel)
-        if result != PCAN_ERROR_OK:
-            err_text = self._get_error_text(result)
-            print(f"Error uninitializing PCAN channel: {err_text}")
-        else:
-            print("PCAN channel uninitialized cleanly.")
+        self.close()
 
     def _run(self):
         """
@@ -104,164 +445,646 @@ class BMSPcanListener:
         Whenever a valid frame arrives, parse it. 
         If we successfully parse 0x200..0x301, call on_update(bms_data).
         """
+        default_read = self.read_function()
         while not self._stop.is_set():
+            # Expire staleness deadlines (cheap unless a wheel tick elapsed)
+            self.poll(time.monotonic())
+
             # Attempt to read a CAN frame
-            result, can_msg, _ = self.pcan.Read(self.channel)
+            result, can_msg, _ = (self._read or default_read)(self.channel)
             if result == PCAN_ERROR_OK:
                 # We got a message -> parse it
                 # print(can_msg)
                 self._handle_message(can_msg)
+                if self.health.state != "ok":
+                    self._backoff.reset()
+                    self._set_health("ok")
             elif result == PCAN_ERROR_QRCVEMPTY:
+                self._m_qrcvempty.value += 1
                 # No frame -> block briefly
                 # if self.fd and self.fd != -1:
                 #     select.select([self.fd], [], [], 0.1)
                 time.sleep(0.001)  # Add a small delay to avoid busy waiting
                 pass
             else:
-                # Possibly a bus error or something else
-                # You can debug print it if needed
-                print("Error")
+                self._handle_error(result)
+
+    def read_function(self):
+        """PCANBasic.Read, or ReadFD when the channel was opened in FD mode."""
+        return self.pcan.ReadFD if self.fd_bitrate else self.pcan.Read
+
+    def _handle_error(self, result):
+        """
+        Classify a failed Read and react to it. Every branch except an
+        overrun waits with exponential back-off, so a dead bus or an unplugged
+        dongle does not spin the reader thread.
+        """
+        kind = self._note_error(result)
+        if kind == OVERRUN:
+            return
+        self._stop.wait(self._backoff.next())
+        self._recover(kind)
+
+    def _note_error(self, result):
+        """
+        First half of _handle_error, without waiting: count and classify a
+        failed Read and update the health. Returns the error class.
+        """
+        kind = classify(result)
+        self.health.errors[kind] += 1
+        self.health.last_status = result
+        self._m_status[kind].value += 1
+
+        if kind == OVERRUN:
+            # We read too late, but frames are still queued: keep reading.
+            # How many were lost is inferred from the gaps (see frame_loss.py)
+            self.loss.overrun(self.clock())
+        elif kind == BUS_WARNING:
+            self._set_health("warning", result)
+        elif kind == BUS_OFF:
+            self._set_health("bus_off", result)
+        elif kind == DISCONNECTED:
+            self._set_health("disconnected", result)
+        return kind
+
+    def _recover(self, kind):
+        """
+        Second half of _handle_error, once the back-off has passed: reset
+        after a bus-off, re-open after a disconnect. Returns True if the
+        channel was re-opened (its receive fd may have changed).
+        """
+        if kind == BUS_OFF:
+            return self._recover_bus_off()
+        if kind == DISCONNECTED:
+            return self._reopen()
+        return False
+
+    def _recover_bus_off(self):
+        """
+        Reset the queues; if the controller is still bus-off, re-initialize.
+        Returns True if the channel was re-opened.
+        """
+        self.pcan.Reset(self.channel)
+        self.health.resets += 1
+        self._m_resets.value += 1
+        if self.pcan.GetStatus(self.channel) & PCAN_ERROR_BUSOFF:
+            return self._reopen()
+        return False
+
+    def _reopen(self):
+        """
+        Re-initialize the channel, e.g. after the dongle was re-plugged.
+        Returns True on success.
+        """
+        self.pcan.Uninitialize(self.channel)
+        res = self.pcan.GetValue(self.channel, PCAN_CHANNEL_CONDITION)
+        if res[0] == PCAN_ERROR_OK and not res[1] & PCAN_CHANNEL_AVAILABLE:
+            return False  # hardware still not there
+        if self._initialize() != PCAN_ERROR_OK:
+            return False
+        self.health.reopens += 1
+        self._m_reopens.value += 1
+        print(f"{self.channel_name} re-opened.")
+        return True
+
+    def _set_health(self, state, status=None):
+        """
+        Record a health change; reported once per transition, not per error.
+        """
+        if not self.health.set_state(state):
+            return
+        self._m_bus_state.set(HEALTH_CODES[state])
+        if status is None:
+            print(f"{self.channel_name}: bus {state}.")
+        else:
+            print(f"{self.channel_name}: bus {state} ({self._get_error_text(status)}).")
+        if self.on_update:
+            self.on_update(self.bms_data)
 
     def _handle_message(self, msg):
         """
-        Parse an incoming TPCANMsg and update bms_data.
+        Parse an incoming TPCANMsg and update the BMS state.
         Then call self.on_update(bms_data).
         """
-        can_id = msg.ID
-        data = bytes(msg.DATA[:msg.LEN])  # convert from c_ubyte array to a Python bytes object
+        t_start = time.perf_counter()
+        can_id = self._decode(msg)
+        if can_id is None:
+            return
+        t_decoded = time.perf_counter()
+        self._m_decode.observe(t_decoded - t_start)
+
+        # If we parsed a BMS frame, call the callback
+        if self.on_update:
+            self.on_update(self.bms_data)
+            self._m_callback.observe(time.perf_counter() - t_decoded)
+
+    def _decode(self, msg):
+        """
+        Decode one received TPCANMsg / TPCANMsgFD (see decode_payload).
+        """
+        if msg.MSGTYPE & _NOT_BMS_DATA:
+            self._m_frames_other.value += 1
+            return None
+        # convert from c_ubyte array to a Python bytes object
         # for easy indexing in parse methods
-        print(can_id, data)
+        return self._decode_checked(msg.ID, frame_payload(msg), self.clock())
+
+    def _decode_checked(self, can_id, data, now):
+        """
+        decode_payload() for the reader thread: exceptions are counted and
+        reported once per ID instead of propagating.
+        """
+        try:
+            return self.decode_payload(can_id, data, now)
+        except Exception as e:
+            # a decoder bug on one malformed frame must not kill the reader
+            self._m_decode_errors.inc()
+            if can_id not in self._decode_error_ids:  # report once per ID
+                self._decode_error_ids.add(can_id)
+                print(f"Error decoding frame 0x{can_id:03X}: {e!r}")
+            return None
+
+    def frame_fields(self, msg):
+        """(CAN ID, payload bytes) of a message returned by read_function()."""
+        return msg.ID, frame_payload(msg)
+
+    def decode_payload(self, can_id, data, now):
+        """
+        Decode one frame into the state and run the per-frame pipeline
+        (derived metrics, rules, cycle assembly, publishing, archiving).
+        `now` is the frame time in seconds (time.monotonic() when live, the
+        recorded time when replaying).
+        Returns the CAN ID, or None if the frame is not a BMS frame, was
+        rejected by its parser (too short, counts out of range) or is a
+        skipped repeat.
+        """
+
+        counter = self._frame_counters.get(can_id)
+        if counter is None:
+            if can_id not in self.frame_signals:
+                counter = self._m_frames_other
+            else:
+                counter = self._frame_counters[can_id] = self._m_frames.labels(f"0x{can_id:03X}")
+        counter.value += 1
+        self.loss.frame(can_id, now)
+        if self.capture is not None:
+            self.capture.record(can_id, data, now)
+
+        if can_id in self._dedup and self._is_duplicate(can_id, data, now):
+            self.assembler.feed(can_id, now)  # still counts as seen
+            return None
 
         # Debug print all incoming frames:
         # print(f"RX frame ID=0x{can_id:X}, len={msg.LEN}, data={list(data)}")
 
         # dispatch parse logic
-        if can_id == 0x200:
-            self._parse_0x200(data)
+        decoder = self._decoders.get(can_id)
+        if decoder is not None:
+            decoded = decoder(data, self.state, self.ntc_table)
+        elif can_id == 0x200:
+            decoded = self._parse_0x200(data)
         elif can_id == 0x201:
-            self._parse_0x201(data)
+            decoded = self._parse_0x201(data)
         elif can_id == 0x202:
-            self._parse_0x202(data)
+            decoded = self._parse_0x202(data)
         elif can_id == 0x203:
-            self._parse_0x203(data)
+            decoded = self._parse_0x203(data)
         elif can_id == 0x204:
-            self._parse_0x204(data)
+            decoded = self._parse_0x204(data)
         elif can_id == 0x205:
-            self._parse_0x205(data)
+            decoded = self._parse_0x205(data)
         elif can_id == 0x206:
-            self._parse_0x206(data)
+            decoded = self._parse_0x206(data)
+        elif can_id == FD_MEASUREMENT_ID:
+            decoded = self._parse_fd_measurement(data)
         elif can_id == 0x300:
-            self._parse_0x300(data)
+            decoded = self._parse_0x300(data)
         elif can_id == 0x301:
-            self._parse_0x301(data)
+            decoded = self._parse_0x301(data)
         else:
             # ignore other IDs or handle them
+            return None
+        if not decoded:
+            # short / malformed frame: nothing was stored, so nothing downstream
+            # runs, and its measurement cycle is not reported as complete
+            self._m_decode_errors.inc()
+            self.assembler.reject(can_id, now)
+            return None
+        entry = self._dedup.get(can_id)
+        if entry is not None:  # only a payload that decoded may be skipped when repeated
+            entry[0] = data
+            entry[1] = now
+
+        self.derived.update(can_id)
+        if self.soc is not None:
+            self.soc.update(can_id)
+        if self.rule_engine is not None:
+            events = self.rule_engine.evaluate(can_id, now)
+            if events and self.capture is not None:
+                for event in events:
+                    if event.active:
+                        self.capture.trigger(f"rule {event.rule}", now)
+        if self.capture is not None and self.state.alarm_bits != self._capture_alarms:
+            self._trigger_alarms(now)
+        self.assembler.feed(can_id, now)
+        if self.publisher is not None or self._recorders or self.dispatcher is not None:
+            changes = self.frame_changes(can_id)
+            if self.publisher is not None:
+                self.publisher.publish(changes)
+            if self._recorders or self.dispatcher is not None:
+                wall = time.time()
+                for recorder in self._recorders:
+                    recorder.append(wall, changes)
+                if self.dispatcher is not None:
+                    self.dispatcher.dispatch(wall, can_id, data, changes)
+        return can_id
+
+    def _trigger_alarms(self, now):
+        """Trigger a capture for the 0x206 alarm bits that just went active."""
+        bits = self.state.alarm_bits
+        rising = bits & ~self._capture_alarms
+        self._capture_alarms = bits
+        if rising:
+            names = [name for name, mask in ALARM_BITS if rising & mask]
+            self.capture.trigger(f"alarm {' '.join(names)}", now)
+
+    def poll(self, now):
+        """
+        Expire what is timed rather than frame-driven: staleness deadlines
+        and the post-trigger window of an open capture.
+        """
+        self.assembler.poll(now)
+        if self.capture is not None:
+            self.capture.poll(now)
+
+    def _is_duplicate(self, can_id, data, now):
+        """
+        True if `data` repeats the last payload of `can_id` that decoded, and
+        that was less than dedup_keepalive seconds ago. decode_payload()
+        records the payload once its parser accepted it, so a repeated
+        malformed frame is parsed (and counted as a decode error) every time.
+        """
+        entry = self._dedup[can_id]
+        hit, miss = self._m_dedup[can_id]
+        if data == entry[0] and now - entry[1] < self.dedup_keepalive:
+            hit.value += 1
+            return True
+        miss.value += 1
+        return False
+
+    def dedup_stats(self):
+        """Per deduplicated ID: {"0x300": {"hits", "misses", "hit_rate"}, ...}"""
+        stats = {}
+        for can_id, (hit, miss) in self._m_dedup.items():
+            total = hit.value + miss.value
+            stats[f"0x{can_id:03X}"] = {
+                "hits": hit.value,
+                "misses": miss.value,
+                "hit_rate": hit.value / total if total else 0.0,
+            }
+        return stats
+
+    ###################################
+    #  PROFILING HOOKS
+    ###################################
+
+    def enable_profiling(self, profiler=None):
+        """
+        Start recording per-stage latencies (read, decode, dispatch) into a
+        profiling.StageProfiler. The profiled variants replace the normal
+        methods on this instance only, so nothing is measured - and nothing
+        is paid - while profiling is off.
+        """
+        self.profiler = profiler if profiler is not None else StageProfiler()
+        self._read = self._read_profiled
+        self._handle_message = self._handle_message_profiled
+        return self.profiler
+
+    def disable_profiling(self):
+        """Remove the hooks; returns the profiler with what was recorded."""
+        profiler = self.profiler
+        self.profiler = None
+        self._read = None
+        self.__dict__.pop("_handle_message", None)
+        return profiler
+
+    def _read_profiled(self, channel):
+        t_start = time.perf_counter_ns()
+        res = self.read_function()(channel)
+        if res[0] == PCAN_ERROR_OK:  # empty polls are not interesting
+            self.profiler.record("read", time.perf_counter_ns() - t_start)
+        return res
+
+    def _handle_message_profiled(self, msg):
+        profiler = self.profiler
+        t_start = time.perf_counter_ns()
+        can_id = self._decode(msg)
+        t_decoded = time.perf_counter_ns()
+        profiler.record("decode", t_decoded - t_start, can_id)
+        if can_id is None:
             return
+        self._m_decode.observe((t_decoded - t_start) / 1e9)
 
-        # If we parsed a BMS frame, call the callback
         if self.on_update:
             self.on_update(self.bms_data)
+            elapsed = time.perf_counter_ns() - t_decoded
+            profiler.record("dispatch", elapsed, can_id)
+            self._m_callback.observe(elapsed / 1e9)
 
     ###################################
     #  PARSE FUNCTIONS (like bms_can.py)
+    #  Each returns True once the frame is stored, False if it was rejected
+    #  (too short, or not matching the pack) and left the state untouched.
     ###################################
 
     def _parse_0x200(self, data):
         # data[0..1] => V4, data[2..3] => V3, data[4..5] => V2, data[6..7] => V1
-        if len(data) < 8:
-            return
-        v4_raw = (data[0] << 8) | data[1]
-        v3_raw = (data[2] << 8) | data[3]
-        v2_raw = (data[4] << 8) | data[5]
-        v1_raw = (data[6] << 8) | data[7]
-        self.bms_data["voltages"][3] = v4_raw * 0.001
-        self.bms_data["voltages"][2] = v3_raw * 0.001
-        self.bms_data["voltages"][1] = v2_raw * 0.001
-        self.bms_data["voltages"][0] = v1_raw * 0.001
+        return self._store_cells(0, data)
 
     def _parse_0x201(self, data):
-        if len(data) < 8:
-            return
-        v8_raw = (data[0] << 8) | data[1]
-        v7_raw = (data[2] << 8) | data[3]
-        v6_raw = (data[4] << 8) | data[5]
-        v5_raw = (data[6] << 8) | data[7]
-        self.bms_data["voltages"][7] = v8_raw * 0.001
-        self.bms_data["voltages"][6] = v7_raw * 0.001
-        self.bms_data["voltages"][5] = v6_raw * 0.001
-        self.bms_data["voltages"][4] = v5_raw * 0.001
+        # V8, V7, V6, V5
+        return self._store_cells(4, data)
 
     def _parse_0x202(self, data):
-        if len(data) < 8:
-            return
-        v12_raw = (data[0] << 8) | data[1]
-        v11_raw = (data[2] << 8) | data[3]
-        v10_raw = (data[4] << 8) | data[5]
-        v9_raw  = (data[6] << 8) | data[7]
-        self.bms_data["voltages"][11] = v12_raw * 0.001
-        self.bms_data["voltages"][10] = v11_raw * 0.001
-        self.bms_data["voltages"][9]  = v10_raw * 0.001
-        self.bms_data["voltages"][8]  = v9_raw * 0.001
+        # V12, V11, V10, V9
+        return self._store_cells(8, data)
 
     def _parse_0x203(self, data):
+        # data[3..4] => V13
+        if len(data) < 5 or self.state.num_cells < 13:
+            return False
         v13_raw = (data[3] << 8) | data[4]
-        self.bms_data["voltages"][12] = v13_raw * 0.001
+        self.state.voltages[12] = v13_raw * 0.001
+        self.state.cell_valid |= 1 << 12
+        return True
 
     def _parse_0x204(self, data):
         # NTC3 => data[2..3], NTC2 => data[4..5], NTC1 => data[6..7]
-        if len(data) < 8:
-            return
-        ntc3_raw = (data[2] << 8) | data[3]
-        ntc2_raw = (data[4] << 8) | data[5]
-        ntc1_raw = (data[6] << 8) | data[7]
-        self.bms_data["ntc"][2] = ntc3_raw 
-        self.bms_data["ntc"][1] = ntc2_raw 
-        self.bms_data["ntc"][0] = ntc1_raw
+        if len(data) < 8 or self.state.num_ntc < 3:
+            return False
+        ntc3_raw, ntc2_raw, ntc1_raw = _U16X3.unpack_from(data, 2)
+        state = self.state
+        raw = state.ntc_raw
+        raw[2] = ntc3_raw
+        raw[1] = ntc2_raw
+        raw[0] = ntc1_raw
+
+        # One table lookup per sensor; NaN (open/shorted NTC) is not valid
+        table = self.ntc_table
+        ntc = state.ntc
+        valid = 0
+        for i in range(3):
+            t = table.convert(raw[i])
+            ntc[i] = t
+            if t == t:
+                valid |= 1 << i
+        state.ntc_valid = valid
+        return True
 
     def _parse_0x205(self, data):
         # [0..1] => vpack, [2..3] => vmin, [4..5] => vmax, [6..7] => vbatt
         if len(data) < 8:
-            return
-        vpack_raw = (data[0] << 8) | data[1]
-        vmin_raw  = (data[2] << 8) | data[3]
-        vmax_raw  = (data[4] << 8) | data[5]
-        vbatt_raw = (data[6] << 8) | data[7]
-
-        self.bms_data["pack_sum"] = vpack_raw * 0.001
-        self.bms_data["vmin"]     = vmin_raw  * 0.001
-        self.bms_data["vmax"]     = vmax_raw  * 0.001
-        self.bms_data["vbatt"]    = vbatt_raw * 0.001
+            return False
+        vpack_raw, vmin_raw, vmax_raw, vbatt_raw = _U16X4.unpack_from(data)
+        pack = self.state.pack
+        pack[PACK_SUM] = vpack_raw * 0.001
+        pack[VMIN]     = vmin_raw  * 0.001
+        pack[VMAX]     = vmax_raw  * 0.001
+        pack[VBATT]    = vbatt_raw * 0.001
+        self.state.pack_valid = 0b1111
+        return True
 
     def _parse_0x206(self, data):
-        # alarm bits in data[0..2]
+        # alarm bits in data[0..2], two per byte -> packed into state.alarm_bits
         if len(data) < 3:
-            return
-        byte0 = data[0]
-        byte1 = data[1]
-        byte2 = data[2]
-        self.bms_data["alarms"]["vmin"]    = bool(byte0 & 0x01)
-        self.bms_data["alarms"]["vmax"]    = bool(byte0 & 0x02)
-        self.bms_data["alarms"]["tmin"]    = bool(byte1 & 0x01)
-        self.bms_data["alarms"]["tmax"]    = bool(byte1 & 0x02)
-        self.bms_data["alarms"]["vbatt"]   = bool(byte2 & 0x01)
-        self.bms_data["alarms"]["sn_error"]= bool(byte2 & 0x02)
+            return False
+        self.state.alarm_bits = (
+            (data[0] & 0x03)
+            | (data[1] & 0x03) << 2
+            | (data[2] & 0x03) << 4
+        )
+        self.state.alarms_valid = True
+        return True
 
     def _parse_0x300(self, data):
         # serial number stored as hex
-        sn_hex = "".join(f"{byte:02X}" for byte in data)
-        self.bms_data["serial_number"] = sn_hex
+        if not data:
+            return False
+        self.state.serial_number = data.hex().upper()
+        return True
 
     def _parse_0x301(self, data):
         # data[3..4] => HW, data[5..7] => SW
         if len(data) < 8:
-            return
+            return False
         hw_major = data[3]
         hw_minor = data[4]
         sw_major = data[5]
         sw_minor = data[6]
         sw_patch = data[7]
-        self.bms_data["hw_version"] = f"{hw_major}.{hw_minor}"
-        self.bms_data["sw_version"] = f"{sw_major}.{sw_minor}.{sw_patch}"
+        self.state.hw_version = f"{hw_major}.{hw_minor}"
+        self.state.sw_version = f"{sw_major}.{sw_minor}.{sw_patch}"
+        if self.variants is not None:
+            variant = self.variants.select(self.state.hw_version, self.state.sw_version)
+            if variant is not None and variant is not self.variant:
+                self._apply_variant(variant)
+        return True
+
+    def _parse_fd_measurement(self, data):
+        # data[0] => cell count N, data[1] => NTC count M,
+        # then N x u16 cell mV and M x u16 raw NTC, big-endian
+        if len(data) < 2:
+            return False
+        num_cells, num_ntc = data[0], data[1]
+        if not (1 <= num_cells <= MAX_CELLS and num_ntc <= MAX_NTC):
+            return False
+        if len(data) < 2 + 2 * (num_cells + num_ntc):
+            return False
+        if num_cells != self.state.num_cells or num_ntc != self.state.num_ntc:
+            self._resize_state(num_cells, num_ntc)
+
+        values = _u16_block(num_cells + num_ntc).unpack_from(data, 2)
+        state = self.state
+        voltages = state.voltages
+        for i in range(num_cells):
+            voltages[i] = values[i] * 0.001
+        state.cell_valid = (1 << num_cells) - 1
+
+        table = self.ntc_table
+        ntc = state.ntc
+        raw = state.ntc_raw
+        valid = 0
+        for i in range(num_ntc):
+            raw[i] = values[num_cells + i]
+            t = table.convert(raw[i])
+            ntc[i] = t
+            if t == t:
+                valid |= 1 << i
+        state.ntc_valid = valid
+        return True
+
+    def _resize_state(self, num_cells, num_ntc):
+        """
+        The pack reports another cell / NTC count (FD firmware): rebuild the
+        state and everything sized after it. Happens once per pack variant.
+        """
+        self._m_resizes.inc()
+        if (num_cells, num_ntc) not in self._layouts_seen:  # report once per layout
+            self._layouts_seen.add((num_cells, num_ntc))
+            print(f"BMS reports {num_cells} cells / {num_ntc} NTC, resizing state.")
+        old = self.state
+        self.state = old.resized(num_cells, num_ntc)
+        self.bms_data = self.state.view()
+        self._rebuild_pipeline(old)
+
+    def _rebuild_pipeline(self, old_state):
+        """
+        Re-create what depends on the state object or on the frame layout:
+        derived metrics, rule engine, frame getters, publisher snapshot.
+        """
+        variant = self.variant
+        if variant is None:
+            self.derived = DerivedMetrics(self.state, self.derived.window)
+        else:
+            self.derived = DerivedMetrics(self.state, self.derived.window, variant.cell_frames,
+                                          variant.ntc_ids, variant.pack_ids)
+        self.state.derived = self.derived
+        if self.soc is not None:
+            if variant is None:
+                self.soc = SOCEstimator(self.state, self.soc_table, self.cell_ntc)
+            else:
+                self.soc = SOCEstimator(self.state, self.soc_table, self.cell_ntc,
+                                        variant.cell_frames, variant.ntc_ids)
+            self.state.soc = self.soc
+        anomalies = self.anomalies
+        if anomalies is not None and anomalies.pack_cells[self.anomaly_pack] != self.state.num_cells:
+            anomalies.resize(self.state.num_cells, self.anomaly_pack)
+        if self.rule_engine is not None:
+            ruleset = self.rule_engine.ruleset
+            if variant is not None:
+                ruleset = RuleSet(ruleset.rules, self.frame_signals)
+            self.rule_engine = self.rule_engine.rebound(ruleset, self.state)
+        self._frame_getters = {}
+        if self.publisher is not None and self.publisher.snapshot == old_state.snapshot:
+            self.publisher.snapshot = self.state.snapshot
+        if old_state is not self.state:
+            old_state.detach()
+
+    def _apply_variant(self, variant):
+        """
+        Switch to the frame layout of a pack_variants.PackVariant: its
+        generated decoders, cell / NTC counts and measurement cycle.
+        """
+        print(f"Pack variant {variant.name} ({variant.num_cells} cells / {variant.num_ntc} NTC).")
+        self.variant = variant
+        self._decoders = variant.decoders
+        self.frame_signals = variant.frame_signals
+        self._frame_counters = {}
+        if not self.fd_bitrate and variant.cycle_ids != self.assembler.cycle_ids:
+            old = self.assembler
+            self.assembler = CycleAssembler(
+                timeout=old.timeout, cycle_ids=variant.cycle_ids, on_cycle=old.on_cycle,
+                on_stale=old.on_stale, snapshot=old.snapshot, frame_signals=variant.frame_signals)
+            self.state.stale_ids.clear()
+            self.loss.track(variant.cycle_ids)
+        else:
+            self.assembler.frame_signals = variant.frame_signals
+        if (variant.num_cells, variant.num_ntc) != (self.state.num_cells, self.state.num_ntc):
+            old = self.state
+            self.state = old.resized(variant.num_cells, variant.num_ntc)
+            self.bms_data = self.state.view()
+            self._rebuild_pipeline(old)
+        else:
+            self._rebuild_pipeline(self.state)
+        self.state.frame_signals = variant.frame_signals
+
+    def _store_cells(self, first, data):
+        """
+        Store the four big-endian cell voltages of a 0x200..0x202 frame.
+        The frame carries the highest cell first, so data[6..7] is cell `first`.
+        Rejected (False) when short, or when an FD pack reported fewer cells.
+        """
+        if len(data) < 8 or first + 4 > self.state.num_cells:
+            return False
+        v_hi, v_b, v_a, v_lo = _U16X4.unpack_from(data)
+        voltages = self.state.voltages
+        voltages[first + 3] = v_hi * 0.001
+        voltages[first + 2] = v_b  * 0.001
+        voltages[first + 1] = v_a  * 0.001
+        voltages[first]     = v_lo * 0.001
+        self.state.cell_valid |= 0x0F << first
+        return True
+
+    def frame_changes(self, can_id):
+        """
+        Current values of the signals a frame with `can_id` may change, as
+        {signal: value}: what decode_payload() hands the publisher and
+        recorders, for tools that replay frames through a listener.
+        """
+        getters = self._frame_getters.get(can_id)
+        if getters is None:
+            getters = self._frame_getters[can_id] = tuple(
+                (name, self.state.getter(name)) for name in self.frame_signals.get(can_id, ())
+            )
+        return {name: get() for name, get in getters}
+
+    def _on_cycle(self, cycle):
+        """
+        Called by the cycle assembler for every complete measurement cycle:
+        feed the anomaly detector, then the on_cycle callback.
+        """
+        if self.anomalies is not None:
+            voltages = self.state.voltages
+            if self.state.cell_valid != (1 << len(voltages)) - 1:
+                voltages = self.bms_data["voltages"]  # None for the missing cells
+            events = self.anomalies.observe(self.anomaly_pack, voltages, cycle.end)
+            if events:
+                self._on_anomaly_events(events)
+        if self.on_cycle:
+            self.on_cycle(cycle)
+
+    def _on_anomaly_events(self, events):
+        for event in events:
+            if event.active:
+                self._m_anomaly_events[event.kind].value += 1
+            if self.on_anomaly_event:
+                self.on_anomaly_event(event)
+        active = self.anomalies.active_cells()
+        self._m_anomalies.set(len(active))
+        if self.publisher is not None:
+            self.publisher.publish({"anomalies": [list(a) for a in active]})
+
+    def _on_frame_loss(self, event):
+        """
+        Called by the loss tracker when missing frames are settled: count
+        them and record the running totals, so that recordings show when
+        frames went missing.
+        """
+        if event.cause == "outage":
+            self._m_outages.inc()
+            return
+        self._m_missing.labels(f"0x{event.can_id:03X}", event.cause).inc(event.missing)
+        changes = {"frames_missing": self.loss.missing, "frame_loss_ratio": self.loss.ratio()}
+        if self.publisher is not None:
+            self.publisher.publish(changes)
+        if self._recorders:
+            wall = time.time()
+            for recorder in self._recorders:
+                recorder.append(wall, changes)
+
+    def _on_stale(self, pack, can_id, stale):
+        """
+        Called by the cycle assembler when a frame ID goes stale or fresh again.
+        Going stale also notifies on_update, since no frame will do it.
+        """
+        if stale:
+            self.state.stale_ids.add(can_id)
+            if self.on_update:
+                self.on_update(self.bms_data)
+        else:
+            self.state.stale_ids.discard(can_id)
+        if self.publisher is not None:
+            self.publisher.publish({"stale": self.bms_data["stale"]})
 
     def _get_error_text(self, error_code):
         """Helper to retrieve text for a PCAN error code."""
@@ -0,0 +1,200 @@
+# derived_metrics.py
+import math
+from array import array
+
+from bms_state import CELL_FRAMES, DERIVED_SIGNALS, FD_MEASUREMENT_ID, PACK_SUM
+
+DEFAULT_WINDOW = 50  # samples per cell for the rolling mean / std
+
+# Names of the scalar signals published by DerivedMetrics
+SIGNALS = DERIVED_SIGNALS
+
+
+class DerivedMetrics:
+    """
+    Incrementally computed pack metrics, updated after every decoded frame:
+
+      - cell_sum:    sum of the cell voltages (running sum)
+      - cell_min / cell_max / cell_spread (max - min), tracked through the
+        index of the extreme cells: a frame only rescans the pack when it
+        raised the lowest cell or lowered the highest one
+      - pack_gap:    reported pack_sum (0x205) minus cell_sum
+      - ntc_spread:  hottest minus coldest NTC
+      - cell_mean / cell_std: per-cell rolling mean and standard deviation
+        over the last `window` samples (ring buffer + running sums)
+
+    update(can_id) only touches the cells carried by that frame, so the work
+    per frame does not depend on the window length. Values stay None until
+    every input they depend on has been received; cells not valid in the
+    state (never received) are not sampled and have no mean / std.
+    """
+
+    def __init__(self, state, window=DEFAULT_WINDOW, cell_frames=CELL_FRAMES,
+                 ntc_ids=(0x204,), pack_ids=(0x205,)):
+        """
+        :param state: the BMSState to read from (usually listener.state)
+        :param window: number of samples kept per cell for the rolling stats
+        :param cell_frames: CAN ID -> (first cell, cell count) of the cell
+                            frames (another layout for a pack variant)
+        :param ntc_ids: CAN IDs of the frames carrying NTC readings
+        :param pack_ids: CAN IDs of the frames carrying pack_sum
+        """
+        n = state.num_cells
+        self.state = state
+        self.window = window
+        self.cell_frames = cell_frames
+        self.ntc_ids = ntc_ids
+        self.pack_ids = pack_ids
+        self._all_cells = (1 << n) - 1
+
+        # Running sum of the cells: _contrib[i] is what cell i adds to it
+        self._contrib = array("d", bytes(8 * n))
+        self._cell_sum = 0.0
+        self._updates = 0
+        self._min_cell = -1  # index of the lowest / highest cell, -1: rescan
+        self._max_cell = -1
+
+        # Per-cell ring buffers, flattened: cell i owns [i*window, (i+1)*window)
+        self._ring = array("d", bytes(8 * n * window))
+        self._head = array("l", [0]) * n
+        self._count = array("l", [0]) * n
+        self._sum = array("d", bytes(8 * n))
+        self._sumsq = array("d", bytes(8 * n))
+
+        self.cell_mean = array("d", bytes(8 * n))
+        self.cell_std = array("d", bytes(8 * n))
+
+        self.cell_sum = None
+        self.cell_min = None
+        self.cell_max = None
+        self.cell_spread = None
+        self.pack_gap = None
+        self.ntc_spread = None
+
+    def update(self, can_id):
+        """Refresh the metrics that depend on the frame that was just decoded."""
+        cells = self.cell_frames.get(can_id)
+        if cells is not None:
+            if cells[0] + cells[1] > self.state.num_cells:
+                return  # classic frame for cells an FD pack does not have
+            self._update_cells(*cells)
+            self._update_pack_gap()
+            if can_id in self.ntc_ids:  # variant layouts may mix cells and NTCs
+                self._update_ntc()
+        elif can_id in self.ntc_ids:
+            self._update_ntc()
+            if can_id in self.pack_ids:
+                self._update_pack_gap()
+        elif can_id in self.pack_ids:
+            self._update_pack_gap()
+        elif can_id == FD_MEASUREMENT_ID:
+            self._update_cells(0, self.state.num_cells)
+            self._update_ntc()
+            self._update_pack_gap()
+
+    def value(self, name):
+        """Current value of one of the SIGNALS."""
+        return getattr(self, name)
+
+    def as_dict(self):
+        d = {name: getattr(self, name) for name in SIGNALS}
+        count = self._count
+        d["cell_mean"] = [m if count[i] else None for i, m in enumerate(self.cell_mean)]
+        d["cell_std"] = [s if count[i] else None for i, s in enumerate(self.cell_std)]
+        return d
+
+    def _update_cells(self, first, count):
+        state = self.state
+        voltages = state.voltages
+        contrib = self._contrib
+        window = self.window
+        ring = self._ring
+        valid = state.cell_valid
+        lo, low = self._min_cell, self.cell_min
+        hi, high = self._max_cell, self.cell_max
+
+        for i in range(first, first + count):
+            if not valid >> i & 1:
+                continue
+            v = voltages[i]
+
+            # extreme cells: a lower / higher value takes over, the extreme
+            # cell itself moving inwards leaves it unknown until the rescan
+            if lo >= 0:
+                if i == lo and v > low:
+                    lo = -1
+                elif i == lo or v < low:
+                    lo, low = i, v
+            if hi >= 0:
+                if i == hi and v < high:
+                    hi = -1
+                elif i == hi or v > high:
+                    hi, high = i, v
+
+            # running sum of the pack
+            self._cell_sum += v - contrib[i]
+            contrib[i] = v
+
+            # windowed accumulators
+            slot = i * window + self._head[i]
+            if self._count[i] < window:
+                self._count[i] += 1
+                old = 0.0
+            else:
+                old = ring[slot]
+            ring[slot] = v
+            self._head[i] = (self._head[i] + 1) % window
+            self._sum[i] += v - old
+            self._sumsq[i] += v * v - old * old
+
+            n = self._count[i]
+            mean = self._sum[i] / n
+            self.cell_mean[i] = mean
+            self.cell_std[i] = math.sqrt(max(0.0, self._sumsq[i] / n - mean * mean))
+
+        # Re-sync the running sums from the stored samples once per window
+        # so floating point error cannot accumulate over long runs.
+        self._updates += 1
+        if self._updates >= window:
+            self._updates = 0
+            self._resync()
+
+        if state.cell_valid != self._all_cells:
+            self._min_cell = self._max_cell = -1  # a cell went missing: rescan
+            return
+        if lo < 0:
+            low = min(voltages)
+            lo = voltages.index(low)
+        if hi < 0:
+            high = max(voltages)
+            hi = voltages.index(high)
+        self._min_cell = lo
+        self._max_cell = hi
+        self.cell_sum = self._cell_sum
+        self.cell_min = low
+        self.cell_max = high
+        self.cell_spread = self.cell_max - self.cell_min
+
+    def _update_pack_gap(self):
+        state = self.state
+        if self.cell_sum is None or not state.pack_valid >> PACK_SUM & 1:
+            return
+        self.pack_gap = state.pack[PACK_SUM] - self.cell_sum
+
+    def _update_ntc(self):
+        state = self.state
+        if not state.num_ntc or state.ntc_valid != (1 << state.num_ntc) - 1:
+            self.ntc_spread = None
+            return
+        ntc = state.ntc
+        self.ntc_spread = max(ntc) - min(ntc)
+
+    def _resync(self):
+        window = self.window
+        ring = self._ring
+        self._cell_sum = math.fsum(self._contrib)
+        for i in range(len(self._contrib)):
+            n = self._count[i]
+            samples = ring[i * window:i * window + n]
+            self._sum[i] = math.fsum(samples)
+            self._sumsq[i] = math.fsum(v * v for v in samples)
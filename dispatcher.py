@@ -0,0 +1,292 @@
+# dispatcher.py
+import threading
+import time
+from collections import deque, namedtuple
+
+from metrics import REGISTRY
+
+# One decoded frame as delivered to subscribers: wall-clock time, CAN ID,
+# raw payload and the {signal: value} it changed (filtered to the
+# subscription's signals). A LATEST delivery merges several frames: can_id
+# and data are those of the last one, values the latest of every signal.
+Item = namedtuple("Item", "timestamp can_id data values")
+
+# Delivery policies
+EVERY = "every"    # every matching frame, in order; dropped when the queue is full
+LATEST = "latest"  # only the latest value of each signal; never drops, skips
+BATCH = "batch"    # lists of frames, at most `batch` frames or `interval` seconds old
+POLICIES = (EVERY, LATEST, BATCH)
+
+DEFAULT_INTAKE = 65536  # frames waiting for the fan-out thread
+
+
+class Subscription:
+    """
+    One consumer of a Dispatcher: filters, delivery policy, bounded queue
+    and the worker thread that calls the callback. Created by
+    Dispatcher.subscribe(); counters are plain attributes.
+    """
+
+    def __init__(self, dispatcher, callback, ids, signals, policy, maxsize, batch, interval, name):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown delivery policy {policy!r}, expected one of {POLICIES}")
+        self.dispatcher = dispatcher
+        self.callback = callback
+        self.ids = None if ids is None else frozenset(ids)
+        self.signals = None if signals is None else frozenset(signals)
+        self.policy = policy
+        self.maxsize = maxsize
+        self.batch = batch
+        self.interval = interval
+        self.name = name or getattr(callback, "__qualname__", "subscriber")
+
+        self.delivered = 0  # frames handed to the callback
+        self.dropped = 0    # frames lost on a full queue (EVERY / BATCH)
+        self.merged = 0     # frames folded into a later delivery (LATEST)
+        self.errors = 0     # callback exceptions
+
+        self._queue = deque()
+        self._latest = None  # LATEST: [timestamp, can_id, data, values, frames]
+        self._latest_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name=f"dispatch-{self.name}")
+
+        labels = (self.name,)
+        self._m_dropped = dispatcher.registry.counter(
+            "bms_dispatch_dropped_total", "Frames dropped for a slow subscriber", ("subscriber",)
+        ).labels(*labels)
+        self._m_depth = dispatcher.registry.gauge(
+            "bms_dispatch_queue_depth", "Frames queued for a subscriber", ("subscriber",)
+        ).labels(*labels)
+
+    def _offer(self, item):
+        """Fan-out thread: queue one matching item according to the policy."""
+        if self.signals is not None:
+            values = {k: v for k, v in item.values.items() if k in self.signals}
+            if not values:
+                return
+            item = item._replace(values=values)
+        if self.policy == LATEST:
+            with self._latest_lock:
+                latest = self._latest
+                if latest is None:
+                    self._latest = [item.timestamp, item.can_id, item.data, dict(item.values), 1]
+                else:
+                    latest[0:3] = item[0:3]
+                    latest[3].update(item.values)
+                    latest[4] += 1
+        elif len(self._queue) >= self.maxsize:
+            self.dropped += 1
+            self._m_dropped.inc()
+            return
+        else:
+            self._queue.append(item)
+            if self.policy == BATCH and len(self._queue) < self.batch:
+                return  # the worker wakes up on its interval
+        self._wake.set()
+
+    def _run(self):
+        policy = self.policy
+        timeout = self.interval if policy == BATCH else None
+        while True:
+            self._wake.wait(timeout)
+            self._wake.clear()
+            if policy == LATEST:
+                with self._latest_lock:
+                    latest, self._latest = self._latest, None
+                if latest is not None:
+                    self.merged += latest[4] - 1
+                    self._deliver(Item(*latest[:4]), latest[4])
+            elif policy == EVERY:
+                queue = self._queue
+                while queue:
+                    self._deliver(queue.popleft(), 1)
+            else:
+                queue = self._queue
+                while queue:
+                    items = [queue.popleft() for _ in range(min(len(queue), self.batch))]
+                    self._deliver(items, len(items))
+            if self._stop and not self._queue and self._latest is None:
+                return
+
+    def _deliver(self, payload, frames):
+        try:
+            self.callback(payload)
+        except Exception as e:
+            self.errors += 1
+            if self.errors == 1:  # report once per subscriber
+                print(f"Subscriber {self.name} raised {e!r}")
+        self.delivered += frames
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "policy": self.policy,
+            "queued": len(self._queue),
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "merged": self.merged,
+            "errors": self.errors,
+        }
+
+
+class Dispatcher:
+    """
+    Fans decoded frames out to any number of in-process subscribers, each
+    with its own ID / signal filters, delivery policy, bounded queue and
+    worker thread, so that a slow consumer only delays (or loses frames
+    of) itself:
+
+        dispatcher = Dispatcher()
+        dispatcher.subscribe(recorder.write, ids=(0x200, 0x201, 0x202, 0x203))
+        dispatcher.subscribe(gui.refresh, policy=LATEST)
+        dispatcher.subscribe(exporter.push, policy=BATCH, batch=500, interval=1.0)
+        listener = BMSPcanListener(dispatcher=dispatcher)
+        listener.start()  # also starts the dispatcher, and stop() stops it
+
+    Without a listener, call start() before dispatching; dispatch() on a
+    dispatcher that is not started raises RuntimeError instead of filling
+    the intake.
+
+    dispatch() is what the CAN reader thread pays: one append to a bounded
+    intake deque, whatever the number of subscribers. A single fan-out
+    thread then matches each frame against a CAN ID -> subscriptions index
+    and queues it for each of them. The fan-out thread is also the only
+    writer of the per-subscriber queue depth gauges.
+    """
+
+    def __init__(self, intake=DEFAULT_INTAKE, registry=REGISTRY):
+        """
+        :param intake: frames buffered for the fan-out thread before dropping
+        :param registry: metrics.Registry receiving the dispatch metrics
+        """
+        self.intake = intake
+        self.registry = registry
+        self.dispatched = 0
+        self.dropped = 0  # frames lost at the intake (fan-out thread stalled)
+        self.subscriptions = []
+
+        self._intake = deque()
+        self._wake = threading.Event()
+        self._waiting = False
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._by_id = {}      # can_id -> subscriptions with an ID filter matching it
+        self._any_id = ()     # subscriptions without an ID filter
+
+        self._m_dropped = registry.counter(
+            "bms_dispatch_intake_dropped_total", "Frames dropped before the fan-out thread")
+
+    def subscribe(self, callback, ids=None, signals=None, policy=EVERY, maxsize=4096,
+                  batch=256, interval=0.5, name=None):
+        """
+        Register a consumer; it starts receiving the next frames.
+
+        :param callback: called on the subscription's worker thread with an
+                         Item (EVERY, LATEST) or a list of Items (BATCH)
+        :param ids: CAN IDs to receive, None for all
+        :param signals: signal names to receive, None for all; frames that
+                        change none of them are skipped
+        :param policy: EVERY, LATEST or BATCH
+        :param maxsize: queue bound in frames (EVERY / BATCH)
+        :param batch: largest list delivered at once (BATCH)
+        :param interval: longest wait before a partial batch is delivered
+        :param name: label for stats and metrics (default: callback name)
+        :returns: the Subscription
+        """
+        sub = Subscription(self, callback, ids, signals, policy, maxsize, batch, interval, name)
+        sub._thread.start()
+        with self._lock:
+            self.subscriptions.append(sub)
+            self._reindex()
+        return sub
+
+    def unsubscribe(self, sub, wait=True):
+        """Stop delivering to `sub`; what is already queued is still delivered."""
+        with self._lock:
+            if sub in self.subscriptions:
+                self.subscriptions.remove(sub)
+                self._reindex()
+        sub._stop = True
+        sub._wake.set()
+        if wait:
+            sub._thread.join()
+
+    def _reindex(self):
+        by_id = {}
+        for sub in self.subscriptions:
+            for can_id in sub.ids or ():
+                by_id.setdefault(can_id, []).append(sub)
+        self._any_id = tuple(sub for sub in self.subscriptions if sub.ids is None)
+        self._by_id = {can_id: tuple(subs) + self._any_id for can_id, subs in by_id.items()}
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        """Start the fan-out thread."""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="dispatch")
+        self._thread.start()
+
+    def stop(self):
+        """Deliver what is queued, then stop the fan-out and worker threads."""
+        if self._thread is not None:
+            self._stop.set()
+            self._wake.set()
+            self._thread.join()
+            self._thread = None
+        for sub in list(self.subscriptions):
+            self.unsubscribe(sub)
+
+    def dispatch(self, timestamp, can_id, data, values):
+        """
+        Hand one decoded frame to the subscribers. Never blocks; O(1) in the
+        number of subscribers. Returns False if the intake was full.
+        """
+        if self._thread is None:
+            raise RuntimeError("Dispatcher is not started (call start(), or pass it to a listener)")
+        intake = self._intake
+        if len(intake) >= self.intake:
+            self.dropped += 1
+            self._m_dropped.inc()
+            return False
+        intake.append(Item(timestamp, can_id, data, values))
+        self.dispatched += 1
+        if self._waiting:
+            self._waiting = False
+            self._wake.set()
+        return True
+
+    def _run(self):
+        intake = self._intake
+        while True:
+            self._waiting = True
+            if not intake:
+                self._wake.wait(0.5)
+            self._wake.clear()
+            self._waiting = False
+            by_id = self._by_id
+            any_id = self._any_id
+            while intake:
+                item = intake.popleft()
+                for sub in by_id.get(item.can_id, any_id):
+                    sub._offer(item)
+            for sub in self.subscriptions:  # also as the workers drain
+                sub._m_depth.set(len(sub._queue))
+            if self._stop.is_set() and not intake:
+                return
+
+    def stats(self):
+        return {
+            "dispatched": self.dispatched,
+            "dropped": self.dropped,
+            "intake": len(self._intake),
+            "subscriptions": [sub.stats() for sub in self.subscriptions],
+        }
@@ -0,0 +1,163 @@
+# frame_loss.py
+import time
+from collections import deque, namedtuple
+
+# Frames of one CAN ID found missing after a gap: `timestamp` is the time of
+# the last frame before the gap (frame clock), `missing` the number of
+# periods skipped. cause is "overrun" if the driver reported a receive
+# queue / controller overrun meanwhile, else "gap" (lost on the bus or never
+# sent); an "outage" is a gap longer than max_gap (BMS off, cable pulled),
+# recorded but not counted as missing frames.
+LossEvent = namedtuple("LossEvent", "timestamp can_id missing cause")
+
+DEFAULT_TOLERANCE = 1.5  # an interval above tolerance * period is a gap
+DEFAULT_MAX_GAP = 2.0    # seconds; longer silences are outages
+LEARN_INTERVALS = 8      # intervals whose median seeds a learned period
+
+
+class FrameLossTracker:
+    """
+    Infers missing frames of periodic CAN IDs from their timing. The period
+    of each ID is given (periods) or learned: the median of its first
+    LEARN_INTERVALS intervals, then an EWMA of its normal ones. An interval
+    of k periods means k - 1 frames went missing.
+
+    Frames read late are not lost: when a backlog is read in a burst (the
+    PCAN path stamps frames at read time) the gap is followed by intervals
+    shorter than period / tolerance, and each of those repays one frame of
+    the gap. What is still owed when the intervals are normal again is
+    counted as missing. With receive-time stamps (SocketCAN) there is no
+    burst and the next normal interval settles the gap.
+
+    Driver overruns are only reported as events, without a frame count;
+    overrun() records them so that the following losses are attributed.
+    """
+
+    def __init__(self, ids=(), periods=None, tolerance=DEFAULT_TOLERANCE,
+                 max_gap=DEFAULT_MAX_GAP, alpha=0.05, history=256, on_loss=None):
+        """
+        :param ids: periodic CAN IDs to watch (others are ignored)
+        :param periods: {can_id: expected period in seconds}; IDs without
+                        one learn it from their first intervals
+        :param tolerance: jitter allowance, as a multiple of the period
+        :param max_gap: seconds of silence treated as an outage
+        :param alpha: EWMA weight of a new interval when learning periods
+        :param history: recent LossEvents kept in `events`
+        :param on_loss: callback LossEvent -> None
+        """
+        self.periods = dict(periods or {})
+        self.tolerance = tolerance
+        self.max_gap = max_gap
+        self.alpha = alpha
+        self.on_loss = on_loss
+
+        self.events = deque(maxlen=history)
+        self.missing = 0
+        self.received = 0
+        self.overruns = 0
+        self.outages = 0
+        self.last_overrun = None
+        self.last_loss = None  # wall-clock time the last loss was settled
+        # can_id -> [last, period, received, missing, owed, gap start, intervals while learning]
+        self._ids = {}
+        self.track(ids)
+
+    def track(self, ids):
+        """Start watching more CAN IDs (e.g. the cycle of a new pack variant)."""
+        for can_id in ids:
+            if can_id not in self._ids:
+                self._ids[can_id] = [None, self.periods.get(can_id), 0, 0, 0, 0.0, []]
+
+    def overrun(self, now):
+        """The driver reported an overrun at `now` (frame clock)."""
+        self.overruns += 1
+        self.last_overrun = now
+
+    def frame(self, can_id, now):
+        """
+        Account for a frame of `can_id` at `now` (seconds, frame clock).
+        Returns the LossEvent it settled, if any.
+        """
+        entry = self._ids.get(can_id)
+        if entry is None:
+            return None
+        self.received += 1
+        entry[2] += 1
+        last = entry[0]
+        entry[0] = now
+        if last is None:
+            return None
+        interval = now - last
+        period = entry[1]
+        if period is None:
+            learning = entry[6]
+            learning.append(interval)
+            if len(learning) == LEARN_INTERVALS:
+                learning.sort()
+                entry[1] = learning[LEARN_INTERVALS // 2] or None
+                learning.clear()
+            return None
+
+        tolerance = self.tolerance
+        if interval > period * tolerance:
+            if interval > self.max_gap:
+                entry[4] = 0
+                return self._event(LossEvent(last, can_id, 0, "outage"))
+            if not entry[4]:
+                entry[5] = last
+            entry[4] += int(interval / period + 0.5) - 1
+            return None
+        if interval * tolerance < period:
+            if entry[4]:
+                entry[4] -= 1  # a late frame of the backlog
+            return None
+
+        if can_id not in self.periods:
+            entry[1] = period + self.alpha * (interval - period)
+        owed = entry[4]
+        if not owed:
+            return None
+        entry[4] = 0
+        entry[3] += owed
+        self.missing += owed
+        start = entry[5]
+        overrun = self.last_overrun is not None and self.last_overrun >= start
+        return self._event(LossEvent(start, can_id, owed, "overrun" if overrun else "gap"))
+
+    def _event(self, event):
+        if event.cause == "outage":
+            self.outages += 1
+        else:
+            self.last_loss = time.time()
+        self.events.append(event)
+        if self.on_loss:
+            self.on_loss(event)
+        return event
+
+    def ratio(self, can_id=None):
+        """Missing / expected frames, overall or for one CAN ID."""
+        if can_id is None:
+            missing, received = self.missing, self.received
+        else:
+            entry = self._ids.get(can_id)
+            if entry is None:
+                return 0.0
+            received, missing = entry[2], entry[3]
+        expected = received + missing
+        return missing / expected if expected else 0.0
+
+    def as_dict(self):
+        last = self.events[-1] if self.events else None
+        return {
+            "missing": self.missing,
+            "received": self.received,
+            "ratio": self.ratio(),
+            "overruns": self.overruns,
+            "outages": self.outages,
+            "last": last and last._asdict(),
+            "last_loss": self.last_loss,
+            "ids": {
+                f"0x{can_id:03X}": {"period": e[1], "received": e[2], "missing": e[3]}
+                for can_id, e in self._ids.items() if e[2]
+            },
+        }
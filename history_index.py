@@ -0,0 +1,312 @@
+# history_index.py
+import bisect
+import math
+import threading
+from array import array
+from collections import namedtuple
+
+# One aggregated bucket (or a whole range, for HistoryIndex.aggregate)
+Summary = namedtuple("Summary", "start min max mean count")
+
+# (bucket seconds, retention seconds or None = forever), finest first. Each
+# bucket size must be a multiple of the previous one.
+DEFAULT_LEVELS = (
+    (1, 6 * 3600),
+    (10, 2 * 86400),
+    (60, 14 * 86400),
+    (600, None),
+    (3600, None),
+)
+
+
+class _Level:
+    """Closed buckets of one resolution as parallel arrays, plus the open one."""
+
+    __slots__ = ("size", "keep", "horizon", "ids", "mins", "maxs", "sums", "counts",
+                 "open_id", "omin", "omax", "osum", "ocount")
+
+    def __init__(self, size, retention):
+        self.size = size
+        self.keep = None if retention is None else int(retention // size)
+        self.horizon = None  # first bucket id still complete, None until a trim
+        self.ids = array("q")
+        self.mins = array("d")
+        self.maxs = array("d")
+        self.sums = array("d")
+        self.counts = array("q")
+        self.open_id = None
+        self.omin = self.omax = self.osum = 0.0
+        self.ocount = 0
+
+    def merge(self, bucket_id, vmin, vmax, vsum, count):
+        """
+        Add an aggregate to bucket `bucket_id`. Returns the bucket it closed,
+        as a (id, min, max, sum, count) tuple, or None.
+        """
+        if bucket_id == self.open_id:
+            if vmin < self.omin:
+                self.omin = vmin
+            if vmax > self.omax:
+                self.omax = vmax
+            self.osum += vsum
+            self.ocount += count
+            return None
+        closed = None
+        if self.ocount:
+            closed = (self.open_id, self.omin, self.omax, self.osum, self.ocount)
+            self._close(*closed)
+        self.open_id = bucket_id
+        self.omin, self.omax, self.osum, self.ocount = vmin, vmax, vsum, count
+        return closed
+
+    def _close(self, bucket_id, vmin, vmax, vsum, count):
+        self.ids.append(bucket_id)
+        self.mins.append(vmin)
+        self.maxs.append(vmax)
+        self.sums.append(vsum)
+        self.counts.append(count)
+        # retention: trim in batches so the cost stays amortized O(1)
+        if self.keep is not None and len(self.ids) > 2 * self.keep:
+            drop = len(self.ids) - self.keep
+            self.horizon = self.ids[drop - 1] + 1
+            for column in (self.ids, self.mins, self.maxs, self.sums, self.counts):
+                del column[:drop]
+
+    def retains(self, bucket_id):
+        """True if bucket `bucket_id` and everything after it are still held."""
+        return self.horizon is None or bucket_id >= self.horizon
+
+    def closed_between(self, first_id, last_id):
+        """Closed buckets with first_id <= id <= last_id, as tuples."""
+        lo = bisect.bisect_left(self.ids, first_id)
+        hi = bisect.bisect_right(self.ids, last_id)
+        return zip(self.ids[lo:hi], self.mins[lo:hi], self.maxs[lo:hi],
+                   self.sums[lo:hi], self.counts[lo:hi])
+
+
+class _Pyramid:
+    """All levels of one signal. Closed buckets cascade to the next level."""
+
+    __slots__ = ("levels",)
+
+    def __init__(self, levels):
+        self.levels = [_Level(size, retention) for size, retention in levels]
+
+    def add(self, timestamp, value):
+        levels = self.levels
+        closed = levels[0].merge(int(timestamp // levels[0].size), value, value, value, 1)
+        k = 1
+        while closed is not None and k < len(levels):
+            bucket_id, vmin, vmax, vsum, count = closed
+            start = bucket_id * levels[k - 1].size
+            closed = levels[k].merge(int(start // levels[k].size), vmin, vmax, vsum, count)
+            k += 1
+
+    def open_tail(self, k):
+        """
+        Level-k buckets not closed yet: its open bucket plus what the finer
+        open buckets hold (not cascaded up yet). At most k + 1 entries.
+        """
+        tail = {}
+        for level in self.levels[:k + 1]:
+            if level.ocount:
+                bucket_id = int(level.open_id * level.size // self.levels[k].size)
+                entry = tail.get(bucket_id)
+                if entry is None:
+                    tail[bucket_id] = [level.omin, level.omax, level.osum, level.ocount]
+                else:
+                    entry[0] = min(entry[0], level.omin)
+                    entry[1] = max(entry[1], level.omax)
+                    entry[2] += level.osum
+                    entry[3] += level.ocount
+        return sorted((bucket_id,) + tuple(entry) for bucket_id, entry in tail.items())
+
+    def retaining(self, k, timestamp):
+        """
+        Finest level >= k from which on every level still holds `timestamp`,
+        or None if even the coarsest has dropped it.
+        """
+        found = None
+        for j in range(len(self.levels) - 1, k - 1, -1):
+            level = self.levels[j]
+            if not level.retains(int(timestamp // level.size)):
+                break
+            found = j
+        return found
+
+    def buckets(self, k, first_id, last_id):
+        """Level-k buckets in [first_id, last_id], closed and open, in order."""
+        out = list(self.levels[k].closed_between(first_id, last_id))
+        out += [b for b in self.open_tail(k) if first_id <= b[0] <= last_id]
+        return out
+
+
+class HistoryIndex:
+    """
+    Incrementally built pyramid of min / max / mean / count summaries for
+    every numeric signal, at several bucket sizes (DEFAULT_LEVELS: 1 s up
+    to 1 h). Adding a sample updates the finest level; a bucket that closes
+    is merged into the next level, so the amortized cost per sample is O(1).
+
+    Queries read the coarsest level that fits the requested bucket size, so
+    their cost is proportional to the number of buckets returned, not to
+    the number of raw samples:
+
+        history.query("cell7", now - 86400, now, bucket=60)
+
+    Thread-safe: the listener thread appends while others query.
+    """
+
+    def __init__(self, levels=DEFAULT_LEVELS):
+        """
+        :param levels: (bucket_seconds, retention_seconds or None) pairs,
+                       finest first, each size a multiple of the previous
+        """
+        for (finer, _), (coarser, _) in zip(levels, levels[1:]):
+            if coarser % finer:
+                raise ValueError(f"Bucket size {coarser} is not a multiple of {finer}")
+        self.levels = tuple(levels)
+        self.sizes = tuple(size for size, _ in levels)
+        self._pyramids = {}
+        self._lock = threading.Lock()
+
+    @property
+    def signals(self):
+        return list(self._pyramids)
+
+    def add(self, signal, timestamp, value):
+        """Add one sample. None, NaN and text values are ignored."""
+        if value is None or isinstance(value, str) or value != value:
+            return
+        with self._lock:
+            pyramid = self._pyramids.get(signal)
+            if pyramid is None:
+                pyramid = self._pyramids[signal] = _Pyramid(self.levels)
+            pyramid.add(timestamp, float(value))
+
+    def append(self, timestamp, values):
+        """Add {signal: value} at `timestamp` (the listener / archive sink API)."""
+        for signal, value in values.items():
+            self.add(signal, timestamp, value)
+
+    def add_series(self, signal, times, values):
+        """Add a column of samples in time order (e.g. from an archive)."""
+        for timestamp, value in zip(times, values):
+            self.add(signal, timestamp, value)
+
+    @classmethod
+    def from_archive(cls, reader, levels=DEFAULT_LEVELS, signals=None):
+        """Build an index from an archive.ArchiveReader, chunk by chunk."""
+        from archive import TEXT
+
+        index = cls(levels)
+        for i in range(len(reader.chunks)):
+            for signal, (times, values) in reader.read_chunk(i, signals).items():
+                if reader.columns[signal] != TEXT:
+                    index.add_series(signal, times, values)
+        return index
+
+    def _level_for(self, bucket):
+        """Index of the coarsest level whose size divides `bucket`."""
+        best = None
+        for k, size in enumerate(self.sizes):
+            if size <= bucket and bucket % size == 0:
+                best = k
+        if best is None:
+            raise ValueError(
+                f"Bucket of {bucket} s is not a multiple of the finest level ({self.sizes[0]} s)")
+        return best
+
+    def query(self, signal, start, end, bucket):
+        """
+        Summaries of `signal` over [start, end) in buckets of `bucket`
+        seconds (a multiple of a level size), as a list of Summary, empty
+        buckets omitted. `start` is aligned down and `end` up to the bucket
+        size.
+
+        A range reaching back past the retention of the level `bucket` reads
+        from falls back, as a whole, to the nearest coarser level that still
+        holds its start: the buckets are then widened to the least common
+        multiple of `bucket` and that level's size (see Summary.start).
+        Raises ValueError if no level holds the start any more.
+        """
+        k = self._level_for(bucket)
+        with self._lock:
+            pyramid = self._pyramids.get(signal)
+            if pyramid is None:
+                return []
+            retained = pyramid.retaining(k, int(start // bucket) * bucket)
+            if retained is None:
+                raise ValueError(f"No level of {signal!r} goes back to {start}")
+            if retained != k:
+                k = retained
+                bucket = math.lcm(int(bucket), self.sizes[k])
+            size = self.sizes[k]
+            first = int(start // bucket) * bucket
+            last = int(math.ceil(end / bucket)) * bucket
+            rows = pyramid.buckets(k, first // size, last // size - 1)
+
+        out = []
+        current = None
+        for bucket_id, vmin, vmax, vsum, count in rows:
+            group = int(bucket_id * size // bucket)
+            if current is None or group != current[0]:
+                if current is not None:
+                    out.append(Summary(current[0] * bucket, current[1], current[2],
+                                       current[3] / current[4], current[4]))
+                current = [group, vmin, vmax, vsum, count]
+            else:
+                current[1] = min(current[1], vmin)
+                current[2] = max(current[2], vmax)
+                current[3] += vsum
+                current[4] += count
+        if current is not None:
+            out.append(Summary(current[0] * bucket, current[1], current[2],
+                               current[3] / current[4], current[4]))
+        return out
+
+    def aggregate(self, signal, start, end):
+        """
+        One Summary of `signal` over [start, end), aligned to the finest
+        level. The range is covered greedily by the coarsest buckets that
+        fit, so the cost is O(levels * size ratio), independent of its length.
+
+        When `start` is older than the retention of the finest levels, the
+        edges are aligned to the finest level that still holds it instead
+        (the range widens to whole buckets of that level). Raises ValueError
+        if no level holds `start` any more.
+        """
+        sizes = self.sizes
+        vmin, vmax, vsum, count = math.inf, -math.inf, 0.0, 0
+        with self._lock:
+            pyramid = self._pyramids.get(signal)
+            if pyramid is None:
+                return Summary(start, None, None, None, 0)
+            finest = pyramid.retaining(0, start)
+            if finest is None:
+                raise ValueError(f"No level of {signal!r} goes back to {start}")
+            pos = int(start // sizes[finest]) * sizes[finest]
+            while pos < end:
+                # coarsest level aligned at pos whose bucket ends before `end`
+                k = finest
+                for j in range(len(sizes) - 1, finest, -1):
+                    if pos % sizes[j] == 0 and pos + sizes[j] <= end:
+                        k = j
+                        break
+                size = sizes[k]
+                # consecutive buckets of that level, up to the next coarser boundary
+                last = pos + size
+                while last + size <= end and (k + 1 == len(sizes) or last % sizes[k + 1]):
+                    last += size
+                if k == finest:
+                    last = max(last, min(end, pos + size))
+                for _, bmin, bmax, bsum, bcount in pyramid.buckets(
+                        k, pos // size, int(math.ceil(last / size)) - 1):
+                    vmin = min(vmin, bmin)
+                    vmax = max(vmax, bmax)
+                    vsum += bsum
+                    count += bcount
+                pos = int(math.ceil(last / size)) * size
+        if not count:
+            return Summary(start, None, None, None, 0)
+        return Summary(start, vmin, vmax, vsum / count, count)
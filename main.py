@@ -1,8 +1,18 @@
 import tkinter as tk
 
 import locale
+import os
+import socket
+import time
 
 from data_handler import BMSPcanListener
+from alarm_rules import Rule
+from metrics import REGISTRY, MetricsServer
+from snapshot_stream import SnapshotPublisher
+from pack_variants import DEFAULT_DEFINITIONS
+from soc import SOCTable, default_table as default_soc_table
+from anomaly_detector import AnomalyDetector
+from trigger_capture import TriggerCapture, DEFAULT_DIRECTORY as DEFAULT_CAPTURE_DIR
 from PCANBasic import PCAN_USBBUS1, PCAN_BAUD_500K
 
 try:
@@ -13,6 +23,21 @@ except locale.Error:
 from ttkbootstrap import Style
 from ttkbootstrap.widgets import Meter
 
+# Host-side alarms evaluated by the listener, on top of the BMS alarm bits
+HOST_RULES = [
+    Rule("Cell undervoltage", "cell_min", "<", 3.0, hysteresis=0.05, delay=0.5),
+    Rule("Cell overvoltage", "cell_max", ">", 4.25, hysteresis=0.05, delay=0.5),
+    Rule("NTC delta", "ntc_spread", ">", 8.0, hysteresis=1.0, delay=1.0),
+]
+
+# OCV-SOC curves of the cells (see soc.SOCTable.from_dict); generic NMC if absent
+SOC_CURVES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "soc_curves.json")
+
+# Raw frames around BMS alarms and host rule trips (see trigger_capture.py)
+# (in the user's data directory: next to main.py is a temporary directory
+# once bundled by PyInstaller)
+CAPTURE_DIR = DEFAULT_CAPTURE_DIR
+
 
 class BMSApp(tk.Tk):
     def __init__(self):
@@ -51,6 +76,7 @@ class BMSApp(tk.Tk):
         # A) 13 Cell Voltages as circular meters, with outside labels
         # ---------------------------------------------------------------------
         self.cell_meters = []
+        self.cell_labels = []
         cell_volt_frame = tk.LabelFrame(
             left_col,
             text="Cell Voltages",
@@ -97,6 +123,7 @@ class BMSApp(tk.Tk):
 
             # Keep references
             self.cell_meters.append(m)
+            self.cell_labels.append(cell_label)
             # If you want them to scale, add both to resizable_widgets
             self.resizable_widgets.append(m)
             self.resizable_widgets.append(cell_label)
@@ -135,7 +162,22 @@ class BMSApp(tk.Tk):
                                        bg=self.style.theme.colors.bg, fg="white")
         self.alarm_sn_label.pack(anchor="w", padx=5)
 
+        self.bus_label = tk.Label(alarm_frame, text="CAN bus: ok",
+                                  bg=self.style.theme.colors.bg, fg="white")
+        self.bus_label.pack(anchor="w", padx=5)
+
+        self.loss_label = tk.Label(alarm_frame, text="Frame loss: none",
+                                   bg=self.style.theme.colors.bg, fg="white")
+        self.loss_label.pack(anchor="w", padx=5)
+
+        self.host_alarm_label = tk.Label(alarm_frame, text="Host alarms: None",
+                                         bg=self.style.theme.colors.bg, fg="white")
+        self.host_alarm_label.pack(anchor="w", padx=5)
+
         for w in (
+            self.bus_label,
+            self.loss_label,
+            self.host_alarm_label,
             self.alarm_vmin_label,
             self.alarm_vmax_label,
             self.alarm_tmin_label,
@@ -213,7 +255,7 @@ class BMSApp(tk.Tk):
             parent=ntc_frame,
             meter_label="NTC1",
             meter_size=150,
-            amounttotal=150,
+            amounttotal=100,
             textright=" °C",
             style="success"
         )
@@ -223,7 +265,7 @@ class BMSApp(tk.Tk):
             parent=ntc_frame,
             meter_label="NTC2",
             meter_size=150,
-            amounttotal=150,
+            amounttotal=100,
             textright=" °C",
             style="success"
         )
@@ -233,11 +275,13 @@ class BMSApp(tk.Tk):
             parent=ntc_frame,
             meter_label="NTC3",
             meter_size=150,
-            amounttotal=150,
+            amounttotal=100,
             textright=" °C",
             style="success"
         )
         self.meter_ntc3.grid(row=0, column=2, padx=5, pady=5)
+        self.ntc_meters = [self.meter_ntc1, self.meter_ntc2, self.meter_ntc3]
+        self.ntc_shown = len(self.ntc_meters)  # meters not hidden for the pack's NTC count
 
         # BMS Serial Number
         sn_frame = tk.LabelFrame(
@@ -263,14 +307,68 @@ class BMSApp(tk.Tk):
         self.sw_label.pack(anchor="w", padx=5, pady=2)
         self.resizable_widgets.extend([self.hw_label, self.sw_label])
 
+        # Derived pack metrics (computed by the listener)
+        derived_frame = tk.LabelFrame(
+            right_col, text="Pack Consistency",
+            bg=self.style.theme.colors.bg,
+            fg=self.style.theme.colors.info
+        )
+        derived_frame.pack(side="top", fill="x", pady=5)
+        self.spread_label = tk.Label(derived_frame, text="Cell spread: --", bg=self.style.colors.get('bg'), fg="white")
+        self.spread_label.pack(anchor="w", padx=5, pady=2)
+        self.pack_gap_label = tk.Label(derived_frame, text="Pack gap: --", bg=self.style.colors.get('bg'), fg="white")
+        self.pack_gap_label.pack(anchor="w", padx=5, pady=2)
+        self.soc_label = tk.Label(derived_frame, text="SOC: --", bg=self.style.colors.get('bg'), fg="white")
+        self.soc_label.pack(anchor="w", padx=5, pady=2)
+        self.anomaly_label = tk.Label(derived_frame, text="Cell anomalies: None", bg=self.style.colors.get('bg'), fg="white")
+        self.anomaly_label.pack(anchor="w", padx=5, pady=2)
+        self.stale_label = tk.Label(derived_frame, text="Stale: None", bg=self.style.colors.get('bg'), fg="white")
+        self.stale_label.pack(anchor="w", padx=5, pady=2)
+        self.resizable_widgets.extend([self.spread_label, self.pack_gap_label, self.soc_label,
+                                       self.anomaly_label, self.stale_label])
+
+        self._m_render = REGISTRY.histogram(
+            "bms_render_seconds", "Time spent refreshing the dashboard widgets")
+
+        # Local msgpack stream for loggers / test sequencers (Unix sockets only)
+        self.publisher = None
+        if hasattr(socket, "AF_UNIX"):
+            self.publisher = SnapshotPublisher()
+            try:
+                self.publisher.start()
+            except OSError as e:
+                print(f"Snapshot stream disabled: {e}")
+                self.publisher = None
+
         # Start CAN listener
         self.can_listener = BMSPcanListener(
             channel=PCAN_USBBUS1,
             baudrate=PCAN_BAUD_500K,
-            on_update=self.on_bms_data
+            on_update=self.on_bms_data,
+            rules=HOST_RULES,
+            on_rule_event=self.on_rule_event,
+            publisher=self.publisher,
+            # 13S / 14S frame layouts, picked from the 0x301 versions
+            variants=DEFAULT_DEFINITIONS if os.path.exists(DEFAULT_DEFINITIONS) else None,
+            soc_table=SOCTable.from_file(SOC_CURVES) if os.path.exists(SOC_CURVES) else default_soc_table(),
+            # early warning on cells drifting from their siblings
+            anomalies=AnomalyDetector(),
+            on_anomaly_event=self.on_anomaly_event,
+            capture=TriggerCapture(CAPTURE_DIR)
         )
         self.can_listener.start()
 
+        # Local Prometheus endpoint with listener and render health
+        self.metrics_server = MetricsServer(REGISTRY)
+        try:
+            self.metrics_server.start()
+        except OSError as e:
+            print(f"Metrics endpoint disabled: {e}")
+            self.metrics_server = None
+
+        # F9 toggles pipeline profiling and dumps a flame graph profile
+        self.bind("<F9>", self.toggle_profiling)
+
         # Window close
         self.protocol("WM_DELETE_WINDOW", self.on_closing)
 
@@ -320,12 +418,15 @@ class BMSApp(tk.Tk):
         """
         Called whenever new BMS data arrives: update the meter values and alarm states, etc.
         """
+        t_start = time.perf_counter()
+
         # Cell voltages: 13 meters
-        for i, val in enumerate(data["voltages"]):
+        # (FD packs may report more cells than there are meters)
+        for meter, val in zip(self.cell_meters, data["voltages"]):
             if val is not None:
-                self.cell_meters[i].configure(amountused=val)
+                meter.configure(amountused=val)
             else:
-                self.cell_meters[i].configure(amountused=0)
+                meter.configure(amountused=0)
 
         # Battery stats
         if data["pack_sum"] is not None:
@@ -337,14 +438,21 @@ class BMSApp(tk.Tk):
         if data["vbatt"] is not None:
             self.meter_vbatt.winfo_children()[0].configure(amountused=data["vbatt"])
 
-        # NTC
-        ntc1, ntc2, ntc3 = data["ntc"]
-        if ntc1 is not None:
-            self.meter_ntc1.winfo_children()[0].configure(amountused=ntc1)
-        if ntc2 is not None:
-            self.meter_ntc2.winfo_children()[0].configure(amountused=ntc2)
-        if ntc3 is not None:
-            self.meter_ntc3.winfo_children()[0].configure(amountused=ntc3)
+        # NTC (already converted to °C by the listener)
+        # (packs and variants report 0..MAX_NTC sensors: hide the meters
+        # without one, and show the first three when there are more)
+        ntc = data["ntc"]
+        shown = min(len(ntc), len(self.ntc_meters))
+        if shown != self.ntc_shown:
+            self.ntc_shown = shown
+            for i, meter in enumerate(self.ntc_meters):
+                if i < shown:
+                    meter.grid()
+                else:
+                    meter.grid_remove()
+        for meter, val in zip(self.ntc_meters, ntc):
+            if val is not None:
+                meter.winfo_children()[0].configure(amountused=round(val, 1))
 
         # Alarms
         def update_alarm(label_widget, triggered):
@@ -370,9 +478,98 @@ class BMSApp(tk.Tk):
         if data["sw_version"] is not None:
             self.sw_label.config(text=f"SW: {data['sw_version']}")
 
+        # Derived metrics
+        derived = data["derived"]
+        if derived is not None:
+            if derived["cell_spread"] is not None:
+                self.spread_label.config(text=f"Cell spread: {derived['cell_spread'] * 1000:.0f} mV")
+            if derived["pack_gap"] is not None:
+                self.pack_gap_label.config(text=f"Pack gap: {derived['pack_gap']:+.3f} V")
+
+        # State of charge from the OCV curves (cells at rest)
+        soc = data["soc"]
+        if soc is not None:
+            for label, (i, value) in zip(self.cell_labels, enumerate(soc["cells"])):
+                label.config(text=f"Cell {i + 1}" if value is None else f"Cell {i + 1} · {value:.0f} %")
+            if soc["pack"] is not None:
+                self.soc_label.config(
+                    text=f"SOC: {soc['pack']:.0f} % (min {soc['min']:.0f} %, max {soc['max']:.0f} %)")
+
+        # Signals whose frames stopped arriving
+        stale = data["stale"]
+        if stale:
+            self.stale_label.config(text=f"Stale: {', '.join(stale)}", fg="#FF5555")
+        else:
+            self.stale_label.config(text="Stale: None", fg="white")
+
+        # CAN channel health
+        bus_state = self.can_listener.health.state
+        self.bus_label.config(text=f"CAN bus: {bus_state}",
+                              fg="white" if bus_state == "ok" else "#FF5555")
+
+        # Frames inferred missing (receive overruns, gaps in the cycle)
+        loss = self.can_listener.loss
+        if loss.missing:
+            when = time.strftime("%H:%M:%S", time.localtime(loss.last_loss))
+            self.loss_label.config(
+                text=f"Frame loss: {loss.missing} ({loss.ratio() * 100:.2f} %), last at {when}",
+                fg="#FF5555")
+
+        elapsed = time.perf_counter() - t_start
+        self._m_render.observe(elapsed)
+        profiler = self.can_listener.profiler
+        if profiler is not None:
+            profiler.record("render", int(elapsed * 1e9))
+
+    def on_rule_event(self, event):
+        """
+        Called when a host-side rule trips or clears: list the active ones.
+        """
+        active = self.can_listener.rule_engine.active
+        if active:
+            self.host_alarm_label.config(text=f"Host alarms: {', '.join(active)}", fg="#FF5555")
+        else:
+            self.host_alarm_label.config(text="Host alarms: None", fg="white")
+
+    def on_anomaly_event(self, event):
+        """
+        Called when a cell starts or stops standing out from the pack: list
+        the cells currently flagged.
+        """
+        active = self.can_listener.anomalies.active_cells()
+        if active:
+            text = ", ".join(f"cell {cell + 1} {kind}" for _, cell, kind in active)
+            self.anomaly_label.config(text=f"Cell anomalies: {text}", fg="#FF5555")
+        else:
+            self.anomaly_label.config(text="Cell anomalies: None", fg="white")
+
+    def toggle_profiling(self, event=None):
+        """
+        Start profiling, or stop it and write the folded-stack profile
+        (for flamegraph.pl / speedscope) next to the working directory.
+        """
+        if self.can_listener.profiler is None:
+            self.can_listener.enable_profiling()
+            print("Profiling enabled (F9 again to stop and dump).")
+            return
+        profiler = self.can_listener.disable_profiling()
+        path = profiler.dump_folded(time.strftime("bms_profile_%Y%m%d_%H%M%S.folded"))
+        print(profiler.report())
+        for can_id, s in self.can_listener.dedup_stats().items():
+            print(f"dedup {can_id}: {s['hits']} skipped / {s['hits'] + s['misses']} ({s['hit_rate']:.1%})")
+        print(f"Profile written to {path}")
+
     def on_closing(self):
         # Stop the CAN thread
         self.can_listener.stop()
+        try:
+            self.can_listener.capture.close()
+        except RuntimeError as e:
+            print(e)  # already reported when the capture failed; keep shutting down
+        if self.metrics_server:
+            self.metrics_server.stop()
+        if self.publisher:
+            self.publisher.stop()
         self.destroy()
 
     def _on_configure(self, event):
@@ -5,7 +5,7 @@ a = Analysis(
     ['main.py'],
     pathex=[],
     binaries=[],
-    datas=[],
+    datas=[('pack_variants.json', '.')],
     hiddenimports=[],
     hookspath=[],
     hooksconfig={},
@@ -0,0 +1,164 @@
+# ntc_calibration.py
+import bisect
+import json
+import math
+from array import array
+
+try:
+    import numpy as np
+except ImportError:  # numpy is only needed for convert_many() speed-ups
+    np = None
+
+KELVIN = 273.15
+
+
+class BetaModel:
+    """Beta-parameter thermistor model: 1/T = 1/T0 + ln(R/R0) / B."""
+
+    def __init__(self, r25=10000.0, beta=3435.0, t25=25.0):
+        """
+        :param r25: resistance in ohms at the reference temperature
+        :param beta: B constant in kelvin
+        :param t25: reference temperature in °C (usually 25)
+        """
+        self.r25 = r25
+        self.beta = beta
+        self.t25 = t25
+
+    def temperature(self, resistance):
+        inv_t = 1.0 / (self.t25 + KELVIN) + math.log(resistance / self.r25) / self.beta
+        return 1.0 / inv_t - KELVIN
+
+
+class SteinhartHartModel:
+    """Steinhart–Hart model: 1/T = A + B ln(R) + C ln(R)^3."""
+
+    def __init__(self, a, b, c):
+        self.a = a
+        self.b = b
+        self.c = c
+
+    def temperature(self, resistance):
+        ln_r = math.log(resistance)
+        return 1.0 / (self.a + self.b * ln_r + self.c * ln_r ** 3) - KELVIN
+
+
+class VendorCurveModel:
+    """
+    Vendor R/T table, interpolated linearly in ln(R).
+    Points outside the table are clamped to its end temperatures.
+    """
+
+    def __init__(self, points):
+        """
+        :param points: iterable of (temperature °C, resistance ohms) pairs
+        """
+        pts = sorted((math.log(r), t) for t, r in points)
+        if len(pts) < 2:
+            raise ValueError("A vendor curve needs at least two points")
+        self._ln_r = [p[0] for p in pts]
+        self._temp = [p[1] for p in pts]
+
+    def temperature(self, resistance):
+        ln_r = math.log(resistance)
+        xs = self._ln_r
+        i = bisect.bisect_left(xs, ln_r)
+        if i == 0:
+            return self._temp[0]
+        if i == len(xs):
+            return self._temp[-1]
+        x0, x1 = xs[i - 1], xs[i]
+        t0, t1 = self._temp[i - 1], self._temp[i]
+        return t0 + (t1 - t0) * (ln_r - x0) / (x1 - x0)
+
+
+class NTCTable:
+    """
+    Raw ADC count -> temperature lookup table, precomputed once from a
+    thermistor model and the measurement divider:
+
+        Vref -- r_series --+-- NTC -- GND      (ntc_low_side=True)
+                           |
+                          ADC
+
+    Live conversion is table[raw]. Counts at the rails (open or shorted
+    sensor) map to NaN, and counts above adc_max are clamped to adc_max.
+    """
+
+    def __init__(self, model, r_series=10000.0, adc_max=4095, ntc_low_side=True):
+        """
+        :param model: BetaModel, SteinhartHartModel or VendorCurveModel
+        :param r_series: fixed divider resistor in ohms
+        :param adc_max: full-scale ADC count (4095 for a 12-bit ADC)
+        :param ntc_low_side: True if the NTC sits between the ADC node and GND
+        """
+        self.model = model
+        self.r_series = r_series
+        self.adc_max = adc_max
+        self.ntc_low_side = ntc_low_side
+
+        table = array("d", [math.nan]) * (adc_max + 1)
+        for raw in range(1, adc_max):
+            ratio = raw / (adc_max - raw)
+            resistance = r_series * ratio if ntc_low_side else r_series / ratio
+            table[raw] = model.temperature(resistance)
+        self.table = table
+        self._np_table = None
+
+    def convert(self, raw):
+        """Temperature in °C for one raw reading (NaN for a faulty sensor)."""
+        if raw > self.adc_max:
+            raw = self.adc_max
+        return self.table[raw]
+
+    def convert_many(self, raws):
+        """
+        Convert a sequence of raw readings in one go, e.g. a recorded column.
+        Returns a numpy array when numpy is available, else an array('d').
+        """
+        if np is not None:
+            if self._np_table is None:
+                self._np_table = np.frombuffer(self.table, dtype=np.float64)
+            idx = np.minimum(np.asarray(raws, dtype=np.intp), self.adc_max)
+            return self._np_table[idx]
+        table = self.table
+        adc_max = self.adc_max
+        return array("d", [table[r if r <= adc_max else adc_max] for r in raws])
+
+    @classmethod
+    def from_dict(cls, config):
+        """
+        Build a table from a calibration dict, e.g.
+
+            {"model": "beta", "r25": 10000, "beta": 3435,
+             "r_series": 10000, "adc_max": 4095}
+            {"model": "steinhart-hart", "a": 1.1e-3, "b": 2.4e-4, "c": 7.5e-8}
+            {"model": "curve", "points": [[-20, 67770], [25, 10000], [80, 1669]]}
+        """
+        config = dict(config)
+        kind = config.pop("model", "beta")
+        divider = {
+            key: config.pop(key)
+            for key in ("r_series", "adc_max", "ntc_low_side")
+            if key in config
+        }
+        if kind == "beta":
+            model = BetaModel(**config)
+        elif kind == "steinhart-hart":
+            model = SteinhartHartModel(**config)
+        elif kind == "curve":
+            model = VendorCurveModel(config["points"])
+        else:
+            raise ValueError(f"Unknown thermistor model {kind!r}")
+        return cls(model, **divider)
+
+    @classmethod
+    def from_file(cls, path):
+        """Load a calibration dict (see from_dict) from a JSON file."""
+        with open(path, "r", encoding="utf-8") as f:
+            return cls.from_dict(json.load(f))
+
+
+def default_table():
+    """10 kOhm / B=3435 NTC on a 10 kOhm pull-up, 12-bit ADC."""
+    return NTCTable(BetaModel())
@@ -0,0 +1,363 @@
+# pack_variants.py
+import argparse
+import fnmatch
+import hashlib
+import importlib.util
+import json
+import os
+import sys
+import types
+from collections import namedtuple
+
+from bms_state import (
+    ALARM_BITS, FD_MEASUREMENT_ID, FRAME_SIGNALS, MAX_CELLS, MAX_NTC, PACK_FIELDS,
+)
+
+# Bump when generate_source() changes: it is part of the cache key
+GENERATOR_VERSION = 2
+
+DEFAULT_DEFINITIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pack_variants.json")
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "bms-decoders")
+
+# Frames that keep their hand-written parsers: identity frames (0x301
+# selects the variant) and the self-describing CAN FD measurement frame
+RESERVED_IDS = (0x300, 0x301, FD_MEASUREMENT_ID)
+
+_DERIVED_CELLS = ("cell_sum", "cell_min", "cell_max", "cell_spread", "pack_gap")
+_PACK_INDEX = {name: i for i, name in enumerate(PACK_FIELDS)}
+_ALARM_INDEX = {f"alarm_{name}": bit.bit_length() - 1 for name, bit in ALARM_BITS}
+
+# One signal of a frame: `bits` bits starting `bit` bits above the least
+# significant bit of the field that begins at data[byte] (DBC-style, with
+# the byte order of that field), then value = raw * scale + offset
+Field = namedtuple("Field", "signal byte bit bits order signed scale offset")
+
+
+def _field(spec):
+    field = Field(
+        signal=spec["signal"],
+        byte=int(spec["byte"]),
+        bit=int(spec.get("bit", 0)),
+        bits=int(spec.get("bits", 16)),
+        order=spec.get("order", "big"),
+        signed=bool(spec.get("signed", False)),
+        scale=float(spec.get("scale", 1)),
+        offset=float(spec.get("offset", 0)),
+    )
+    if field.order not in ("big", "little"):
+        raise ValueError(f"{field.signal}: order must be 'big' or 'little'")
+    if field.byte < 0 or field.bit < 0 or field.bits < 1 or field.byte + _width(field) > 64:
+        raise ValueError(f"{field.signal}: field outside a 64-byte frame")
+    return field
+
+
+def _width(field):
+    """Number of payload bytes a field spans."""
+    return (field.bit + field.bits + 7) // 8
+
+
+class PackVariant:
+    """
+    One pack variant: its cell / NTC counts, the layout of its measurement
+    frames and the hardware / software versions (0x301) it applies to.
+    `decoders` (CAN ID -> function) is filled in by load_variants().
+    """
+
+    def __init__(self, name, cells, ntc, frames, match=None, description=""):
+        """
+        :param name: variant name, e.g. "14S"
+        :param cells: number of cells
+        :param ntc: number of NTC sensors
+        :param frames: {can_id: [field spec dicts]} (see Field)
+        :param match: {"hw": pattern, "sw": pattern} (fnmatch patterns,
+                      missing = any); None for the fallback variant
+        :param description: free text
+        """
+        if not 1 <= cells <= MAX_CELLS or not 0 <= ntc <= MAX_NTC:
+            raise ValueError(f"Variant {name}: {cells} cells / {ntc} NTC out of range")
+        self.name = name
+        self.num_cells = cells
+        self.num_ntc = ntc
+        self.match = match
+        self.description = description
+        self.frames = {}
+        for can_id, specs in frames.items():
+            can_id = int(can_id, 0) if isinstance(can_id, str) else can_id
+            if can_id in RESERVED_IDS or not 0 <= can_id <= 0x7FF:
+                raise ValueError(f"Variant {name}: frame 0x{can_id:X} cannot be redefined")
+            self.frames[can_id] = tuple(_field(spec) for spec in specs)
+            for field in self.frames[can_id]:
+                self._check_signal(can_id, field)
+        self.decoders = {}
+
+        # What the listener pipeline needs to know about the layout
+        self.cycle_ids = tuple(sorted(self.frames))
+        self.cell_frames = {}
+        self.ntc_ids = ()
+        self.pack_ids = ()
+        frame_signals = {can_id: FRAME_SIGNALS[can_id] for can_id in RESERVED_IDS}
+        for can_id, fields in self.frames.items():
+            names = tuple(field.signal for field in fields)
+            cells = [int(s[4:]) - 1 for s in names if s.startswith("cell")]
+            if cells:
+                self.cell_frames[can_id] = (min(cells), max(cells) - min(cells) + 1)
+                names += _DERIVED_CELLS
+            if any(s.startswith("ntc") for s in names):
+                self.ntc_ids += (can_id,)
+                names += ("ntc_spread",)
+            if "pack_sum" in names:
+                self.pack_ids += (can_id,)
+                if not cells:
+                    names += ("pack_gap",)
+            frame_signals[can_id] = names
+        self.frame_signals = frame_signals
+
+    def _check_signal(self, can_id, field):
+        signal = field.signal
+        if signal.startswith("cell") and signal[4:].isdigit():
+            if not 1 <= int(signal[4:]) <= self.num_cells:
+                raise ValueError(f"Variant {self.name}: {signal} but {self.num_cells} cells")
+        elif signal.startswith("ntc") and signal[3:].isdigit():
+            if not 1 <= int(signal[3:]) <= self.num_ntc:
+                raise ValueError(f"Variant {self.name}: {signal} but {self.num_ntc} NTC")
+            if field.scale != 1 or field.offset or field.signed:
+                raise ValueError(f"Variant {self.name}: {signal} must be raw ADC counts")
+        elif signal in _ALARM_INDEX:
+            if field.bits != 1:
+                raise ValueError(f"Variant {self.name}: {signal} must be a single bit")
+        elif signal not in _PACK_INDEX:
+            raise ValueError(f"Variant {self.name}: unknown signal {signal} in 0x{can_id:03X}")
+
+    @property
+    def key(self):
+        """Hash of everything the generated code depends on."""
+        layout = {
+            "generator": GENERATOR_VERSION,
+            "cells": self.num_cells,
+            "ntc": self.num_ntc,
+            "frames": {f"0x{can_id:03X}": [f._asdict() for f in fields]
+                       for can_id, fields in sorted(self.frames.items())},
+        }
+        return hashlib.sha256(json.dumps(layout, sort_keys=True).encode()).hexdigest()
+
+    def matches(self, hw_version, sw_version):
+        if self.match is None:
+            return False
+        return (fnmatch.fnmatchcase(hw_version or "", self.match.get("hw", "*"))
+                and fnmatch.fnmatchcase(sw_version or "", self.match.get("sw", "*")))
+
+    def __repr__(self):
+        return f"PackVariant({self.name!r}, {self.num_cells}S, {self.num_ntc} NTC)"
+
+
+class VariantSet:
+    """
+    The variants of a definition file. select() returns the first variant
+    whose patterns match the reported versions, else the fallback (the
+    first variant without "match"), which is also used until 0x301 arrives.
+    """
+
+    def __init__(self, variants):
+        self.variants = tuple(variants)
+        self.default = next((v for v in self.variants if v.match is None), None)
+
+    def select(self, hw_version, sw_version):
+        for variant in self.variants:
+            if variant.matches(hw_version, sw_version):
+                return variant
+        return self.default
+
+    def __iter__(self):
+        return iter(self.variants)
+
+
+def _raw_expr(field):
+    """Python expression for the unsigned raw value of a field in `data`."""
+    n = _width(field)
+    parts = []
+    for k in range(n):
+        shift = 8 * (n - 1 - k) if field.order == "big" else 8 * k
+        parts.append(f"data[{field.byte + k}] << {shift}" if shift else f"data[{field.byte + k}]")
+    expr = " | ".join(parts)
+    if field.bit:
+        expr = f"{_group(expr)} >> {field.bit}"
+    if field.bit or field.bits != 8 * n:
+        expr = f"{_group(expr)} & {(1 << field.bits) - 1:#x}"
+    return expr
+
+
+def _group(expr):
+    return f"({expr})" if " " in expr else expr
+
+
+def _value_expr(field):
+    expr = _raw_expr(field)
+    if field.signed:
+        sign = 1 << (field.bits - 1)
+        expr = f"({_group(expr)} ^ {sign:#x}) - {sign:#x}"
+    if field.scale != 1:
+        expr = f"{_group(expr)} * {field.scale!r}"
+    if field.offset:
+        expr = f"{expr} + {field.offset!r}"
+    return expr
+
+
+def _frame_source(can_id, fields):
+    cells = [f for f in fields if f.signal.startswith("cell")]
+    ntcs = [f for f in fields if f.signal.startswith("ntc")]
+    packs = [f for f in fields if f.signal in _PACK_INDEX]
+    alarms = [f for f in fields if f.signal in _ALARM_INDEX]
+
+    guards = [f"len(data) < {max(f.byte + _width(f) for f in fields)}"]
+    if cells:
+        guards.append(f"state.num_cells < {max(int(f.signal[4:]) for f in cells)}")
+    if ntcs:
+        guards.append(f"state.num_ntc < {max(int(f.signal[3:]) for f in ntcs)}")
+    lines = [
+        f"def decode_0x{can_id:03X}(data, state, table):",
+        f"    if {' or '.join(guards)}:",
+        "        return False",
+    ]
+    if cells:
+        mask = 0
+        lines.append("    voltages = state.voltages")
+        for f in cells:
+            index = int(f.signal[4:]) - 1
+            mask |= 1 << index
+            lines.append(f"    voltages[{index}] = {_value_expr(f)}")
+        lines.append(f"    state.cell_valid |= {mask:#x}")
+    if ntcs:
+        mask = sum(1 << (int(f.signal[3:]) - 1) for f in ntcs)
+        lines += [
+            "    ntc_raw = state.ntc_raw",
+            "    ntc = state.ntc",
+            "    convert = table.convert",
+            f"    valid = state.ntc_valid & {~mask & ((1 << MAX_NTC) - 1):#x}",
+        ]
+        for f in ntcs:
+            index = int(f.signal[3:]) - 1
+            lines += [
+                f"    raw = {_raw_expr(f)}",
+                f"    ntc_raw[{index}] = raw",
+                "    t = convert(raw)",
+                f"    ntc[{index}] = t",
+                "    if t == t:",
+                f"        valid |= {1 << index:#x}",
+            ]
+        lines.append("    state.ntc_valid = valid")
+    if packs:
+        mask = 0
+        lines.append("    pack = state.pack")
+        for f in packs:
+            index = _PACK_INDEX[f.signal]
+            mask |= 1 << index
+            lines.append(f"    pack[{index}] = {_value_expr(f)}")
+        lines.append(f"    state.pack_valid |= {mask:#x}")
+    if alarms:
+        mask = sum(1 << _ALARM_INDEX[f.signal] for f in alarms)
+        keep = ~mask & ((1 << len(ALARM_BITS)) - 1)
+        terms = [f"state.alarm_bits & {keep:#x}"] if keep else []
+        # bits of one byte that land at the same distance share one mask
+        groups = {}
+        for f in alarms:
+            position = _ALARM_INDEX[f.signal]
+            if _width(f) == 1:
+                key = (f.byte, position - f.bit)
+                groups[key] = groups.get(key, 0) | 1 << f.bit
+            else:
+                terms.append(f"({_raw_expr(f)}) << {position}" if position else f"({_raw_expr(f)})")
+        for (byte, shift), mask in sorted(groups.items()):
+            term = f"(data[{byte}] & {mask:#x})"
+            if shift:
+                term += f" << {shift}" if shift > 0 else f" >> {-shift}"
+            terms.append(term)
+        lines.append("    state.alarm_bits = (")
+        lines.append("        " + "\n        | ".join(terms))
+        lines.append("    )")
+        lines.append("    state.alarms_valid = True")
+    lines.append("    return True")
+    return "\n".join(lines)
+
+
+def generate_source(variant):
+    """
+    Source of a module with one straight-line decode function per frame of
+    `variant` and a DECODERS dict. Each function has the signature of the
+    listener parsers plus the state and NTC table: decoder(data, state, table),
+    and like them returns False when it rejects a frame (too short, or more
+    cells / NTCs than the state holds), True once the frame is stored.
+    """
+    header = (
+        f"# Generated by pack_variants.py (generator {GENERATOR_VERSION}) for variant "
+        f"{variant.name}: {variant.num_cells} cells, {variant.num_ntc} NTC.\n"
+        f"# Key {variant.key}. Do not edit: edit the definition file instead.\n"
+    )
+    functions = [_frame_source(can_id, fields) for can_id, fields in sorted(variant.frames.items())]
+    table = "".join(f"    0x{can_id:03X}: decode_0x{can_id:03X},\n" for can_id in sorted(variant.frames))
+    return header + "\n\n" + "\n\n\n".join(functions) + f"\n\n\nDECODERS = {{\n{table}}}\n"
+
+
+def compile_variant(variant, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    The DECODERS of a variant. The generated module is written once to
+    `cache_dir` under its key and imported from there, so later starts only
+    load its cached bytecode. Without a writable cache the source is
+    compiled in memory.
+    """
+    name = f"bms_decoders_{variant.key[:16]}"
+    path = os.path.join(cache_dir, name + ".py") if cache_dir else None
+    if path is not None and not os.path.exists(path):
+        source = generate_source(variant)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(source)
+            os.replace(tmp, path)  # atomic: concurrent starts never see half a file
+        except OSError as e:
+            print(f"Decoder cache disabled ({e}).")
+            path = None
+    if path is not None:
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    else:
+        module = types.ModuleType(name)
+        exec(compile(generate_source(variant), f"<{name}>", "exec"), module.__dict__)
+    return module.DECODERS
+
+
+def load_variants(path=DEFAULT_DEFINITIONS, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Read a definition file ({"variants": [...]}, see pack_variants.json)
+    and compile the decoders of every variant. Returns a VariantSet.
+    """
+    with open(path, encoding="utf-8") as f:
+        definitions = json.load(f)
+    variants = []
+    for spec in definitions["variants"]:
+        variant = PackVariant(spec["name"], spec["cells"], spec["ntc"], spec["frames"],
+                              spec.get("match"), spec.get("description", ""))
+        variant.decoders = compile_variant(variant, cache_dir)
+        variants.append(variant)
+    return VariantSet(variants)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pack variant decoders")
+    parser.add_argument("definitions", nargs="?", default=DEFAULT_DEFINITIONS)
+    parser.add_argument("--show", metavar="VARIANT", help="print the generated source of a variant")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR)
+    args = parser.parse_args()
+
+    variant_set = load_variants(args.definitions, args.cache_dir)
+    for variant in variant_set:
+        if args.show == variant.name:
+            print(generate_source(variant))
+        elif args.show is None:
+            match = variant.match or "fallback"
+            print(f"{variant.name:<8}{variant.num_cells}S / {variant.num_ntc} NTC, "
+                  f"frames {', '.join(f'0x{i:03X}' for i in variant.cycle_ids)}, "
+                  f"match {match}, key {variant.key[:16]}")
+    if args.show and args.show not in [v.name for v in variant_set]:
+        sys.exit(f"No variant {args.show}")
@@ -0,0 +1,157 @@
+# profiling.py
+import time
+from array import array
+
+# Pipeline stages, in call order. "render" runs inside "dispatch" (the GUI
+# refresh is the on_update callback), which the folded dump reflects.
+STAGES = ("read", "decode", "dispatch", "render")
+_FOLDED_PATHS = {
+    "read": "listener;read",
+    "decode": "listener;decode",
+    "dispatch": "listener;dispatch",
+    "render": "listener;dispatch;render",
+}
+
+
+class HdrHistogram:
+    """
+    Fixed-memory log-linear histogram of integer values (nanoseconds), in
+    the spirit of HdrHistogram: every power of two is split into
+    2**sub_bits linear sub-buckets, so the relative error is below
+    1 / 2**sub_bits at any magnitude. With the defaults (5 bits, up to
+    2**40 ns ~ 18 min) it is ~1.2k counters, whatever the sample count.
+    """
+
+    def __init__(self, sub_bits=5, max_bits=40):
+        self.sub_bits = sub_bits
+        self.sub = 1 << sub_bits
+        self.max_value = (1 << max_bits) - 1
+        self.counts = array("Q", bytes(8 * (self._index(self.max_value) + 1)))
+        self.total = 0
+        self.sum = 0
+        self.min = None
+        self.max = 0
+
+    def _index(self, value):
+        if value < 2 * self.sub:
+            return value
+        shift = value.bit_length() - self.sub_bits - 1
+        return self.sub * shift + (value >> shift)
+
+    def _value_at(self, index):
+        """Lowest value falling in bucket `index`."""
+        if index < 2 * self.sub:
+            return index
+        shift = index // self.sub - 1
+        return (index - self.sub * shift) << shift
+
+    def record(self, value):
+        if value < 0:
+            value = 0
+        elif value > self.max_value:
+            value = self.max_value
+        self.counts[self._index(value)] += 1
+        self.total += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """Value at percentile p (0..100), at bucket resolution."""
+        if not self.total:
+            return 0
+        rank = max(1, int(round(p / 100.0 * self.total)))
+        seen = 0
+        for index, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return self._value_at(index)
+        return self.max
+
+    def mean(self):
+        return self.sum / self.total if self.total else 0.0
+
+    def summary(self):
+        return {
+            "count": self.total,
+            "mean_ns": self.mean(),
+            "min_ns": self.min or 0,
+            "p50_ns": self.percentile(50),
+            "p99_ns": self.percentile(99),
+            "p999_ns": self.percentile(99.9),
+            "max_ns": self.max,
+        }
+
+
+class StageProfiler:
+    """
+    Per-stage latency histograms for the receive pipeline, with a
+    per-CAN-ID breakdown of the decode and dispatch stages.
+
+    The listener only calls into it while profiling is enabled
+    (BMSPcanListener.enable_profiling); when disabled the hooks are not
+    installed at all.
+    """
+
+    def __init__(self):
+        self.stages = {stage: HdrHistogram() for stage in STAGES}
+        self.by_id = {}  # (stage, can_id) -> HdrHistogram
+        self.started = time.monotonic()
+
+    def record(self, stage, ns, can_id=None):
+        self.stages[stage].record(ns)
+        if can_id is not None:
+            key = (stage, can_id)
+            hist = self.by_id.get(key)
+            if hist is None:
+                hist = self.by_id[key] = HdrHistogram()
+            hist.record(ns)
+
+    def report(self):
+        """Text table of the per-stage and per-ID latencies."""
+        lines = [f"{'stage':<22}{'count':>10}{'mean':>10}{'p50':>10}{'p99':>10}{'max':>10}  (µs)"]
+        rows = [(stage, self.stages[stage]) for stage in STAGES]
+        rows += [(f"  {stage} 0x{can_id:03X}", hist)
+                 for (stage, can_id), hist in sorted(self.by_id.items())]
+        for name, hist in rows:
+            s = hist.summary()
+            lines.append(
+                f"{name:<22}{s['count']:>10}{s['mean_ns'] / 1e3:>10.1f}"
+                f"{s['p50_ns'] / 1e3:>10.1f}{s['p99_ns'] / 1e3:>10.1f}{s['max_ns'] / 1e3:>10.1f}"
+            )
+        return "\n".join(lines)
+
+    def folded(self):
+        """
+        Profile in the "folded stacks" format read by flamegraph.pl /
+        speedscope / inferno: one "frame;frame;frame weight" line per stack,
+        weighted by total nanoseconds. Per-ID decode/dispatch time becomes a
+        child frame; render time is carved out of dispatch.
+        """
+        lines = []
+        render_ns = self.stages["render"].sum
+        for stage in STAGES:
+            ids = {can_id: h for (s, can_id), h in self.by_id.items() if s == stage}
+            total = self.stages[stage].sum
+            path = _FOLDED_PATHS[stage]
+            if stage == "dispatch":
+                # render is reported as its own child frame
+                if ids:
+                    scale = max(0.0, 1.0 - render_ns / total) if total else 0.0
+                    for can_id, hist in sorted(ids.items()):
+                        lines.append(f"{path};0x{can_id:03X} {int(hist.sum * scale)}")
+                else:
+                    lines.append(f"{path} {max(0, total - render_ns)}")
+            elif ids:
+                for can_id, hist in sorted(ids.items()):
+                    lines.append(f"{path};0x{can_id:03X} {hist.sum}")
+            elif total:
+                lines.append(f"{path} {total}")
+        return "\n".join(line for line in lines if not line.endswith(" 0")) + "\n"
+
+    def dump_folded(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(self.folded())
+        return path
@@ -0,0 +1,282 @@
+# session_analyzer.py
+import argparse
+import json
+import math
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from archive import ArchiveReader, TEXT, read_trc
+from bms_state import ALARM_BITS
+from data_handler import BMSPcanListener
+from metrics import Registry
+
+CHUNK_FRAMES = 50000  # frames decoded per chunk of a .trc session
+SESSION_EXTENSIONS = (".trc", ".bmsa")
+ALARM_SIGNALS = tuple(f"alarm_{name}" for name, _ in ALARM_BITS)
+
+# Default report limits
+SPREAD_LIMIT = 0.05  # V, max cell spread before a pack is flagged as imbalanced
+TEMP_LIMIT = 60.0    # °C, max NTC temperature before a pack is flagged
+
+
+class SessionStats:
+    """
+    Per-signal extremes of one session, accumulated chunk by chunk from
+    {signal: (times, values)} columns: min / max / sum / count of every
+    numeric signal, rising edges and active time of the alarm bits, and the
+    last value of the text signals (serial number, versions).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.frames = 0
+        self.start = None
+        self.end = None
+        self.signals = {}  # signal -> [min, max, sum, count]
+        self.alarm_edges = {name: 0 for name in ALARM_SIGNALS}
+        self.alarm_seconds = {name: 0.0 for name in ALARM_SIGNALS}
+        self.text = {}
+        self._alarm_last = {}  # signal -> (time, active) of the previous sample
+
+    def add_chunk(self, columns):
+        for name, (times, values) in columns.items():
+            if not times:
+                continue
+            if self.start is None or times[0] < self.start:
+                self.start = times[0]
+            if self.end is None or times[-1] > self.end:
+                self.end = times[-1]
+            if isinstance(values[-1], str):
+                self.text[name] = values[-1]
+                continue
+            valid = [v for v in values if v is not None and v == v]
+            if not valid:
+                continue
+            if name in self.alarm_edges:
+                self._add_alarm(name, times, values)
+            entry = self.signals.get(name)
+            lo, hi, total = min(valid), max(valid), math.fsum(valid)
+            if entry is None:
+                self.signals[name] = [lo, hi, total, len(valid)]
+            else:
+                entry[0] = min(entry[0], lo)
+                entry[1] = max(entry[1], hi)
+                entry[2] += total
+                entry[3] += len(valid)
+
+    def _add_alarm(self, name, times, values):
+        last_t, last_active = self._alarm_last.get(name, (None, False))
+        edges = 0
+        seconds = 0.0
+        for t, v in zip(times, values):
+            if v is None or v != v:
+                continue
+            active = bool(v)
+            if last_active:
+                seconds += t - last_t
+            elif active:
+                edges += 1
+            last_t, last_active = t, active
+        self._alarm_last[name] = (last_t, last_active)
+        self.alarm_edges[name] += edges
+        self.alarm_seconds[name] += seconds
+
+    def summary(self):
+        def stat(name, index):
+            entry = self.signals.get(name)
+            return None if entry is None else entry[index]
+
+        def mean(name):
+            entry = self.signals.get(name)
+            return None if entry is None else entry[2] / entry[3]
+
+        ntc = [name for name in self.signals if name.startswith("ntc") and name[3:].isdigit()]
+        return {
+            "path": self.path,
+            "serial_number": self.text.get("serial_number"),
+            "hw_version": self.text.get("hw_version"),
+            "sw_version": self.text.get("sw_version"),
+            "frames": self.frames,
+            "start": self.start,
+            "duration": (self.end - self.start) if self.start is not None else 0.0,
+            "cell_min": stat("cell_min", 0),
+            "cell_max": stat("cell_max", 1),
+            "spread_max": stat("cell_spread", 1),
+            "spread_mean": mean("cell_spread"),
+            "pack_gap_max": stat("pack_gap", 1),
+            "temp_min": min((self.signals[n][0] for n in ntc), default=None),
+            "temp_max": max((self.signals[n][1] for n in ntc), default=None),
+            "ntc_spread_max": stat("ntc_spread", 1),
+            "alarm_edges": dict(self.alarm_edges),
+            "alarm_seconds": dict(self.alarm_seconds),
+        }
+
+
+def _trc_chunks(path, stats):
+    """Decode a .trc session with a hardware-less listener, CHUNK_FRAMES at a time."""
+    listener = BMSPcanListener(registry=Registry())
+    columns = {}
+    pending = 0
+    for timestamp, can_id, data in read_trc(path):
+        if listener.decode_payload(can_id, data, timestamp) is None:
+            continue
+        for name, value in listener.frame_changes(can_id).items():
+            column = columns.get(name)
+            if column is None:
+                column = columns[name] = ([], [])
+            column[0].append(timestamp)
+            column[1].append(value)
+        stats.frames += 1
+        pending += 1
+        if pending >= CHUNK_FRAMES:
+            yield columns
+            columns = {}
+            pending = 0
+    if columns:
+        yield columns
+
+
+def _archive_chunks(path, stats):
+    reader = ArchiveReader(path)
+    for i in range(len(reader.chunks)):
+        columns = reader.read_chunk(i)
+        # archives keep samples, not frames; count the busiest column instead
+        stats.frames += max((len(t) for name, (t, _) in columns.items()
+                             if reader.columns[name] != TEXT), default=0)
+        yield columns
+
+
+def analyze_session(path):
+    """Summary dict of one recorded session (.trc or .bmsa). Runs in a worker."""
+    stats = SessionStats(path)
+    chunks = _archive_chunks if path.endswith(".bmsa") else _trc_chunks
+    for columns in chunks(path, stats):
+        stats.add_chunk(columns)
+    return stats.summary()
+
+
+def find_sessions(paths):
+    """Expand directories into the session files they contain, sorted."""
+    sessions = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                sessions += [os.path.join(root, f) for f in files
+                             if f.endswith(SESSION_EXTENSIONS)]
+        else:
+            sessions.append(path)
+    return sorted(sessions)
+
+
+def analyze(paths, jobs=None, on_result=None):
+    """
+    Analyze sessions over a process pool. on_result(summary) is called in
+    the parent as each session finishes (not in submission order); a
+    session that fails yields {"path", "error"} instead. Returns all the
+    summaries in path order.
+    """
+    results = {}
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(analyze_session, path): path for path in paths}
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                summary = future.result()
+            except Exception as e:
+                summary = {"path": path, "error": f"{type(e).__name__}: {e}"}
+            results[path] = summary
+            if on_result:
+                on_result(summary)
+    return [results[path] for path in paths]
+
+
+def merge(summaries, spread_limit=SPREAD_LIMIT, temp_limit=TEMP_LIMIT):
+    """Fleet report: totals, extremes and the sessions exceeding the limits."""
+    ok = [s for s in summaries if "error" not in s]
+
+    def extreme(key, pick):
+        values = [s for s in ok if s[key] is not None]
+        return pick(values, key=lambda s: s[key]) if values else None
+
+    alarm_totals = {name: sum(s["alarm_edges"][name] for s in ok) for name in ALARM_SIGNALS}
+    lowest = extreme("cell_min", min)
+    highest = extreme("cell_max", max)
+    hottest = extreme("temp_max", max)
+    return {
+        "sessions": len(summaries),
+        "failed": [s for s in summaries if "error" in s],
+        "frames": sum(s["frames"] for s in ok),
+        "hours": sum(s["duration"] for s in ok) / 3600.0,
+        "alarm_totals": alarm_totals,
+        "lowest_cell": lowest and {"path": lowest["path"], "value": lowest["cell_min"]},
+        "highest_cell": highest and {"path": highest["path"], "value": highest["cell_max"]},
+        "hottest": hottest and {"path": hottest["path"], "value": hottest["temp_max"]},
+        "imbalanced": [s["path"] for s in ok
+                       if s["spread_max"] is not None and s["spread_max"] > spread_limit],
+        "over_temperature": [s["path"] for s in ok
+                             if s["temp_max"] is not None and s["temp_max"] > temp_limit],
+        "with_alarms": [s["path"] for s in ok if any(s["alarm_edges"].values())],
+    }
+
+
+def _fmt(value, spec):
+    return "-" if value is None else format(value, spec)
+
+
+def print_session(summary):
+    if "error" in summary:
+        print(f"{summary['path']}: FAILED ({summary['error']})")
+        return
+    if not summary["frames"]:
+        print(f"{summary['path']}: no BMS frames")
+        return
+    alarms = sum(summary["alarm_edges"].values())
+    print(
+        f"{summary['path']}: SN {summary['serial_number'] or '?'}, "
+        f"{summary['duration'] / 60:.1f} min, cells {_fmt(summary['cell_min'], '.3f')}"
+        f"..{_fmt(summary['cell_max'], '.3f')} V, spread max {_fmt(summary['spread_max'], '.3f')} V, "
+        f"T {_fmt(summary['temp_min'], '.1f')}..{_fmt(summary['temp_max'], '.1f')} °C, "
+        f"{alarms} alarm(s)"
+    )
+
+
+def print_report(report):
+    print()
+    print(f"{report['sessions']} sessions, {report['frames']} frames, {report['hours']:.1f} h")
+    for key, label in (("lowest_cell", "Lowest cell"), ("highest_cell", "Highest cell"),
+                       ("hottest", "Hottest NTC")):
+        if report[key]:
+            print(f"{label:<14}{report[key]['value']:.3f}  {report[key]['path']}")
+    print("Alarm edges:   " + ", ".join(f"{n[6:]}={c}" for n, c in report["alarm_totals"].items()))
+    for key, label in (("imbalanced", "Imbalanced"), ("over_temperature", "Over-temperature"),
+                       ("with_alarms", "With alarms")):
+        print(f"{label} ({len(report[key])}):")
+        for path in report[key]:
+            print(f"  {path}")
+    for failed in report["failed"]:
+        print(f"FAILED {failed['path']}: {failed['error']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Batch analysis of recorded BMS sessions")
+    parser.add_argument("paths", nargs="+", help=".trc / .bmsa files or directories")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="worker processes (default: one per core)")
+    parser.add_argument("--spread-limit", type=float, default=SPREAD_LIMIT)
+    parser.add_argument("--temp-limit", type=float, default=TEMP_LIMIT)
+    parser.add_argument("--json", help="write the sessions and the report to this file")
+    args = parser.parse_args()
+
+    sessions = find_sessions(args.paths)
+    if not sessions:
+        sys.exit("No sessions found.")
+    t_start = time.perf_counter()
+    summaries = analyze(sessions, args.jobs, on_result=print_session)
+    report = merge(summaries, args.spread_limit, args.temp_limit)
+    print_report(report)
+    print(f"Analyzed in {time.perf_counter() - t_start:.1f} s")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"sessions": summaries, "report": report}, f, indent=2)
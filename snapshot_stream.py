@@ -0,0 +1,280 @@
+# snapshot_stream.py
+import os
+import selectors
+import socket
+import tempfile
+import threading
+import time
+
+import msgpack
+
+DEFAULT_SOCKET_PATH = os.path.join(tempfile.gettempdir(), "bms_snapshots.sock")
+
+# Message layout (one msgpack map per message, no extra framing):
+#   {"seq": int, "t": float, "full": bool, "d": {signal: value}}
+# "full" messages carry every known signal and reset the subscriber's view;
+# the others only carry signals that changed (None = no longer valid).
+
+
+class _Subscriber:
+    __slots__ = ("sock", "out", "pending", "dropped")
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.out = b""       # encoded bytes not yet accepted by the socket
+        self.pending = None  # coalesced changes not encoded yet (None = nothing)
+        self.dropped = 0     # deltas merged into a later message
+
+
+class SnapshotPublisher:
+    """
+    Streams decoded BMS values to any number of local processes over a Unix
+    domain socket, as delta-encoded msgpack messages.
+
+    publish() only merges the changes into a dict and wakes the sender
+    thread, so it never blocks the reader. The sender writes non-blocking:
+    while a subscriber still has unsent bytes, new changes are merged into
+    its pending dict (latest value wins) and sent as one message once the
+    socket drains. A slow subscriber therefore skips intermediate values but
+    never loses the latest one, and never slows the others down.
+    """
+
+    def __init__(self, path=DEFAULT_SOCKET_PATH, snapshot=None):
+        """
+        :param path: filesystem path of the Unix socket
+        :param snapshot: callable -> dict with every current signal, sent to
+                         new subscribers (e.g. listener.state.snapshot)
+        """
+        self.path = path
+        self.snapshot = snapshot
+
+        self._lock = threading.Lock()
+        self._changes = {}
+        self._stamp = 0.0
+        self._wake_pending = False
+        self._known = {}  # every value published so far (sender thread only)
+        self._seq = 0
+
+        self._subs = {}
+        self._server = None
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._selector = selectors.DefaultSelector()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.messages_sent = 0
+        self.coalesced = 0
+
+    @property
+    def subscriber_count(self):
+        return len(self._subs)
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)  # stale socket from a previous run
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(self.path)
+        self._server.listen()
+        self._server.setblocking(False)
+        self._selector.register(self._server, selectors.EVENT_READ, "accept")
+        self._selector.register(self._wake_r, selectors.EVENT_READ, "wake")
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        print(f"Snapshot stream published on {self.path}")
+
+    def stop(self):
+        self._stop.set()
+        self._wake()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        for sub in list(self._subs.values()):
+            self._drop(sub)
+        if self._server:
+            self._selector.unregister(self._server)
+            self._server.close()
+            self._server = None
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+    def publish(self, changes, timestamp=None):
+        """
+        Queue changed signals for every subscriber. Cheap and non-blocking,
+        safe to call from the CAN reader thread.
+        """
+        with self._lock:
+            self._changes.update(changes)
+            self._stamp = time.time() if timestamp is None else timestamp
+            if self._wake_pending:
+                return
+            self._wake_pending = True
+        self._wake()
+
+    def _wake(self):
+        try:
+            self._wake_w.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass  # already signalled
+
+    def _run(self):
+        while not self._stop.is_set():
+            for key, mask in self._selector.select(timeout=0.5):
+                if key.data == "accept":
+                    self._accept()
+                elif key.data == "wake":
+                    self._drain_wake()
+                    self._dispatch()
+                else:
+                    sub = key.data
+                    if mask & selectors.EVENT_READ and not self._discard_input(sub):
+                        continue
+                    if mask & selectors.EVENT_WRITE:
+                        self._flush(sub)
+
+    def _accept(self):
+        try:
+            sock, _ = self._server.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        sub = _Subscriber(sock)
+        self._subs[sock.fileno()] = sub
+        self._selector.register(sock, selectors.EVENT_READ, sub)
+
+        full = dict(self._known)
+        if self.snapshot is not None:
+            full.update(self.snapshot())
+        self._send(sub, full, full=True)
+
+    def _drain_wake(self):
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _dispatch(self):
+        with self._lock:
+            changes = self._changes
+            stamp = self._stamp
+            self._changes = {}
+            self._wake_pending = False
+        if not changes:
+            return
+        self._known.update(changes)
+        for sub in list(self._subs.values()):
+            if sub.out:
+                # still busy: coalesce, latest value wins
+                if sub.pending is None:
+                    sub.pending = dict(changes)
+                else:
+                    sub.pending.update(changes)
+                    sub.dropped += 1
+                    self.coalesced += 1
+            else:
+                self._send(sub, changes, stamp=stamp)
+
+    def _send(self, sub, values, full=False, stamp=None):
+        self._seq += 1
+        sub.out = msgpack.packb({
+            "seq": self._seq,
+            "t": time.time() if stamp is None else stamp,
+            "full": full,
+            "d": values,
+        })
+        self._flush(sub)
+
+    def _flush(self, sub):
+        try:
+            sent = sub.sock.send(sub.out)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self._drop(sub)
+            return
+        sub.out = sub.out[sent:]
+        if sub.out:
+            self._selector.modify(sub.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, sub)
+            return
+
+        self.messages_sent += 1
+        self._selector.modify(sub.sock, selectors.EVENT_READ, sub)
+        if sub.pending is not None:
+            pending = sub.pending
+            sub.pending = None
+            self._send(sub, pending)
+
+    def _discard_input(self, sub):
+        """Subscribers never send anything; reading only detects hang-ups."""
+        try:
+            data = sub.sock.recv(4096)
+        except BlockingIOError:
+            return True
+        except OSError:
+            data = b""
+        if not data:
+            self._drop(sub)
+            return False
+        return True
+
+    def _drop(self, sub):
+        self._subs.pop(sub.sock.fileno(), None)
+        try:
+            self._selector.unregister(sub.sock)
+        except (KeyError, ValueError):
+            pass
+        sub.sock.close()
+
+
+class SnapshotSubscriber:
+    """
+    Client side of SnapshotPublisher. Iterating yields the reconstructed
+    {signal: value} dict after every message received:
+
+        for values in SnapshotSubscriber():
+            print(values.get("cell1"))
+    """
+
+    def __init__(self, path=DEFAULT_SOCKET_PATH, timeout=None):
+        self.path = path
+        self.values = {}
+        self.seq = None
+        self.timestamp = None
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        self._sock.connect(path)
+        self._unpacker = msgpack.Unpacker(raw=False, strict_map_key=False)
+
+    def close(self):
+        self._sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self):
+        while True:
+            data = self._sock.recv(65536)
+            if not data:
+                return
+            self._unpacker.feed(data)
+            for message in self._unpacker:
+                self._apply(message)
+                yield self.values
+
+    def _apply(self, message):
+        if message["full"]:
+            self.values = {}
+        for name, value in message["d"].items():
+            if value is None:
+                self.values.pop(name, None)
+            else:
+                self.values[name] = value
+        self.seq = message["seq"]
+        self.timestamp = message["t"]
@@ -0,0 +1,283 @@
+# soak.py
+import argparse
+import random
+import sys
+import time
+import traceback
+import tracemalloc
+
+from PCANBasic import TPCANMsg, TPCANMsgFD, PCAN_MESSAGE_EXTENDED, PCAN_MESSAGE_FD
+from alarm_rules import Rule
+from bms_state import FD_DLC_LEN, FD_MEASUREMENT_ID, FRAME_SIGNALS
+from data_handler import BMSPcanListener
+from metrics import Registry
+from profiling import HdrHistogram
+
+BMS_IDS = tuple(FRAME_SIGNALS)
+CYCLE = (0x200, 0x201, 0x202, 0x203, 0x204, 0x205, 0x206)
+# (cells, NTCs) reported by the FD measurement frame; one per run, as a
+# real pack keeps its layout (a new one resizes the listener's state)
+FD_LAYOUTS = ((13, 3), (14, 4), (16, 4))
+
+# Pass/fail gates (see run())
+MIN_HEADROOM = 1.0       # decode throughput / bus frame rate
+MAX_LATENCY_DRIFT = 1.5  # p99 latency of the last window / first window
+MAX_GROWTH = 32 * 1024   # traced bytes gained over half a probe
+PROBE_FRAMES = 200000     # frames per tracemalloc probe
+
+SOAK_RULES = [
+    Rule("Cell undervoltage", "cell_min", "<", 3.0, hysteresis=0.05, delay=0.5),
+    Rule("Cell overvoltage", "cell_max", ">", 4.25, hysteresis=0.05, delay=0.5),
+    Rule("NTC delta", "ntc_spread", ">", 8.0, hysteresis=1.0, delay=1.0),
+]
+
+
+def frame_bits(length, fd=False):
+    """
+    Approximate bits on the wire for a standard-ID frame: 47 bits of
+    overhead plus the payload, +10 % for bit stuffing. CAN FD data-phase
+    bits are counted at the nominal rate, which overestimates their time.
+    """
+    return int((47 + 8 * length) * 1.1) if not fd else int((67 + 8 * length) * 1.1)
+
+
+def _valid_payload(rng, can_id, layout):
+    if can_id in (0x200, 0x201, 0x202):
+        return b"".join(rng.randint(3500, 4100).to_bytes(2, "big") for _ in range(4))
+    if can_id == 0x203:
+        return bytes(3) + rng.randint(3500, 4100).to_bytes(2, "big") + bytes(3)
+    if can_id == 0x204:
+        return bytes(2) + b"".join(rng.randint(1500, 2500).to_bytes(2, "big") for _ in range(3))
+    if can_id == 0x205:
+        return b"".join(rng.randint(3000, 50000).to_bytes(2, "big") for _ in range(4))
+    if can_id == 0x206:
+        return bytes(rng.choice((0, 0, 0, 1, 2)) for _ in range(3)) + bytes(5)
+    if can_id == 0x300:
+        return bytes.fromhex("0102030405060708")
+    if can_id == 0x301:
+        return bytes((0, 0, 0, 1, 2, 3, 4, 5))
+    # FD measurement: N cells, M NTCs
+    cells, ntc = layout
+    payload = bytes((cells, ntc)) + b"".join(
+        rng.randint(3500, 4100).to_bytes(2, "big") for _ in range(cells + ntc))
+    return payload + bytes(64 - len(payload))
+
+
+def make_frames(count, fuzz=0.3, fd=False, seed=0):
+    """
+    A pool of `count` messages: mostly well-formed measurement cycles, and a
+    `fuzz` share of malformed ones (random DLC, unknown / extended IDs,
+    corrupted and truncated payloads, FD frames with wild counts). The FD
+    frames report one of FD_LAYOUTS, picked from the seed.
+    """
+    rng = random.Random(seed)
+    layout = rng.choice(FD_LAYOUTS)
+    frames = []
+    cycle = list(CYCLE) + ([FD_MEASUREMENT_ID] if fd else [])
+    while len(frames) < count:
+        for can_id in cycle + [rng.choice((0x300, 0x301))]:
+            data = _valid_payload(rng, can_id, layout)
+            extended = False
+            if rng.random() < fuzz:
+                kind = rng.randrange(5)
+                if kind == 0:    # truncated or padded
+                    data = data[:rng.randrange(len(data) + 1)]
+                elif kind == 1:  # corrupted bytes
+                    data = bytes(rng.randrange(256) for _ in data)
+                elif kind == 2:  # unknown standard ID
+                    can_id = rng.randrange(0x800)
+                elif kind == 3:  # extended ID, possibly aliasing a BMS ID
+                    can_id = rng.choice((rng.randrange(1 << 29), rng.choice(BMS_IDS)))
+                    extended = True
+                else:            # random DLC and random content
+                    size = rng.choice(FD_DLC_LEN if fd else range(9))
+                    data = bytes(rng.randrange(256) for _ in range(size))
+            frames.append(_message(can_id, data, fd, extended))
+    return frames[:count]
+
+
+def _message(can_id, data, fd, extended):
+    if fd:
+        msg = TPCANMsgFD()
+        msg.DLC = next(i for i, n in enumerate(FD_DLC_LEN) if n >= len(data))
+        msg.MSGTYPE = PCAN_MESSAGE_FD.value
+        data = data + bytes(FD_DLC_LEN[msg.DLC] - len(data))
+    else:
+        data = data[:8]
+        msg = TPCANMsg()
+        msg.LEN = len(data)
+    if extended:
+        msg.MSGTYPE |= PCAN_MESSAGE_EXTENDED.value
+    msg.ID = can_id
+    for i, b in enumerate(data):
+        msg.DATA[i] = b
+    return msg
+
+
+def run(bitrate=500000, hours=1.0, fuzz=0.3, fd=False, windows=12, pool=65536, seed=0,
+        trace_memory=True, out=print):
+    """
+    Soak the decode path (BMSPcanListener._handle_message, with rules and an
+    on_update callback) for `hours` of simulated bus time at the frame rate
+    of a saturated `bitrate` bus. The listener runs on a simulated clock
+    advanced by each frame's wire time, so rule delays and staleness behave
+    as on the bus while the run only takes as long as decoding does.
+
+    Memory is checked with tracemalloc probes after warm-up and at the end
+    (tracing the whole soak would slow it ~10x). A probe traces two halves
+    of PROBE_FRAMES frames: what is still allocated from the first half is
+    the decoder's working set (e.g. pending stale timers), and only a leak
+    keeps growing during the second half.
+
+    Gates: no decode exception, decode throughput >= bus frame rate, p99
+    latency drift between the first and last window, memory growth in
+    either probe. Returns (passed, report dict).
+    """
+    frames = make_frames(pool, fuzz, fd, seed)
+    durations = [frame_bits(FD_DLC_LEN[m.DLC] if fd else m.LEN, fd) / bitrate for m in frames]
+    bus_rate = len(frames) / sum(durations)
+    per_window = max(1, int(hours * 3600 * bus_rate) // windows)
+
+    updates = [0]
+
+    def on_update(bms_data):
+        updates[0] += 1
+
+    listener = BMSPcanListener(on_update=on_update, rules=SOAK_RULES, registry=Registry())
+    handle = listener._handle_message
+    poll = listener.assembler.poll
+    errors = {}
+
+    # The listener counts and swallows decode exceptions; record them first
+    decode_payload = listener.decode_payload
+
+    def checked_decode(can_id, data, now):
+        try:
+            return decode_payload(can_id, data, now)
+        except Exception as e:
+            key = (can_id, type(e).__name__)
+            if key not in errors:
+                errors[key] = [0, traceback.format_exc(limit=-3), data]
+            errors[key][0] += 1
+            raise
+
+    listener.decode_payload = checked_decode
+    clock = [time.monotonic()]
+    listener.clock = lambda: clock[0]
+    position = [0]
+
+    def drive(count, latency=None):
+        """Feed `count` frames; returns the wall time it took."""
+        i = position[0]
+        size = len(frames)
+        t_start = time.perf_counter()
+        for _ in range(count):
+            clock[0] += durations[i]
+            if latency is None:
+                poll(clock[0])
+                handle(frames[i])
+            else:
+                t0 = time.perf_counter_ns()
+                poll(clock[0])
+                handle(frames[i])
+                latency.record(time.perf_counter_ns() - t0)
+            i = i + 1 if i + 1 < size else 0
+        position[0] = i
+        return time.perf_counter() - t_start
+
+    def probe():
+        """Traced bytes growth over the second half of a probe, and its top sites."""
+        tracemalloc.start()
+        drive(PROBE_FRAMES // 2)
+        half = tracemalloc.get_traced_memory()[0]
+        before = tracemalloc.take_snapshot()
+        drive(PROBE_FRAMES // 2)
+        growth = tracemalloc.get_traced_memory()[0] - half
+        top = [str(stat) for stat in
+               tracemalloc.take_snapshot().compare_to(before, "lineno")[:5]]
+        tracemalloc.stop()
+        return growth, top
+
+    drive(min(per_window, PROBE_FRAMES))  # warm-up: caches, metric children, ring buffers
+    first_growth = probe()[0] if trace_memory else 0
+
+    window_stats = []
+    wall = 0.0
+    for w in range(windows):
+        latency = HdrHistogram()
+        elapsed = drive(per_window, latency)
+        wall += elapsed
+        s = latency.summary()
+        window_stats.append({"rate": per_window / elapsed, "p99_us": s["p99_ns"] / 1e3})
+        out(f"  window {w + 1}/{windows}: {per_window / elapsed:,.0f} frames/s, "
+            f"p50 {s['p50_ns'] / 1e3:.1f} µs, p99 {s['p99_ns'] / 1e3:.1f} µs")
+
+    last_growth, top = probe() if trace_memory else (0, [])
+
+    # per-frame timing inflates latency equally in every window; drift is a ratio
+    throughput = per_window * windows / wall
+    first, last = window_stats[0]["p99_us"], window_stats[-1]["p99_us"]
+    report = {
+        "bitrate": bitrate,
+        "fd": fd,
+        "simulated_hours": hours,
+        "frames": per_window * windows,
+        "bus_frame_rate": bus_rate,
+        "throughput": throughput,
+        "headroom": throughput / bus_rate,
+        "latency_drift": last / first if first else 1.0,
+        "memory_growth": max(first_growth, last_growth),
+        "errors": {f"0x{can_id:X} {name}": v for (can_id, name), v in errors.items()},
+        "updates": updates[0],
+        "top_allocations": top,
+    }
+    gates = {
+        "no decode errors": not errors,
+        f"headroom >= {MIN_HEADROOM}": report["headroom"] >= MIN_HEADROOM,
+        f"latency drift <= {MAX_LATENCY_DRIFT}": report["latency_drift"] <= MAX_LATENCY_DRIFT,
+    }
+    if trace_memory:
+        gates[f"memory growth <= {MAX_GROWTH // 1024} KiB"] = report["memory_growth"] <= MAX_GROWTH
+    report["gates"] = gates
+    return all(gates.values()), report
+
+
+def print_report(passed, report):
+    print(f"{report['frames']:,} frames ({report['simulated_hours']} h at "
+          f"{report['bus_frame_rate']:,.0f} frames/s), decoded at {report['throughput']:,.0f} frames/s "
+          f"(x{report['headroom']:.2f}), p99 drift x{report['latency_drift']:.2f}, "
+          f"memory growth {report['memory_growth'] / 1024:.1f} KiB per {PROBE_FRAMES // 2:,} frames")
+    for key, (count, tb, data) in report["errors"].items():
+        print(f"  {count} x {key}, e.g. data={data.hex()}\n{tb}")
+    if report["memory_growth"] > MAX_GROWTH:
+        for line in report["top_allocations"]:
+            print(f"  {line}")
+    for gate, ok in report["gates"].items():
+        print(f"  [{'PASS' if ok else 'FAIL'}] {gate}")
+    print("PASSED" if passed else "FAILED")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Saturation / malformed-frame soak of the decoder",
+        epilog="Before a release, run both `python soak.py` and `python soak.py --fd` "
+               "(each at 500 kbit/s and 1 Mbit/s by default).")
+    parser.add_argument("--bitrate", type=int, action="append",
+                        help="bus bit rate (repeatable; default 500000 and 1000000)")
+    parser.add_argument("--hours", type=float, default=1.0, help="simulated hours per run")
+    parser.add_argument("--fuzz", type=float, default=0.3, help="share of malformed frames")
+    parser.add_argument("--fd", action="store_true", help="include 64-byte CAN FD frames")
+    parser.add_argument("--windows", type=int, default=12)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-tracemalloc", action="store_true",
+                        help="skip the tracemalloc probes (no memory gate)")
+    args = parser.parse_args()
+
+    all_passed = True
+    for bitrate in args.bitrate or (500000, 1000000):
+        print(f"Soak at {bitrate // 1000} kbit/s{' (FD)' if args.fd else ''}:")
+        passed, report = run(bitrate, args.hours, args.fuzz, args.fd, args.windows,
+                             seed=args.seed, trace_memory=not args.no_tracemalloc)
+        print_report(passed, report)
+        all_passed &= passed
+    sys.exit(0 if all_passed else 1)
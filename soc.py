@@ -0,0 +1,278 @@
+# soc.py
+import json
+import math
+from array import array
+
+from bms_state import CELL_FRAMES, FD_MEASUREMENT_ID
+
+try:
+    import numpy as np
+except ImportError:  # numpy is only needed for lookup_many() speed-ups
+    np = None
+
+# Generic NMC cell at 25 °C, (SOC %, OCV V). Replace with the cell datasheet
+# curves (one per temperature) through SOCTable.from_dict / from_file.
+DEFAULT_CURVE = (
+    (0, 3.00), (5, 3.35), (10, 3.45), (20, 3.55), (30, 3.62), (40, 3.67),
+    (50, 3.72), (60, 3.79), (70, 3.87), (80, 3.95), (90, 4.05), (100, 4.20),
+)
+
+
+class OCVCurve:
+    """
+    Open-circuit voltage vs state of charge of one cell at one temperature,
+    interpolated linearly. Voltages must increase with SOC.
+    """
+
+    def __init__(self, points, temperature=25.0):
+        """
+        :param points: iterable of (SOC %, OCV volts) pairs
+        :param temperature: temperature of the measurement in °C
+        """
+        pts = sorted((float(v), float(soc)) for soc, v in points)
+        if len(pts) < 2:
+            raise ValueError("An OCV curve needs at least two points")
+        for (v0, s0), (v1, s1) in zip(pts, pts[1:]):
+            if v1 <= v0 or s1 <= s0:
+                raise ValueError(f"OCV curve at {temperature} °C is not strictly increasing")
+        self.temperature = float(temperature)
+        self._ocv = [p[0] for p in pts]
+        self._soc = [p[1] for p in pts]
+
+    def soc_column(self, v_min, step, count):
+        """
+        SOC at v_min, v_min + step, ... (`count` voltages), clamped to the
+        curve's end points. One linear sweep, the grid being sorted.
+        """
+        xs, ys = self._ocv, self._soc
+        out = array("d", bytes(8 * count))
+        j = 0
+        for k in range(count):
+            v = v_min + k * step
+            if v <= xs[0]:
+                out[k] = ys[0]
+                continue
+            while j + 1 < len(xs) and xs[j + 1] < v:
+                j += 1
+            if j + 1 == len(xs):
+                out[k] = ys[-1]
+            else:
+                x0, x1 = xs[j], xs[j + 1]
+                out[k] = ys[j] + (ys[j + 1] - ys[j]) * (v - x0) / (x1 - x0)
+        return out
+
+
+class SOCTable:
+    """
+    (temperature, cell voltage) -> SOC lookup table, precomputed once from
+    OCV curves measured at one or more temperatures:
+
+      - columns: one per `step` volts from v_min to v_max
+      - rows: one per `t_step` °C from t_min to t_max; a row between two
+        measured temperatures blends their curves linearly, outside them the
+        nearest curve is used
+
+    A lookup is a rounding and an index, table[row * columns + column].
+    Voltages and temperatures outside the grid are clamped to its edges.
+    The SOC is only meaningful for a cell at rest (no load for a while).
+    """
+
+    def __init__(self, curves, v_min=2.5, v_max=4.3, step=0.001,
+                 t_min=-20.0, t_max=60.0, t_step=1.0, t_ref=25.0):
+        """
+        :param curves: OCVCurve instances, at least one
+        :param v_min: lowest tabulated voltage in volts
+        :param v_max: highest tabulated voltage in volts
+        :param step: voltage resolution in volts (1 mV, like the BMS frames)
+        :param t_min: lowest tabulated temperature in °C
+        :param t_max: highest tabulated temperature in °C
+        :param t_step: temperature resolution in °C
+        :param t_ref: temperature used when no NTC reading is available
+        """
+        curves = sorted(curves, key=lambda c: c.temperature)
+        if not curves:
+            raise ValueError("A SOC table needs at least one OCV curve")
+        self.v_min = v_min
+        self.step = step
+        self.t_min = t_min
+        self.t_step = t_step
+        self.t_ref = t_ref
+        self.columns = int(round((v_max - v_min) / step)) + 1
+        self.rows = int(round((t_max - t_min) / t_step)) + 1
+        self._per_volt = 1.0 / step
+        self._per_degree = 1.0 / t_step
+
+        columns = [c.soc_column(v_min, step, self.columns) for c in curves]
+        temps = [c.temperature for c in curves]
+        table = array("d")
+        for r in range(self.rows):
+            t = t_min + r * t_step
+            if t <= temps[0]:
+                table.extend(columns[0])
+            elif t >= temps[-1]:
+                table.extend(columns[-1])
+            else:
+                i = next(i for i in range(1, len(temps)) if temps[i] >= t)
+                w = (t - temps[i - 1]) / (temps[i] - temps[i - 1])
+                lo, hi = columns[i - 1], columns[i]
+                table.extend(lo[k] + (hi[k] - lo[k]) * w for k in range(self.columns))
+        self.table = table
+        self._np_table = None
+
+    def row(self, temperature):
+        """Table row for a temperature in °C (t_ref for None / NaN)."""
+        if temperature is None or temperature != temperature:
+            temperature = self.t_ref
+        r = int((temperature - self.t_min) * self._per_degree + 0.5)
+        return 0 if r < 0 else (self.rows - 1 if r >= self.rows else r)
+
+    def lookup(self, voltage, temperature=None):
+        """SOC in % of one cell."""
+        c = int((voltage - self.v_min) * self._per_volt + 0.5)
+        c = 0 if c < 0 else (self.columns - 1 if c >= self.columns else c)
+        return self.table[self.row(temperature) * self.columns + c]
+
+    def lookup_many(self, voltages, temperatures=None):
+        """
+        SOC of many cells in one go, e.g. recorded (samples x cells) arrays.
+        `temperatures` broadcasts against `voltages` (one per sample, per
+        cell or a scalar); NaN temperatures use t_ref. Returns a numpy array
+        when numpy is available, else a flat array('d') (both arguments then
+        flat sequences, or a scalar / None temperature).
+        """
+        if np is not None:
+            if self._np_table is None:
+                self._np_table = np.frombuffer(self.table, dtype=np.float64).reshape(
+                    self.rows, self.columns)
+            v = np.asarray(voltages, dtype=np.float64)
+            c = np.clip(np.rint((v - self.v_min) * self._per_volt), 0, self.columns - 1)
+            t = np.asarray(self.t_ref if temperatures is None else temperatures, dtype=np.float64)
+            t = np.where(np.isnan(t), self.t_ref, t)
+            r = np.clip(np.rint((t - self.t_min) * self._per_degree), 0, self.rows - 1)
+            r, c = np.broadcast_arrays(r.astype(np.intp), c.astype(np.intp))
+            return self._np_table[r, c]
+        if temperatures is None or isinstance(temperatures, (int, float)):
+            return array("d", [self.lookup(v, temperatures) for v in voltages])
+        return array("d", [self.lookup(v, t) for v, t in zip(voltages, temperatures)])
+
+    @classmethod
+    def from_dict(cls, config):
+        """
+        Build a table from a dict, e.g.
+
+            {"curves": [{"temperature": 0, "points": [[0, 2.95], ..., [100, 4.18]]},
+                        {"temperature": 25, "points": [[0, 3.0], ..., [100, 4.2]]}],
+             "v_min": 2.5, "v_max": 4.3}
+        """
+        config = dict(config)
+        curves = [OCVCurve(c["points"], c.get("temperature", 25.0)) for c in config.pop("curves")]
+        return cls(curves, **config)
+
+    @classmethod
+    def from_file(cls, path):
+        """Load a table definition (see from_dict) from a JSON file."""
+        with open(path, "r", encoding="utf-8") as f:
+            return cls.from_dict(json.load(f))
+
+
+def default_table():
+    """Generic NMC curve at 25 °C (no temperature compensation)."""
+    return SOCTable([OCVCurve(DEFAULT_CURVE)])
+
+
+class SOCEstimator:
+    """
+    Per-cell and pack state of charge from the cell voltages of a BMSState,
+    updated after every decoded frame like DerivedMetrics:
+
+      - a cell frame re-reads the SOC of the cells it carries
+      - an NTC frame changes the temperatures, so every cell is re-read
+
+    Each cell is compensated with the temperature of its NTC (cell_ntc), or
+    the mean of the valid NTCs. soc_pack is the mean cell SOC, soc_min the
+    cell that empties first; all stay None until every cell was received.
+    """
+
+    def __init__(self, state, table, cell_ntc=None, cell_frames=CELL_FRAMES, ntc_ids=(0x204,)):
+        """
+        :param state: the BMSState to read from (usually listener.state)
+        :param table: a SOCTable
+        :param cell_ntc: NTC index per cell (sensor closest to each cell),
+                         None to use the mean NTC temperature for every cell
+        :param cell_frames: CAN ID -> (first cell, cell count), see DerivedMetrics
+        :param ntc_ids: CAN IDs of the frames carrying NTC readings
+        """
+        n = state.num_cells
+        self.state = state
+        self.table = table
+        self.cell_ntc = cell_ntc
+        self.cell_frames = cell_frames
+        self.ntc_ids = ntc_ids
+        self.cell_soc = array("d", bytes(8 * n))
+        self._all_cells = (1 << n) - 1
+        self._rows = array("l", [table.row(None)]) * n  # table row offset per cell
+
+        self.temperature = None  # mean NTC temperature used, °C
+        self.soc_pack = None
+        self.soc_min = None
+        self.soc_max = None
+
+    def update(self, can_id):
+        cells = self.cell_frames.get(can_id)
+        if can_id in self.ntc_ids or can_id == FD_MEASUREMENT_ID:
+            self._update_rows()
+            cells = (0, self.state.num_cells)
+        if cells is None or cells[0] + cells[1] > self.state.num_cells:
+            return
+        self._update_cells(*cells)
+
+    def _update_rows(self):
+        state = self.state
+        table = self.table
+        columns = table.columns
+        valid = [state.ntc[i] for i in range(state.num_ntc) if state.ntc_valid >> i & 1]
+        self.temperature = math.fsum(valid) / len(valid) if valid else None
+        mean_row = table.row(self.temperature) * columns
+        rows = self._rows
+        for i in range(len(rows)):
+            if self.cell_ntc is not None and i < len(self.cell_ntc):
+                k = self.cell_ntc[i]
+                if k < state.num_ntc and state.ntc_valid >> k & 1:
+                    rows[i] = table.row(state.ntc[k]) * columns
+                    continue
+            rows[i] = mean_row
+
+    def _update_cells(self, first, count):
+        state = self.state
+        table = self.table
+        lut = table.table
+        v_min = table.v_min
+        per_volt = table._per_volt
+        last = table.columns - 1
+        voltages = state.voltages
+        rows = self._rows
+        soc = self.cell_soc
+        for i in range(first, first + count):
+            c = int((voltages[i] - v_min) * per_volt + 0.5)
+            soc[i] = lut[rows[i] + (0 if c < 0 else (last if c > last else c))]
+
+        if state.cell_valid != self._all_cells:
+            return
+        self.soc_pack = math.fsum(soc) / len(soc)
+        self.soc_min = min(soc)
+        self.soc_max = max(soc)
+
+    def cell(self, index):
+        """SOC of one cell in %, or None if its voltage was never received."""
+        if self.state.cell_valid >> index & 1:
+            return self.cell_soc[index]
+        return None
+
+    def as_dict(self):
+        return {
+            "pack": self.soc_pack,
+            "min": self.soc_min,
+            "max": self.soc_max,
+            "temperature": self.temperature,
+            "cells": [self.cell(i) for i in range(len(self.cell_soc))],
+        }
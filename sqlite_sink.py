@@ -0,0 +1,313 @@
+# sqlite_sink.py
+import argparse
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+
+from metrics import REGISTRY, Registry
+from profiling import HdrHistogram
+
+DEFAULT_MAX_QUEUE = 65536  # frames waiting for the writer before new ones are dropped
+DEFAULT_BATCH = 4096       # frames per transaction at most
+DEFAULT_MAX_LATENCY = 0.5  # seconds a frame may wait before it is committed
+
+# Narrow, time-indexed layout: one row per (time, signal) sample, signal
+# names interned in their own table. value has no declared type, so text
+# signals (serial number, versions) sit next to the numbers; None is NULL.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS signals (
+    id   INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS samples (
+    t      REAL NOT NULL,
+    signal INTEGER NOT NULL REFERENCES signals(id),
+    value
+);
+CREATE INDEX IF NOT EXISTS samples_signal_t ON samples (signal, t);
+CREATE INDEX IF NOT EXISTS samples_t ON samples (t);
+CREATE VIEW IF NOT EXISTS signal_values AS
+    SELECT samples.t AS t, signals.name AS signal, samples.value AS value
+    FROM samples JOIN signals ON signals.id = samples.signal;
+"""
+INSERT_SAMPLE = "INSERT INTO samples (t, signal, value) VALUES (?, ?, ?)"
+
+
+class SQLiteSink:
+    """
+    Writes decoded signals to an SQLite database for SQL queries, e.g.
+
+        SELECT t, value FROM signal_values
+        WHERE signal = 'cell7' AND t BETWEEN ? AND ?
+
+    append() has the archive / history API and only puts the frame's
+    {signal: value} dict on a bounded queue, so it is cheap enough for the
+    CAN reader thread; when the queue is full the frame is dropped and
+    counted instead of blocking the reader. A dedicated thread owns the
+    connection and writes the queue out with one prepared INSERT
+    (executemany) per transaction, at most `batch` frames each, committing
+    at least every `max_latency` seconds. The database runs in WAL mode, so
+    other processes can query it while it is being written.
+    """
+
+    def __init__(self, path, max_queue=DEFAULT_MAX_QUEUE, batch=DEFAULT_BATCH,
+                 max_latency=DEFAULT_MAX_LATENCY, registry=REGISTRY):
+        """
+        :param path: database file, created if needed (appended to otherwise)
+        :param max_queue: frames buffered for the writer before dropping
+        :param batch: largest number of frames written in one transaction
+        :param max_latency: longest time in seconds a frame waits to be written
+        :param registry: metrics.Registry receiving the sink metrics
+        """
+        self.path = path
+        self.max_queue = max_queue
+        self.batch = batch
+        self.max_latency = max_latency
+
+        self.queued = 0    # frames accepted by append()
+        self.frames = 0    # frames written
+        self.failed = 0    # frames lost to database errors
+        self.rows = 0      # samples written
+        self.dropped = 0   # frames dropped on a full queue
+        self.commits = 0
+        self.commit_ns = HdrHistogram()
+
+        self._queue = deque()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._error = None
+        self._ids = {}  # signal name -> id, writer thread only
+
+        self._m_depth = registry.gauge(
+            "bms_sql_queue_depth", "Frames waiting for the SQLite writer")
+        self._m_rows = registry.counter(
+            "bms_sql_rows_total", "Samples written to the SQLite database")
+        self._m_dropped = registry.counter(
+            "bms_sql_dropped_total", "Frames dropped because the SQLite queue was full")
+        self._m_commit = registry.histogram(
+            "bms_sql_commit_seconds", "Time spent writing and committing one transaction")
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def start(self):
+        """Open the database and start the writer thread."""
+        ready = threading.Event()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(ready,), daemon=True,
+                                        name="sqlite-sink")
+        self._thread.start()
+        ready.wait()
+        if self._error is not None:
+            raise self._error
+
+    def append(self, timestamp, values):
+        """
+        Queue {signal: value} at `timestamp` (seconds since the epoch).
+        Never blocks; returns False if the frame was dropped.
+        """
+        queue = self._queue
+        if len(queue) >= self.max_queue:
+            self.dropped += 1
+            self._m_dropped.inc()
+            return False
+        queue.append((timestamp, values))
+        self.queued += 1
+        if len(queue) == self.batch:
+            self._wake.set()
+        return True
+
+    def flush(self, timeout=None):
+        """
+        Wait until every frame queued so far is written (or failed to be).
+        Returns False on timeout.
+        """
+        target = self.queued
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self._wake.set()
+        while self.frames + self.failed < target and self._thread and self._thread.is_alive():
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def close(self):
+        """Write what is still queued, then stop the writer and close the database."""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._wake.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self, ready):
+        try:
+            db = self._connect()
+        except sqlite3.Error as e:
+            self._error = e
+            ready.set()
+            return
+        ready.set()
+        try:
+            while True:
+                self._wake.wait(self.max_latency)
+                self._wake.clear()
+                stopping = self._stop.is_set()
+                while self._queue:
+                    frames = self._take()
+                    try:
+                        self._write(db, frames)
+                    except sqlite3.Error as e:
+                        # e.g. disk full: lose this batch, keep the reader unaffected
+                        if db.in_transaction:
+                            db.rollback()
+                        self._ids = self._load_ids(db)  # names added by the batch are gone
+                        self.failed += len(frames)
+                        if self._error is None:
+                            print(f"SQLite sink {self.path}: {e}")
+                        self._error = e
+                self._m_depth.set(len(self._queue))
+                if stopping:
+                    break
+        finally:
+            db.close()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, isolation_level=None)  # explicit BEGIN / COMMIT
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")  # durable at checkpoints, safe in WAL mode
+        db.executescript(SCHEMA)
+        self._ids = self._load_ids(db)
+        return db
+
+    @staticmethod
+    def _load_ids(db):
+        return {name: i for i, name in db.execute("SELECT id, name FROM signals")}
+
+    def _take(self):
+        queue = self._queue
+        popleft = queue.popleft
+        return [popleft() for _ in range(min(len(queue), self.batch))]
+
+    def _write(self, db, frames):
+        t_start = time.perf_counter_ns()
+        ids = self._ids
+        rows = []
+        append = rows.append
+        db.execute("BEGIN")
+        for timestamp, values in frames:
+            for name, value in values.items():
+                signal = ids.get(name)
+                if signal is None:
+                    signal = ids[name] = db.execute(
+                        "INSERT INTO signals (name) VALUES (?)", (name,)).lastrowid
+                append((timestamp, signal, value))
+        db.executemany(INSERT_SAMPLE, rows)
+        db.execute("COMMIT")
+        elapsed = time.perf_counter_ns() - t_start
+
+        self.frames += len(frames)
+        self.rows += len(rows)
+        self.commits += 1
+        self.commit_ns.record(elapsed)
+        self._m_rows.inc(len(rows))
+        self._m_commit.observe(elapsed / 1e9)
+
+    def stats(self):
+        """Queue depth, drops and commit times so far."""
+        s = self.commit_ns.summary()
+        return {
+            "queue_depth": len(self._queue),
+            "frames": self.frames,
+            "rows": self.rows,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "commits": self.commits,
+            "commit_p50_ms": s["p50_ns"] / 1e6,
+            "commit_p99_ms": s["p99_ns"] / 1e6,
+            "commit_max_ms": s["max_ns"] / 1e6,
+        }
+
+
+def bench(path, frames=200000, bitrate=500000, fuzz=0.0):
+    """
+    Throughput of the sink against the frame rate of a saturated `bitrate`
+    bus: decode soak.make_frames() traffic, queue the signals each frame
+    changes as fast as possible and time until the last one is committed.
+    """
+    from data_handler import BMSPcanListener
+    from soak import make_frames, frame_bits
+
+    messages = make_frames(min(frames, 65536), fuzz)
+    bus_rate = len(messages) / sum(frame_bits(m.LEN) / bitrate for m in messages)
+    listener = BMSPcanListener(registry=Registry())
+    decoded = []
+    now = time.time()
+    for i in range(frames):
+        msg = messages[i % len(messages)]
+        can_id, data = listener.frame_fields(msg)
+        if listener.decode_payload(can_id, data, now) is not None:
+            decoded.append((now, listener.frame_changes(can_id)))
+        now += 1.0 / bus_rate
+
+    sink = SQLiteSink(path, max_queue=len(decoded), registry=Registry())
+    with sink:
+        t_start = time.perf_counter()
+        for timestamp, values in decoded:
+            sink.append(timestamp, values)
+        sink.flush()
+        elapsed = time.perf_counter() - t_start
+    result = sink.stats()
+    result["bus_frame_rate"] = bus_rate
+    result["frames_per_second"] = result["frames"] / elapsed
+    result["rows_per_second"] = result["rows"] / elapsed
+    result["headroom"] = result["frames_per_second"] / bus_rate
+    return result
+
+
+def record(path, seconds=None, **listener_kwargs):
+    """Record live traffic into a database until `seconds` elapse or Ctrl+C."""
+    from data_handler import BMSPcanListener
+
+    with SQLiteSink(path) as sink:
+        listener = BMSPcanListener(database=sink, **listener_kwargs)
+        listener.start()
+        try:
+            deadline = None if seconds is None else time.monotonic() + seconds
+            while deadline is None or time.monotonic() < deadline:
+                time.sleep(1.0)
+                s = sink.stats()
+                print(f"{s['rows']} rows, queue {s['queue_depth']}, dropped {s['dropped']}, "
+                      f"commit p99 {s['commit_p99_ms']:.1f} ms")
+        except KeyboardInterrupt:
+            pass
+        finally:
+            listener.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SQLite (WAL) sink for decoded BMS signals")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("record", help="record live traffic into a database")
+    p.add_argument("database")
+    p.add_argument("--seconds", type=float)
+    p = sub.add_parser("bench", help="sink throughput vs a saturated bus")
+    p.add_argument("database")
+    p.add_argument("--frames", type=int, default=200000)
+    p.add_argument("--bitrate", type=int, default=500000)
+    args = parser.parse_args()
+
+    if args.command == "record":
+        record(args.database, args.seconds)
+    else:
+        if os.path.exists(args.database):
+            parser.error(f"{args.database} exists; bench needs a new file")
+        for key, value in bench(args.database, args.frames, args.bitrate).items():
+            print(f"{key:<20}{value:,.3f}" if isinstance(value, float) else f"{key:<20}{value}")
@@ -0,0 +1,81 @@
+# tests/test_alarm_rules.py
+import pytest
+
+from alarm_rules import Rule, RuleEngine, RuleSet
+from bms_state import BMSState
+
+CELL_FRAME = 0x200  # carries cell1..cell4 and cell_min
+
+
+def engine_for(*rules):
+    state = BMSState()
+    events = []
+    return state, RuleEngine(rules, state, on_event=events.append), events
+
+
+def set_cell1(state, volts):
+    state.voltages[0] = volts
+    state.cell_valid |= 1
+
+
+def edges(events):
+    return [(e.rule, e.active) for e in events]
+
+
+def test_hysteresis_keeps_the_rule_active_until_past_the_band():
+    state, engine, events = engine_for(Rule("cell1_low", "cell1", "<", 3.0, hysteresis=0.05))
+    for volts, now in ((3.1, 0.0), (2.99, 1.0), (3.02, 2.0), (2.98, 3.0), (3.049, 4.0)):
+        set_cell1(state, volts)
+        engine.evaluate(CELL_FRAME, now)
+    assert edges(events) == [("cell1_low", True)]
+
+    set_cell1(state, 3.05)
+    engine.evaluate(CELL_FRAME, 5.0)
+    assert edges(events) == [("cell1_low", True), ("cell1_low", False)]
+    assert engine.active == []
+
+
+def test_delay_debounces_the_trip_and_the_clear():
+    state, engine, events = engine_for(
+        Rule("cell1_high", "cell1", ">", 4.2, delay=0.5, clear_delay=1.0))
+    set_cell1(state, 4.25)
+    engine.evaluate(CELL_FRAME, 0.0)
+    engine.evaluate(CELL_FRAME, 0.4)
+    set_cell1(state, 4.1)  # a dip restarts the trip delay
+    engine.evaluate(CELL_FRAME, 0.45)
+    set_cell1(state, 4.25)
+    engine.evaluate(CELL_FRAME, 0.6)
+    engine.evaluate(CELL_FRAME, 1.0)
+    assert events == []
+    engine.evaluate(CELL_FRAME, 1.1)
+    assert edges(events) == [("cell1_high", True)]
+    assert events[0].timestamp == 1.1
+
+    set_cell1(state, 4.0)
+    engine.evaluate(CELL_FRAME, 2.0)
+    engine.evaluate(CELL_FRAME, 2.9)
+    assert len(events) == 1
+    engine.evaluate(CELL_FRAME, 3.0)
+    assert edges(events)[-1] == ("cell1_high", False)
+
+
+def test_only_rules_of_the_frame_are_evaluated():
+    state, engine, _ = engine_for(Rule("cell1_low", "cell1", "<", 3.0))
+    set_cell1(state, 2.5)
+    assert engine.evaluate(0x201, 0.0) == []  # cells 5..8 only
+    assert edges(engine.evaluate(CELL_FRAME, 0.0)) == [("cell1_low", True)]
+
+
+def test_signals_never_received_do_not_trip():
+    state, engine, events = engine_for(Rule("cell1_low", "cell1", "<", 3.0))
+    engine.evaluate(CELL_FRAME, 0.0)  # voltages[0] is 0.0 but not valid
+    assert events == []
+
+
+def test_ruleset_refuses_unknown_signals_and_duplicate_names():
+    with pytest.raises(ValueError):
+        RuleSet([Rule("x", "no_such_signal", "<", 1.0)])
+    with pytest.raises(ValueError):
+        RuleSet([Rule("x", "cell1", "<", 1.0), Rule("x", "cell2", "<", 1.0)])
+    with pytest.raises(ValueError):
+        Rule("x", "cell1", "==", 1.0)
@@ -0,0 +1,65 @@
+# tests/test_anomaly_detector.py
+import random
+
+import pytest
+
+import anomaly_detector
+from anomaly_detector import AnomalyDetector
+
+
+def cycles(num_packs, num_cells, steps, seed=0):
+    """Noisy packs in which cell 3 of pack 0 starts to drift down halfway."""
+    rng = random.Random(seed)
+    for n in range(steps):
+        rows = []
+        for p in range(num_packs):
+            row = [3.7 + rng.gauss(0.0, 0.002) for _ in range(num_cells)]
+            if p == 0 and n >= steps // 2:
+                row[3] -= 0.001 * (n - steps // 2)
+            if rng.random() < 0.05:
+                row[rng.randrange(num_cells)] = float("nan")
+            rows.append(row)
+        yield rows
+
+
+def flat(grid):
+    return [x for row in grid for x in (flat(row) if isinstance(row, list) else (row,))]
+
+
+def test_resizing_one_pack_keeps_the_others():
+    detector = AnomalyDetector(num_packs=2, num_cells=4, warmup=1)
+    for rows in cycles(2, 4, 20):
+        detector.step(rows, 0.0)
+    kept = [float(m) for m in detector.mean[1]]
+    counts = [int(c) for c in detector.count[1]]
+
+    detector.resize(6, pack=0)
+    assert detector.pack_cells == [6, 4]
+    assert [int(c) for c in detector.count[0]] == [0] * 6
+    assert [float(m) for m in detector.mean[1]][:4] == kept
+    assert [int(c) for c in detector.count[1]] == counts + [0, 0]
+
+    detector.observe(0, [3.7] * 6, 1.0)
+    detector.observe(1, [3.7] * 4, 1.0)  # both packs reported: one step
+    assert detector.steps == 21
+    assert [int(c) for c in detector.count[1]] == [c + 1 for c in counts] + [0, 0]
+
+
+def test_python_fallback_matches_numpy(monkeypatch):
+    np = pytest.importorskip("numpy")
+    fast = AnomalyDetector(num_packs=2, num_cells=8, confirm=2, warmup=10)
+    monkeypatch.setattr(anomaly_detector, "np", None)
+    slow = AnomalyDetector(num_packs=2, num_cells=8, confirm=2, warmup=10)
+
+    fast_events, slow_events = [], []
+    for n, rows in enumerate(cycles(2, 8, 300)):
+        slow_events += slow.step(rows, n)
+        monkeypatch.setattr(anomaly_detector, "np", np)
+        fast_events += fast.step(rows, n)
+        monkeypatch.setattr(anomaly_detector, "np", None)
+
+    assert [e[:4] for e in slow_events] == [e[:4] for e in fast_events]
+    assert any(e.cell == 3 and e.kind == "drift" for e in fast_events)
+    assert [e.z for e in slow_events] == pytest.approx([e.z for e in fast_events])
+    for name in ("mean", "var", "z"):
+        assert flat(getattr(slow, name)) == pytest.approx(np.ravel(getattr(fast, name)).tolist())
@@ -0,0 +1,74 @@
+# tests/test_archive.py
+import math
+
+import pytest
+
+from archive import ArchiveReader, ArchiveWriter, NUMERIC, TEXT
+
+
+def write(path, samples, chunk_seconds=10.0):
+    with ArchiveWriter(str(path), chunk_seconds) as writer:
+        for timestamp, values in samples:
+            writer.append(timestamp, values)
+    return ArchiveReader(str(path))
+
+
+def test_numeric_and_text_columns_round_trip(tmp_path):
+    samples = [(1000.0 + 0.1 * i, {"cell1": 3.5 + 0.001 * i, "cell2": None if i % 7 == 0 else 3.6})
+               for i in range(500)]
+    samples.append((1050.0, {"serial_number": "0102030405060708"}))
+    reader = write(tmp_path / "a.arc", samples)
+
+    assert reader.columns == {"cell1": NUMERIC, "cell2": NUMERIC, "serial_number": TEXT}
+    assert len(reader.chunks) == 6
+    data = reader.read()
+    times, values = data["cell1"]
+    assert list(times) == pytest.approx([t for t, _ in samples[:500]], abs=1e-6)
+    assert list(values) == [v["cell1"] for _, v in samples[:500]]
+    assert [math.isnan(v) for v in data["cell2"][1]] == [i % 7 == 0 for i in range(500)]
+    assert data["serial_number"] == (pytest.approx([1050.0]), ["0102030405060708"])
+
+
+def test_time_range_read(tmp_path):
+    reader = write(tmp_path / "a.arc", [(1000.0 + i, {"x": float(i)}) for i in range(100)])
+    times, values = reader.read(["x"], start=1025.0, end=1034.5)["x"]
+
+    assert list(values) == [float(i) for i in range(25, 35)]
+    assert reader.chunks_between(1025.0, 1034.5) == [2, 3]
+
+
+def test_column_kind_comes_from_the_first_value_that_is_not_none(tmp_path):
+    samples = [(1000.0, {"hw_version": None}), (1020.0, {"hw_version": "2.1"})]
+    reader = write(tmp_path / "a.arc", samples)
+
+    assert reader.columns["hw_version"] == TEXT
+    assert reader.read()["hw_version"][1] == [None, "2.1"]
+
+
+def test_numeric_column_is_promoted_to_text(tmp_path):
+    samples = [(1000.0, {"v": 1.5}), (1020.0, {"v": "n/a"}), (1040.0, {"v": 2.5})]
+    reader = write(tmp_path / "a.arc", samples)
+
+    assert reader.columns["v"] == TEXT
+    assert reader.read()["v"][1] == [1.5, "n/a", 2.5]
+
+
+def test_failed_chunk_is_reported(tmp_path, monkeypatch):
+    writer = ArchiveWriter(str(tmp_path / "a.arc"), chunk_seconds=10.0)
+    write_chunk = writer._write_chunk
+
+    def failing(buffers):
+        if "bad" in buffers:
+            raise OSError("disk full")
+        return write_chunk(buffers)
+
+    monkeypatch.setattr(writer, "_write_chunk", failing)
+    writer.append(1000.0, {"bad": 1.0})
+    writer.append(1020.0, {"good": 2.0})
+    writer.flush()
+    assert writer.failed_chunks == 1
+    with pytest.raises(RuntimeError):
+        writer.close()
+
+    reader = ArchiveReader(str(tmp_path / "a.arc"))
+    assert reader.read()["good"][1][0] == 2.0
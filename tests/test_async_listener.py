@@ -0,0 +1,126 @@
+# tests/test_async_listener.py
+import asyncio
+import os
+from collections import deque
+
+from PCANBasic import (
+    TPCANMsg, PCAN_ERROR_OK, PCAN_ERROR_QRCVEMPTY, PCAN_ERROR_ILLHANDLE, PCAN_ERROR_QOVERRUN,
+    PCAN_RECEIVE_EVENT, PCAN_CHANNEL_CONDITION, PCAN_CHANNEL_AVAILABLE,
+)
+from async_listener import AsyncBMSListener
+from data_handler import BMSPcanListener
+from metrics import Registry
+
+CELLS = bytes.fromhex("0FA00FA10FA20FA3")
+
+
+class FakePCAN:
+    """
+    PCANBasic stand-in: Read() returns the queued results, the receive
+    event is a pipe that is readable while results are queued, and every
+    Initialize() creates a new one (as a re-plugged adapter does).
+    """
+
+    def __init__(self):
+        self.results = deque()
+        self.pipes = []
+        self.initialized = 0
+
+    def push(self, *results):
+        self.results.extend(results)
+        os.write(self.pipes[-1][1], b"x")
+
+    def Initialize(self, channel, baudrate):
+        self.initialized += 1
+        r, w = os.pipe()
+        os.set_blocking(r, False)
+        self.pipes.append((r, w))
+        return PCAN_ERROR_OK
+
+    def Uninitialize(self, channel):
+        return PCAN_ERROR_OK
+
+    def SetValue(self, channel, parameter, value):
+        return PCAN_ERROR_OK
+
+    def GetValue(self, channel, parameter):
+        if parameter.value == PCAN_RECEIVE_EVENT.value:
+            return PCAN_ERROR_OK, self.pipes[-1][0]
+        if parameter.value == PCAN_CHANNEL_CONDITION.value:
+            return PCAN_ERROR_OK, PCAN_CHANNEL_AVAILABLE
+        return PCAN_ERROR_OK, 0
+
+    def GetErrorText(self, status):
+        return PCAN_ERROR_OK, b"error"
+
+    def Read(self, channel):
+        if not self.results:
+            try:
+                os.read(self.pipes[-1][0], 4096)
+            except BlockingIOError:
+                pass
+            return PCAN_ERROR_QRCVEMPTY, None, None
+        result = self.results.popleft()
+        if isinstance(result, TPCANMsg):
+            return PCAN_ERROR_OK, result, None
+        return result, None, None
+
+
+def message(can_id, data):
+    msg = TPCANMsg()
+    msg.ID = can_id
+    msg.LEN = len(data)
+    for i, b in enumerate(data):
+        msg.DATA[i] = b
+    return msg
+
+
+def test_reader_mode_recovers_from_a_replug():
+    async def scenario():
+        listener = BMSPcanListener(registry=Registry())
+        pcan = listener.pcan = FakePCAN()
+        async with AsyncBMSListener(listener) as bms:
+            assert bms.mode == "reader"
+            pcan.push(message(0x200, CELLS), PCAN_ERROR_QOVERRUN, message(0x201, CELLS))
+            await asyncio.sleep(0.05)
+            assert listener.loss.overruns == 1
+            assert listener.health.state == "ok"
+
+            pcan.push(PCAN_ERROR_ILLHANDLE)
+            await asyncio.sleep(0.05)
+            assert listener.health.state == "disconnected"
+            assert listener.health.reopens == 1
+            assert bms._reader_fd == pcan.pipes[-1][0]  # the new fd is watched
+
+            pcan.push(message(0x202, CELLS))
+            await asyncio.sleep(0.05)
+            assert listener.health.state == "ok"
+            assert listener.state.cell_valid == 0xFFF
+
+    asyncio.run(scenario())
+
+
+def test_executor_mode_handles_errors_on_the_loop_thread():
+    async def scenario():
+        listener = BMSPcanListener(registry=Registry())
+        pcan = listener.pcan = FakePCAN()
+        bms = AsyncBMSListener(listener)
+        bms._try_add_reader = lambda: False
+        threads = set()
+        note_error = listener._note_error
+
+        def recording(result):
+            threads.add(asyncio.get_running_loop())
+            return note_error(result)
+
+        listener._note_error = recording
+        async with bms:
+            assert bms.mode == "executor"
+            pcan.push(PCAN_ERROR_QOVERRUN, PCAN_ERROR_ILLHANDLE, message(0x200, CELLS))
+            await asyncio.sleep(0.2)
+            assert threads == {asyncio.get_running_loop()}
+            assert listener.loss.overruns == 1
+            assert listener.health.reopens == 1
+            assert listener.health.state == "ok"
+
+    asyncio.run(scenario())
@@ -0,0 +1,79 @@
+# tests/test_can_bus_listener.py
+import time
+
+import pytest
+
+can = pytest.importorskip("can")
+
+from can_bus_listener import CanBusListener
+from metrics import Registry
+
+CELL_FRAMES = {
+    0x200: bytes.fromhex("0FA30FA20FA10FA0"),  # cells 4..1: 4.003 .. 4.000 V
+    0x201: bytes.fromhex("0FA70FA60FA50FA4"),
+    0x202: bytes.fromhex("0FAB0FAA0FA90FA8"),
+    0x203: bytes.fromhex("0000000FAC000000"),  # cell 13: 4.012 V
+}
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.005)
+    return condition()
+
+
+@pytest.fixture
+def bus(request):
+    channel = f"bms-test-{request.node.name}"
+    sender = can.Bus(interface="virtual", channel=channel)
+    yield channel, sender
+    sender.shutdown()
+
+
+def test_cell_frames_are_decoded(bus):
+    channel, sender = bus
+    updates = []
+    listener = CanBusListener("virtual", channel, on_update=updates.append, registry=Registry(),
+                              request_identity=False)
+    listener.start()
+    try:
+        for can_id, data in CELL_FRAMES.items():
+            sender.send(can.Message(arbitration_id=can_id, data=data, is_extended_id=False))
+        # not a BMS frame: an extended ID aliasing 0x200, then one more 0x203
+        sender.send(can.Message(arbitration_id=0x200, data=bytes(8), is_extended_id=True))
+        sender.send(can.Message(arbitration_id=0x203, data=CELL_FRAMES[0x203], is_extended_id=False))
+        assert wait_for(lambda: len(updates) == 5)
+    finally:
+        listener.stop()
+
+    assert listener.state.cell_valid == 0x1FFF
+    voltages = listener.bms_data["voltages"]
+    assert voltages == pytest.approx([4.000 + 0.001 * i for i in range(13)])
+
+
+def test_identity_request_goes_out_as_remote_frames(bus):
+    channel, sender = bus
+    listener = CanBusListener("virtual", channel, registry=Registry(), request_identity=True)
+    listener.start()
+    try:
+        requests = [sender.recv(2.0), sender.recv(2.0)]
+    finally:
+        listener.stop()
+
+    assert [(m.arbitration_id, m.is_remote_frame, m.dlc) for m in requests] == [
+        (0x300, True, 8), (0x301, True, 8)]
+
+
+def test_listen_only_session_has_no_transmit_thread(bus):
+    channel, sender = bus
+    listener = CanBusListener("virtual", channel, registry=Registry(), request_identity=False)
+    listener.start()
+    try:
+        assert listener.tx is None
+        listener.request_identity()  # started on demand
+        assert listener.tx is not None
+        assert sender.recv(2.0).arbitration_id == 0x300
+    finally:
+        listener.stop()
+    assert listener.tx is None
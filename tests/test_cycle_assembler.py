@@ -0,0 +1,63 @@
+# tests/test_cycle_assembler.py
+import pytest
+
+from cycle_assembler import CycleAssembler, CYCLE_IDS, TimerWheel
+
+
+def feed_cycle(assembler, start, period=0.1, skip=()):
+    for i, can_id in enumerate(CYCLE_IDS):
+        if can_id not in skip:
+            assembler.feed(can_id, start + i * period / len(CYCLE_IDS))
+
+
+def test_consecutive_cycles_complete():
+    cycles = []
+    assembler = CycleAssembler(on_cycle=cycles.append)
+    for k in range(20):
+        feed_cycle(assembler, k * 0.1)
+
+    assert [c.seq for c in cycles] == list(range(20))
+    assert assembler.incomplete == 0
+    assert cycles[-1].start == pytest.approx(1.9)
+
+
+def test_rejected_frame_drops_its_cycle():
+    cycles = []
+    assembler = CycleAssembler(on_cycle=cycles.append)
+    feed_cycle(assembler, 0.0, skip=(0x203,))
+    assembler.reject(0x203, 0.05)
+    feed_cycle(assembler, 0.1)
+
+    assert [c.start for c in cycles] == [0.1]
+    assert assembler.incomplete == 1
+
+
+def test_rejected_first_frame_does_not_borrow_from_the_next_cycle():
+    cycles = []
+    assembler = CycleAssembler(on_cycle=cycles.append)
+    assembler.reject(0x200, 0.0)
+    feed_cycle(assembler, 0.0, skip=(0x200,))
+    feed_cycle(assembler, 0.1)
+
+    assert len(cycles) == 1
+    assert set(cycles[0].stamps.values()) == {0.1 + i * 0.1 / 7 for i in range(7)}
+
+
+def test_rejected_frame_does_not_refresh_staleness():
+    stale = []
+    assembler = CycleAssembler(timeout=0.5, on_stale=lambda p, i, s: stale.append((i, s)))
+    assembler.feed(0x205, 0.0)
+    assembler.reject(0x205, 0.4)
+    assembler.poll(0.6)
+
+    assert stale == [(0x205, True)]
+
+
+def test_wheel_holds_one_entry_per_key_and_tick():
+    wheel = TimerWheel(tick=0.01, slots=100)
+    for k in range(1000):  # 1000 reschedules over 11 ticks
+        wheel.schedule("a", 0.5 + k * 0.0001)
+
+    assert sum(len(slot) for slot in wheel._slots) == 11
+    assert wheel.advance(0.55) == []
+    assert wheel.advance(0.61) == ["a"]
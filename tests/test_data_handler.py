@@ -0,0 +1,212 @@
+# tests/test_data_handler.py
+import random
+from array import array
+
+import pytest
+
+from PCANBasic import TPCANMsg
+from alarm_rules import Rule
+from bms_state import BMSState, CELL_FRAMES
+from data_handler import BMSPcanListener
+from derived_metrics import DerivedMetrics
+from metrics import Registry
+from pack_variants import load_variants
+
+CELLS = bytes.fromhex("0FA00FA10FA20FA3")  # 4.000 .. 4.003 V, highest cell first
+
+
+def make_listener(**kwargs):
+    updates = []
+    listener = BMSPcanListener(on_update=updates.append, registry=Registry(), **kwargs)
+    return listener, updates
+
+
+def message(can_id, data):
+    msg = TPCANMsg()
+    msg.ID = can_id
+    msg.LEN = len(data)
+    for i, b in enumerate(data):
+        msg.DATA[i] = b
+    return msg
+
+
+def decoded_state(listener):
+    """State as a dict, without the frame counts of the loss tracker."""
+    state = listener.state.as_dict()
+    del state["loss"]
+    return state
+
+
+def decode_errors(listener):
+    return listener._m_decode_errors._default.value
+
+
+@pytest.mark.parametrize("can_id, data", [
+    (0x200, b"\x0f\xa0"),
+    (0x201, b""),
+    (0x203, b"\x00"),
+    (0x204, bytes(7)),
+    (0x205, bytes(4)),
+    (0x206, b"\x01"),
+    (0x300, b""),
+    (0x301, bytes(7)),
+])
+def test_short_frame_is_rejected(can_id, data):
+    listener, updates = make_listener()
+    before = decoded_state(listener)
+
+    assert listener.decode_payload(can_id, data, 1.0) is None
+    listener._handle_message(message(can_id, data))
+
+    assert updates == []
+    assert decode_errors(listener) == 2
+    assert decoded_state(listener) == before
+
+
+def test_rejected_frame_does_not_reach_the_rolling_window():
+    listener, updates = make_listener()
+    listener._handle_message(message(0x200, CELLS))
+    listener._handle_message(message(0x200, CELLS[:2]))
+
+    assert len(updates) == 1
+    assert list(listener.derived._count[:4]) == [1, 1, 1, 1]
+    assert listener.state.voltages[0] == pytest.approx(4.003)
+
+
+def test_fd_frame_with_wild_counts_is_rejected():
+    listener, _ = make_listener()
+    for data in (b"\x0d", bytes((0, 3)) + bytes(62), bytes((200, 3)) + bytes(62),
+                 bytes((13, 3)) + bytes(10)):
+        assert listener.decode_payload(0x210, data, 1.0) is None
+    assert decode_errors(listener) == 4
+    assert listener.state.num_cells == 13
+
+
+def test_generated_decoders_reject_short_frames(tmp_path):
+    variants = load_variants(cache_dir=str(tmp_path))
+    listener, updates = make_listener(variants=variants)
+    decoder = listener._decoders[0x203]
+
+    assert decoder(b"\x00", listener.state, listener.ntc_table) is False
+    assert listener.decode_payload(0x203, b"\x00", 1.0) is None
+    assert listener.decode_payload(0x200, CELLS, 1.0) == 0x200
+    assert decode_errors(listener) == 1
+
+
+def test_cycle_with_rejected_frames_is_not_complete():
+    cycles = []
+    listener = BMSPcanListener(on_cycle=cycles.append, registry=Registry())
+    for can_id in (0x200, 0x201, 0x202):
+        listener.decode_payload(can_id, CELLS, 1.0)
+    listener.decode_payload(0x203, b"\x00", 1.01)
+    for can_id in (0x204, 0x205, 0x206):
+        listener.decode_payload(can_id, b"", 1.02)
+
+    assert cycles == []
+    assert listener.assembler.completed == 0
+
+
+def test_cells_never_received_have_no_rolling_stats():
+    listener, _ = make_listener()
+    listener.decode_payload(0x200, CELLS, 1.0)
+    derived = listener.bms_data["derived"]
+
+    assert derived["cell_mean"][:4] == pytest.approx([4.003, 4.002, 4.001, 4.000])
+    assert derived["cell_mean"][4:] == [None] * 9
+    assert derived["cell_std"][4:] == [None] * 9
+    assert list(listener.derived._count[4:]) == [0] * 9
+
+
+def test_invalid_cells_of_a_frame_are_not_sampled():
+    state = BMSState()
+    derived = DerivedMetrics(state)
+    state.voltages[0:4] = array("d", [4.0, 4.0, 4.0, 0.0])
+    state.cell_valid = 0b0111
+    derived.update(0x200)
+
+    assert list(derived._count[:4]) == [1, 1, 1, 0]
+    assert derived.as_dict()["cell_mean"][3] is None
+
+
+def test_cell_extremes_match_a_full_scan():
+    rng = random.Random(1)
+    state = BMSState()
+    derived = DerivedMetrics(state)
+    frames = sorted(CELL_FRAMES.items())
+    for n in range(3000):
+        can_id, (first, count) = rng.choice(frames)
+        for i in range(first, first + count):
+            # few distinct values, so the extreme cells often tie or move inwards
+            state.voltages[i] = rng.choice((3.9, 4.0, 4.05, 4.1, 4.2))
+        state.cell_valid |= ((1 << count) - 1) << first
+        if n % 500 == 499:
+            state.cell_valid &= ~(1 << rng.randrange(state.num_cells))  # a cell goes missing
+        derived.update(can_id)
+        if state.cell_valid == (1 << state.num_cells) - 1:
+            assert (derived.cell_min, derived.cell_max) == (min(state.voltages), max(state.voltages))
+            assert derived.cell_spread == derived.cell_max - derived.cell_min
+
+
+IDENTITY_14S = bytes([0, 0, 0, 2, 0, 1, 0, 0])  # 0x301: HW 2.0 selects the 14S variant
+IDENTITY = bytes([0, 0, 0, 1, 0, 1, 0, 0])
+
+
+def test_only_decoded_payloads_are_deduplicated():
+    listener, updates = make_listener()
+    for now in (1.0, 1.1, 1.2):  # short 0x301: parsed and rejected every time
+        assert listener.decode_payload(0x301, bytes(7), now) is None
+    assert decode_errors(listener) == 3
+
+    assert listener.decode_payload(0x301, IDENTITY, 1.3) == 0x301
+    assert listener.decode_payload(0x301, IDENTITY, 1.4) is None  # repeat skipped
+    assert listener.dedup_stats()["0x301"] == {"hits": 1, "misses": 4, "hit_rate": 0.2}
+    assert decode_errors(listener) == 3
+
+
+def test_stale_lists_the_signals_of_the_active_variant(tmp_path):
+    listener, _ = make_listener(variants=load_variants(cache_dir=str(tmp_path)))
+    listener.decode_payload(0x301, IDENTITY_14S, 1.0)
+    assert listener.variant.name == "14S"
+
+    listener._on_stale(0, 0x203, True)  # carries cells 13 and 14 on the 14S pack
+    assert "cell14" in listener.bms_data["stale"]
+
+
+def test_assembler_lists_the_stale_signals_of_the_active_variant(tmp_path):
+    listener, _ = make_listener(variants=load_variants(cache_dir=str(tmp_path)))
+    listener.decode_payload(0x301, IDENTITY_14S, 1.0)
+
+    listener.assembler.feed(0x203, 1.0)
+    listener.assembler.poll(1.0 + 2 * listener.assembler.timeout)
+    assert {"cell13", "cell14"} <= set(listener.assembler.stale_signals())
+
+
+def test_active_rule_survives_a_variant_switch_and_clears(tmp_path):
+    events = []
+    listener, _ = make_listener(variants=load_variants(cache_dir=str(tmp_path)),
+                                rules=[Rule("cell1_high", "cell1", ">", 4.0025)],
+                                on_rule_event=events.append)
+    listener.decode_payload(0x200, CELLS, 1.0)
+    assert [(e.rule, e.active) for e in events] == [("cell1_high", True)]
+
+    listener.decode_payload(0x301, IDENTITY_14S, 1.1)  # resizes the state to 14 cells
+    assert listener.rule_engine.active == ["cell1_high"]
+
+    listener.decode_payload(0x200, bytes.fromhex("0FA00FA10FA20FA0"), 1.2)  # cell1 = 4.000 V
+    assert [(e.rule, e.active) for e in events] == [("cell1_high", True), ("cell1_high", False)]
+    assert listener.rule_engine.active == []
+
+
+def fd_measurement(cells, ntc):
+    payload = bytes((cells, ntc)) + bytes.fromhex("0FA0") * (cells + ntc)
+    return payload + bytes(64 - len(payload))
+
+
+def test_flapping_fd_layout_is_reported_once_per_layout(capsys):
+    listener, _ = make_listener()
+    for i in range(10):
+        listener.decode_payload(0x210, fd_measurement(14, 4) if i % 2 else fd_measurement(9, 1), i)
+
+    assert listener.state.num_cells == 14
+    assert listener._m_resizes._default.value == 10
+    assert capsys.readouterr().out.count("resizing state") == 2
@@ -0,0 +1,141 @@
+# tests/test_dispatcher.py
+import threading
+import time
+from collections import deque
+
+import pytest
+
+from PCANBasic import TPCANMsg, PCAN_ERROR_OK, PCAN_ERROR_QRCVEMPTY
+from data_handler import BMSPcanListener
+from dispatcher import Dispatcher, EVERY, LATEST, BATCH
+from metrics import Registry
+
+CELLS = bytes.fromhex("0FA00FA10FA20FA3")
+
+
+class FakePCAN:
+    """PCANBasic stand-in: Read() returns the queued frames, Write() succeeds."""
+
+    def __init__(self):
+        self.frames = deque()
+
+    def Initialize(self, channel, baudrate):
+        return PCAN_ERROR_OK
+
+    def Uninitialize(self, channel):
+        return PCAN_ERROR_OK
+
+    def SetValue(self, channel, parameter, value):
+        return PCAN_ERROR_OK
+
+    def GetValue(self, channel, parameter):
+        return PCAN_ERROR_OK, 0
+
+    def Read(self, channel):
+        if not self.frames:
+            return PCAN_ERROR_QRCVEMPTY, None, None
+        return PCAN_ERROR_OK, self.frames.popleft(), None
+
+    def Write(self, channel, msg):
+        return PCAN_ERROR_OK
+
+
+def message(can_id, data):
+    msg = TPCANMsg()
+    msg.ID = can_id
+    msg.LEN = len(data)
+    for i, b in enumerate(data):
+        msg.DATA[i] = b
+    return msg
+
+
+def test_fans_out_by_id_and_signal():
+    dispatcher = Dispatcher(registry=Registry())
+    cells, voltages, everything = [], [], []
+    dispatcher.subscribe(cells.append, ids=(0x200,))
+    dispatcher.subscribe(voltages.append, signals=("pack_voltage",))
+    dispatcher.subscribe(everything.append)
+    dispatcher.start()
+    dispatcher.dispatch(1.0, 0x200, b"a", {"cell1": 4.0})
+    dispatcher.dispatch(2.0, 0x207, b"b", {"pack_voltage": 48.0, "pack_current": 1.5})
+    dispatcher.dispatch(3.0, 0x201, b"c", {"cell5": 4.1})
+    dispatcher.stop()  # delivers what is queued
+
+    assert [item.can_id for item in cells] == [0x200]
+    assert [item.values for item in voltages] == [{"pack_voltage": 48.0}]
+    assert [item.timestamp for item in everything] == [1.0, 2.0, 3.0]
+
+
+def test_latest_merges_and_batch_groups():
+    dispatcher = Dispatcher(registry=Registry())
+    latest, batches = [], []
+    gate = threading.Event()
+
+    def slow(item):
+        gate.wait()
+        latest.append(item)
+
+    sub = dispatcher.subscribe(slow, policy=LATEST)
+    dispatcher.subscribe(batches.append, policy=BATCH, batch=2, interval=10.0)
+    dispatcher.start()
+    for i in range(5):
+        dispatcher.dispatch(float(i), 0x207, b"", {"pack_voltage": 48.0 + i, f"s{i}": i})
+        time.sleep(0.02)
+    gate.set()
+    dispatcher.stop()
+
+    merged = latest[-1].values
+    assert merged["pack_voltage"] == 52.0
+    assert all(f"s{i}" in merged for i in range(1, 5))
+    assert sub.delivered == 5 and sub.merged == 5 - len(latest)
+    assert [len(b) for b in batches] == [2, 2, 1]
+
+
+def test_every_drops_on_a_full_queue():
+    dispatcher = Dispatcher(registry=Registry())
+    gate = threading.Event()
+    sub = dispatcher.subscribe(lambda item: gate.wait(), policy=EVERY, maxsize=2)
+    dispatcher.start()
+    for i in range(6):
+        dispatcher.dispatch(float(i), 0x200, b"", {"cell1": i})
+        time.sleep(0.02)
+    gate.set()
+    dispatcher.stop()
+    assert sub.dropped > 0
+    assert sub.delivered + sub.dropped == 6
+
+
+def test_dispatch_without_start_raises():
+    dispatcher = Dispatcher(registry=Registry())
+    with pytest.raises(RuntimeError):
+        dispatcher.dispatch(0.0, 0x200, b"", {})
+
+
+def test_listener_starts_and_stops_the_dispatcher():
+    dispatcher = Dispatcher(registry=Registry())
+    items = []
+    dispatcher.subscribe(items.append, ids=(0x200,))
+    listener = BMSPcanListener(registry=Registry(), dispatcher=dispatcher, request_identity=False)
+    listener.pcan = FakePCAN()
+    listener.start()
+    assert dispatcher.running
+    listener.pcan.frames.append(message(0x200, CELLS))
+    deadline = time.monotonic() + 2.0
+    while listener.state.cell_valid == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    listener.stop()
+
+    assert not dispatcher.running
+    assert [item.can_id for item in items] == [0x200]
+    assert items[0].values["cell1"] == pytest.approx(4.003)
+
+
+def test_listener_leaves_a_running_dispatcher_alone():
+    dispatcher = Dispatcher(registry=Registry())
+    dispatcher.start()
+    listener = BMSPcanListener(registry=Registry(), dispatcher=dispatcher, request_identity=False)
+    listener.pcan = FakePCAN()
+    listener.start()
+    listener.stop()
+    assert dispatcher.running
+    dispatcher.stop()
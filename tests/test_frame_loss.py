@@ -0,0 +1,98 @@
+# tests/test_frame_loss.py
+import pytest
+
+from frame_loss import FrameLossTracker, LossEvent, LEARN_INTERVALS
+
+ID = 0x200
+PERIOD = 0.1
+
+
+def tracker(**kwargs):
+    events = []
+    loss = FrameLossTracker(ids=(ID,), periods={ID: PERIOD}, on_loss=events.append, **kwargs)
+    return loss, events
+
+
+def feed(loss, *times, can_id=ID):
+    return [loss.frame(can_id, t) for t in times]
+
+
+def owed(loss, can_id=ID):
+    return loss._ids[can_id][4]
+
+
+def test_gap_is_settled_by_the_next_normal_interval():
+    loss, events = tracker()
+    feed(loss, 0.0, 0.1, 0.2, 0.5)  # 0.3 s: two frames missing
+    assert events == [] and owed(loss) == 2
+
+    feed(loss, 0.6)
+    assert events == [LossEvent(0.2, ID, 2, "gap")]
+    assert owed(loss) == 0
+    assert (loss.missing, loss.received) == (2, 5)
+    assert loss.ratio() == pytest.approx(2 / 7)
+    assert loss.ratio(ID) == loss.ratio()
+
+
+def test_burst_of_late_frames_repays_the_gap():
+    loss, events = tracker()
+    feed(loss, 0.0, 0.1, 0.2, 0.5)
+    feed(loss, 0.51)  # backlog read late: one frame repaid
+    assert owed(loss) == 1
+    feed(loss, 0.52, 0.62)
+    assert events == [] and loss.missing == 0
+
+
+def test_partly_repaid_gap_counts_the_rest():
+    loss, events = tracker()
+    feed(loss, 0.0, 0.1, 0.2, 0.6, 0.61, 0.71)  # 3 owed, 1 repaid
+    assert events == [LossEvent(0.2, ID, 2, "gap")]
+
+
+def test_long_silence_is_an_outage_without_missing_frames():
+    loss, events = tracker(max_gap=2.0)
+    feed(loss, 0.0, 0.1, 3.1, 3.2)
+    assert events == [LossEvent(0.1, ID, 0, "outage")]
+    assert (loss.outages, loss.missing) == (1, 0)
+
+
+def test_outage_cancels_what_was_owed():
+    loss, events = tracker(max_gap=2.0)
+    feed(loss, 0.0, 0.1, 0.4)
+    assert owed(loss) == 2
+    feed(loss, 3.0, 3.1)
+    assert [e.cause for e in events] == ["outage"]
+    assert loss.missing == 0
+
+
+def test_overrun_during_the_gap_is_blamed():
+    loss, events = tracker()
+    feed(loss, 0.0, 0.1, 0.2)
+    loss.overrun(0.3)
+    feed(loss, 0.5, 0.6)
+    assert events == [LossEvent(0.2, ID, 2, "overrun")]
+    assert loss.overruns == 1
+
+    feed(loss, 0.9, 1.0)  # an older overrun does not explain a later gap
+    assert events[-1].cause == "gap"
+
+
+def test_period_is_learned_from_the_first_intervals():
+    loss = FrameLossTracker(ids=(ID,))
+    times = [i * PERIOD for i in range(LEARN_INTERVALS + 1)]
+    feed(loss, *times)
+    assert loss._ids[ID][1] == pytest.approx(PERIOD)
+
+    t = times[-1]
+    event = feed(loss, t + 4 * PERIOD, t + 5 * PERIOD)[-1]
+    assert event == LossEvent(pytest.approx(t), ID, 3, "gap")
+
+
+def test_untracked_ids_are_ignored_until_tracked():
+    loss, events = tracker()
+    assert feed(loss, 0.0, 0.5, can_id=0x201) == [None, None]
+    assert loss.received == 0
+
+    loss.track((0x201,))
+    feed(loss, *[i * PERIOD for i in range(LEARN_INTERVALS + 1)], can_id=0x201)
+    assert loss.as_dict()["ids"]["0x201"]["received"] == LEARN_INTERVALS + 1
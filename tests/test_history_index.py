@@ -0,0 +1,77 @@
+# tests/test_history_index.py
+import pytest
+
+from history_index import HistoryIndex
+
+SHORT = ((1, 10), (10, 100), (100, None))  # 1 s kept 10 s, 10 s kept 100 s, 100 s forever
+
+
+def brute(samples, start, end):
+    values = [v for t, v in samples if start <= t < end]
+    return min(values), max(values), sum(values) / len(values), len(values)
+
+
+@pytest.fixture
+def two_hours():
+    history = HistoryIndex()
+    samples = [(i * 0.5, float((i * 37) % 101)) for i in range(2 * 3600 * 2)]
+    for t, v in samples:
+        history.add("cell7", t, v)
+    return history, samples
+
+
+def test_query_groups_buckets(two_hours):
+    history, samples = two_hours
+    minutes = history.query("cell7", 0, 7200, bucket=60)
+    assert len(minutes) == 120
+    assert all(s.count == 120 for s in minutes)
+    first = minutes[0]
+    assert (first.min, first.max, first.mean, first.count) == pytest.approx(brute(samples, 0, 60))
+
+    hour = history.query("cell7", 3600, 7200, bucket=3600)
+    assert [s.start for s in hour] == [3600]
+    assert (hour[0].min, hour[0].max, hour[0].mean, hour[0].count) == pytest.approx(
+        brute(samples, 3600, 7200))
+
+
+def test_aggregate_matches_the_raw_samples(two_hours):
+    history, samples = two_hours
+    for start, end in ((0, 7200), (30, 4001), (599, 1201), (7000, 7200)):
+        s = history.aggregate("cell7", start, end)
+        assert (s.min, s.max, s.mean, s.count) == pytest.approx(brute(samples, start, end))
+
+
+def test_unknown_bucket_size_is_refused(two_hours):
+    history, _ = two_hours
+    with pytest.raises(ValueError):
+        history.query("cell7", 0, 60, bucket=0.5)
+
+
+def test_expired_range_falls_back_to_a_coarser_level():
+    history = HistoryIndex(SHORT)
+    for t in range(300):
+        history.add("pack_voltage", t, float(t))
+
+    # 10 s buckets from t=0 are gone: served in 100 s buckets instead
+    old = history.query("pack_voltage", 0, 300, bucket=10)
+    assert [(s.start, s.count, s.mean) for s in old] == [(0, 100, 49.5), (100, 100, 149.5),
+                                                         (200, 100, 249.5)]
+    recent = history.query("pack_voltage", 290, 300, bucket=1)
+    assert [s.start for s in recent] == list(range(290, 300))
+
+    whole = history.aggregate("pack_voltage", 0, 300)
+    assert (whole.min, whole.max, whole.count) == (0, 299, 300)
+    # an expired edge widens to the whole bucket of the level that kept it
+    assert history.aggregate("pack_voltage", 5, 300).count == 300
+    tail = history.aggregate("pack_voltage", 290, 296)
+    assert (tail.min, tail.max, tail.count) == (290, 295, 6)
+
+
+def test_range_dropped_by_every_level_raises():
+    history = HistoryIndex(SHORT[:2])
+    for t in range(300):
+        history.add("pack_voltage", t, float(t))
+    with pytest.raises(ValueError):
+        history.query("pack_voltage", 0, 300, bucket=10)
+    with pytest.raises(ValueError):
+        history.aggregate("pack_voltage", 0, 300)
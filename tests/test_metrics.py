@@ -0,0 +1,76 @@
+# tests/test_metrics.py
+import re
+import urllib.error
+import urllib.request
+
+import pytest
+
+from metrics import MetricsServer, Registry
+
+# Prometheus text format 0.0.4: name{label="value",...} number
+SAMPLE = re.compile(r'([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})? (\S+)$')
+LABEL = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"(?:,|$)')
+SUFFIXES = {"counter": ("",), "gauge": ("",), "histogram": ("_bucket", "_sum", "_count")}
+
+
+def parse(text):
+    """{metric name: (type, help, [(sample name, labels, value)])}; fails on malformed lines."""
+    assert text.endswith("\n")
+    families = {}
+    for line in text.splitlines():
+        if line.startswith("# HELP "):
+            name, help_text = line[7:].split(" ", 1)
+            families[name] = [None, help_text, []]
+        elif line.startswith("# TYPE "):
+            name, kind = line[7:].split(" ")
+            assert kind in SUFFIXES and families[name][0] is None
+            families[name][0] = kind
+        else:
+            match = SAMPLE.match(line)
+            assert match, line
+            sample, labels, value = match.groups()
+            pairs = LABEL.findall(labels or "")
+            assert ",".join(f'{k}="{v}"' for k, v in pairs) == (labels or ""), line
+            family = next(n for n in families if sample in (n + s for s in SUFFIXES[families[n][0]]))
+            families[family][2].append((sample, dict(pairs), float(value)))
+    return {name: tuple(f) for name, f in families.items()}
+
+
+@pytest.fixture
+def server():
+    registry = Registry()
+    server = MetricsServer(registry, port=0)
+    server.start()
+    yield registry, server
+    server.stop()
+
+
+def test_metrics_endpoint_serves_the_text_format(server):
+    registry, server = server
+    registry.counter("bms_frames_total", "Frames decoded", ("id",)).labels("0x200").inc(3)
+    registry.gauge("bms_pack_voltage_volts", "Pack voltage").set(52.25)
+    latency = registry.histogram("bms_decode_seconds", "Decode latency", buckets=(0.001, 0.01))
+    for value in (0.0005, 0.002, 0.5):
+        latency.observe(value)
+    registry.counter("bms_errors_total", "Errors", ("reason",)).labels('bad "crc"\n').inc()
+
+    assert server.port != 0
+    with urllib.request.urlopen(server.url, timeout=5.0) as response:
+        assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+        families = parse(response.read().decode("utf-8"))
+
+    assert families["bms_frames_total"] == ("counter", "Frames decoded",
+                                            [("bms_frames_total", {"id": "0x200"}, 3.0)])
+    assert families["bms_pack_voltage_volts"][2] == [("bms_pack_voltage_volts", {}, 52.25)]
+    kind, _, samples = families["bms_decode_seconds"]
+    assert kind == "histogram"
+    assert [(s[1].get("le"), s[2]) for s in samples] == [
+        ("0.001", 1.0), ("0.01", 2.0), ("+Inf", 3.0), (None, pytest.approx(0.5025)), (None, 3.0)]
+    assert families["bms_errors_total"][2][0][1] == {"reason": 'bad \\"crc\\"\\n'}
+
+
+def test_other_paths_are_not_found(server):
+    _, server = server
+    with pytest.raises(urllib.error.HTTPError) as error:
+        urllib.request.urlopen(server.url.replace("/metrics", "/"), timeout=5.0)
+    assert error.value.code == 404
@@ -0,0 +1,66 @@
+# tests/test_sqlite_sink.py
+import sqlite3
+
+from metrics import Registry
+from sqlite_sink import SQLiteSink
+
+
+def rows(path):
+    with sqlite3.connect(path) as db:
+        return db.execute("SELECT t, signal, value FROM signal_values ORDER BY t, signal").fetchall()
+
+
+def test_frames_are_written_in_batches(tmp_path):
+    path = str(tmp_path / "bms.db")
+    with SQLiteSink(path, batch=2, registry=Registry()) as sink:
+        sink.append(1.0, {"cell1": 4.0, "serial_number": "0102"})
+        sink.append(2.0, {"cell1": 4.1})
+        sink.append(3.0, {"cell1": None})
+        assert sink.flush(timeout=5.0)
+        assert (sink.frames, sink.rows, sink.failed) == (3, 4, 0)
+        assert sink.commits == 2  # 2 + 1 frames
+
+    assert rows(path) == [(1.0, "cell1", 4.0), (1.0, "serial_number", "0102"),
+                          (2.0, "cell1", 4.1), (3.0, "cell1", None)]
+
+    with SQLiteSink(path, registry=Registry()) as sink:  # appends, names are reused
+        sink.append(4.0, {"cell1": 4.2})
+    with sqlite3.connect(path) as db:
+        assert db.execute("SELECT count(*) FROM signals").fetchone() == (2,)
+    assert rows(path)[-1] == (4.0, "cell1", 4.2)
+
+
+def test_full_queue_drops_frames(tmp_path):
+    registry = Registry()
+    sink = SQLiteSink(str(tmp_path / "bms.db"), max_queue=2, registry=registry)
+    assert sink.append(1.0, {"cell1": 4.0})
+    assert sink.append(2.0, {"cell1": 4.0})
+    assert not sink.append(3.0, {"cell1": 4.0})  # writer not started: nothing drains
+    assert (sink.queued, sink.dropped) == (2, 1)
+    assert sink._m_dropped._default.value == 1
+
+    sink.start()
+    sink.close()
+    assert sink.frames == 2
+    assert [t for t, _, _ in rows(sink.path)] == [1.0, 2.0]
+
+
+def test_failed_batch_is_rolled_back_and_the_names_reloaded(tmp_path, capsys):
+    path = str(tmp_path / "bms.db")
+    with SQLiteSink(path, batch=1, registry=Registry()) as sink:
+        sink.append(1.0, {"cell1": 4.0})
+        assert sink.flush(timeout=5.0)
+        # a value SQLite cannot bind fails the batch after "new_signal" was inserted
+        sink.append(2.0, {"new_signal": [1, 2], "cell1": 4.1})
+        assert sink.flush(timeout=5.0)
+        assert sink.failed == 1
+        assert isinstance(sink._error, sqlite3.Error)
+        assert "new_signal" not in sink._ids
+
+        sink.append(3.0, {"new_signal": 1.5})
+        sink.append(4.0, {"cell1": 4.2})
+        assert sink.flush(timeout=5.0)
+
+    assert sink.frames == 3
+    assert rows(path) == [(1.0, "cell1", 4.0), (3.0, "new_signal", 1.5), (4.0, "cell1", 4.2)]
+    assert capsys.readouterr().out.count("SQLite sink") == 1
@@ -0,0 +1,61 @@
+# tests/test_trigger_capture.py
+import os
+
+import pytest
+
+from archive import read_trc
+from trigger_capture import TriggerCapture
+
+PAYLOAD = bytes(range(8))
+
+
+def record(capture, start, stop, period=0.01):
+    t = start
+    while t < stop:
+        capture.record(0x200, PAYLOAD, t)
+        t += period
+
+
+def test_window_is_saved_around_the_trigger(tmp_path):
+    capture = TriggerCapture(str(tmp_path), pre=1.0, post=1.0)
+    record(capture, 100.0, 103.0)
+    capture.trigger("alarm vmin", 103.0)
+    record(capture, 103.0, 105.0)
+    capture.close()
+
+    assert len(capture.saved) == 1
+    frames = list(read_trc(capture.saved[0]))
+    assert 199 <= len(frames) <= 201
+    assert all(can_id == 0x200 and data == PAYLOAD for _, can_id, data in frames)
+
+
+def test_triggers_in_the_same_second_get_their_own_file(tmp_path):
+    capture = TriggerCapture(str(tmp_path), pre=0.1, post=0.1)
+    for t in (100.2, 100.5, 100.8):
+        record(capture, t - 0.2, t)
+        capture.trigger("rule x", t)
+        record(capture, t, t + 0.1)
+        capture.poll(t + 0.15)
+    capture.close()
+
+    assert len(set(capture.saved)) == 3
+    assert all(os.path.exists(path) for path in capture.saved)
+
+
+def test_failed_write_is_reported(tmp_path, monkeypatch):
+    capture = TriggerCapture(str(tmp_path), pre=0.1, post=0.1)
+
+    def failing(window, frames):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(capture, "_write", failing)
+    record(capture, 100.0, 101.0)
+    capture.trigger("rule x", 100.2)
+    capture.poll(100.5)
+    capture.trigger("rule x", 100.6)
+    capture.poll(100.9)
+
+    assert capture.failed == 1
+    with pytest.raises(RuntimeError):
+        capture.close()
+    assert capture.failed == 2
@@ -0,0 +1,64 @@
+# tests/test_tx_scheduler.py
+import threading
+import time
+
+import pytest
+
+from PCANBasic import PCAN_ERROR_OK, PCAN_MESSAGE_RTR
+from metrics import Registry
+from tx_scheduler import TxScheduler
+
+
+class FakePCAN:
+    def __init__(self):
+        self.written = []
+
+    def Write(self, channel, msg):
+        self.written.append((msg.ID, msg.LEN, msg.MSGTYPE))
+        return PCAN_ERROR_OK
+
+
+def test_remote_frame_requests_its_dlc():
+    pcan = FakePCAN()
+    tx = TxScheduler(pcan, 0x51, registry=Registry())
+    tx.start()
+    tx.send(0x300, rtr=True, dlc=8)
+    deadline = time.monotonic() + 1.0
+    while not pcan.written and time.monotonic() < deadline:
+        time.sleep(0.001)
+    tx.stop()
+    assert pcan.written == [(0x300, 8, PCAN_MESSAGE_RTR.value)]
+
+
+def test_bad_dlc_is_refused():
+    tx = TxScheduler(FakePCAN(), 0x51, registry=Registry())
+    with pytest.raises(ValueError):
+        tx.send(0x300, rtr=True, dlc=9)
+    with pytest.raises(ValueError):
+        tx.send(0x300, b"\x01", dlc=8)
+
+
+def _reader_wakeups(seconds):
+    """Iterations of a loop sleeping 0.5 ms, like the reader thread polling an empty queue."""
+    count = 0
+    stop = time.monotonic() + seconds
+    while time.monotonic() < stop:
+        time.sleep(0.0005)
+        count += 1
+    return count
+
+
+def test_spinning_does_not_starve_the_reader():
+    baseline = _reader_wakeups(0.3)
+    pcan = FakePCAN()
+    tx = TxScheduler(pcan, 0x51, spin=0.001, registry=Registry())
+    job = tx.add_periodic(0x400, b"\x01", period=0.002)
+    tx.start()
+    wakeups = []
+    thread = threading.Thread(target=lambda: wakeups.append(_reader_wakeups(0.3)))
+    thread.start()
+    thread.join()
+    tx.stop()
+
+    assert job.sent >= 100
+    assert wakeups[0] > 0.8 * baseline
@@ -0,0 +1,255 @@
+# trigger_capture.py
+import math
+import os
+import re
+import sys
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_PRE = 5.0         # seconds of frames kept before a trigger
+DEFAULT_POST = 5.0        # seconds of frames recorded after it
+DEFAULT_CAPACITY = 65536  # frames in the ring (~15 s of a saturated 500 kbit/s bus)
+
+
+def user_data_dir(app="bms-supervisor"):
+    """
+    Per-user data directory of the application: outside the program's own
+    directory, which is read-only or temporary once bundled (PyInstaller).
+    """
+    if sys.platform == "darwin":
+        base = os.path.join(os.path.expanduser("~"), "Library", "Application Support")
+    elif sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA") or os.path.join(os.path.expanduser("~"), "AppData", "Local")
+    else:
+        base = os.environ.get("XDG_DATA_HOME") or os.path.join(os.path.expanduser("~"), ".local", "share")
+    return os.path.join(base, app)
+
+
+DEFAULT_DIRECTORY = os.path.join(user_data_dir(), "captures")
+
+
+class Capture:
+    """
+    One capture window: frames from `start` to `end` (frame clock), and
+    the (time, reason) of every trigger that fell into it.
+    """
+
+    __slots__ = ("first", "start", "end", "triggers", "truncated", "path")
+
+    def __init__(self, first, start, end, trigger, truncated):
+        self.first = first    # ring index (frame count) of its first frame
+        self.start = start
+        self.end = end
+        self.triggers = [trigger]
+        self.truncated = truncated  # the ring did not hold the whole window
+        self.path = None
+
+
+class TriggerCapture:
+    """
+    Oscilloscope-style capture of raw frames around events (alarm bits,
+    host rules): every frame goes into a fixed-size ring, and a trigger
+    saves the frames from `pre` seconds before it to `post` seconds after
+    it as a PCAN trace file (.trc), readable by archive.read_trc, the
+    session analyzer and PCAN-View.
+
+    record() is one store into preallocated arrays. A trigger only marks
+    where its window starts in the ring; the ring keeps filling during the
+    post-trigger window, and when it ends the window is copied out in a few
+    slice copies and written to disk by a background thread. A trigger
+    while a window is open extends that window instead of starting a new
+    one, and a window never starts before the end of the previous one, so
+    no frame is saved twice. Windows longer than the ring are truncated
+    (flagged in the file header). A capture that cannot be written is
+    reported once and counted in `failed`; close() raises after the others
+    are saved.
+    """
+
+    def __init__(self, directory, pre=DEFAULT_PRE, post=DEFAULT_POST,
+                 capacity=DEFAULT_CAPACITY, slot=8, prefix="capture", on_saved=None):
+        """
+        :param directory: where capture files are written (created if needed)
+        :param pre: seconds of frames saved before a trigger
+        :param post: seconds of frames saved after the last trigger of a window
+        :param capacity: frames held by the ring (memory: capacity * (13 + slot) bytes)
+        :param slot: payload bytes stored per frame, 8 for CAN, 64 for CAN FD
+        :param prefix: capture file name prefix
+        :param on_saved: callback Capture -> None once a capture is on disk
+                         (called on the writer thread)
+        """
+        self.directory = directory
+        self.pre = pre
+        self.post = post
+        self.capacity = capacity
+        self.slot = slot
+        self.prefix = prefix
+        self.on_saved = on_saved
+
+        self._times = array("d", bytes(8 * capacity))
+        self._ids = array("L", [0]) * capacity
+        self._lengths = bytearray(capacity)
+        self._data = bytearray(capacity * slot)
+        self._count = 0  # frames recorded so far; the ring holds the last `capacity`
+
+        self._open = None
+        self._deadline = math.inf  # end of the open window
+        self._last_end = -math.inf  # end of the previous window
+        self._wall_offset = time.time() - time.monotonic()  # frame clock -> epoch
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="capture")
+        self._pending = []
+        self.saved = []  # paths of the captures written so far
+        self.failed = 0
+        self.error = None  # first exception of the writer thread
+
+    def record(self, can_id, data, now):
+        """Store one frame received at `now` (frame clock). Reader thread."""
+        if now >= self._deadline:
+            self._close_window()
+        i = self._count % self.capacity
+        self._times[i] = now
+        self._ids[i] = can_id
+        n = len(data)
+        if n > self.slot:
+            n = self.slot
+            data = data[:n]
+        self._lengths[i] = n
+        offset = i * self.slot
+        self._data[offset:offset + n] = data
+        self._count += 1
+
+    def trigger(self, reason, now):
+        """
+        Start a capture window at `now`, or extend the open one. Returns
+        the Capture the trigger belongs to.
+        """
+        window = self._open
+        if window is not None:
+            window.triggers.append((now, reason))
+            window.end = self._deadline = max(window.end, now + self.post)
+            return window
+
+        start = max(now - self.pre, self._last_end)
+        oldest = max(0, self._count - self.capacity)
+        first = self._first_at(start, oldest)
+        truncated = first == oldest and oldest > 0 and self._times[oldest % self.capacity] > start
+        window = self._open = Capture(first, start, now + self.post, (now, reason), truncated)
+        self._deadline = window.end
+        return window
+
+    def _first_at(self, start, oldest):
+        """Ring index of the first frame at or after `start` (frames are in time order)."""
+        times = self._times
+        capacity = self.capacity
+        lo, hi = oldest, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if times[mid % capacity] < start:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def poll(self, now):
+        """Close the open window once its post-trigger time has passed."""
+        if now >= self._deadline:
+            self._close_window()
+
+    def _close_window(self):
+        window = self._open
+        self._open = None
+        self._deadline = math.inf
+        self._last_end = window.end
+
+        first = window.first
+        oldest = max(0, self._count - self.capacity)
+        if first < oldest:  # overwritten by the post-trigger frames
+            first = oldest
+            window.truncated = True
+        frames = self._copy(first, self._count)
+        pending = []
+        for future in self._pending:
+            if future.done():
+                self._check(future)
+            else:
+                pending.append(future)
+        pending.append(self._executor.submit(self._write, window, frames))
+        self._pending = pending
+
+    def _check(self, future):
+        """Wait for a capture write; record (and report once) its failure."""
+        error = future.exception()
+        if error is None:
+            return
+        self.failed += 1
+        if self.error is None:
+            print(f"Capture to {self.directory} failed ({error!r})")
+            self.error = error
+
+    def _copy(self, first, stop):
+        """(times, ids, lengths, data) of ring frames [first, stop), unwrapped."""
+        capacity, slot = self.capacity, self.slot
+        a, b = first % capacity, stop % capacity
+        if stop - first == 0:
+            parts = []
+        elif a < b:
+            parts = [(a, b)]
+        else:
+            parts = [(a, capacity), (0, b)]
+        times, ids, lengths, data = array("d"), array("L"), bytearray(), bytearray()
+        for lo, hi in parts:
+            times.extend(self._times[lo:hi])
+            ids.extend(self._ids[lo:hi])
+            lengths += self._lengths[lo:hi]
+            data += self._data[lo * slot:hi * slot]
+        return times, ids, lengths, data
+
+    def _write(self, window, frames):
+        times, ids, lengths, data = frames
+        reason = window.triggers[0][1]
+        wall = window.triggers[0][0] + self._wall_offset
+        stamp = time.strftime("%Y%m%d_%H%M%S", time.localtime(wall))
+        stamp += f"_{int(wall * 1000) % 1000:03d}"
+        name = re.sub(r"[^A-Za-z0-9]+", "_", reason).strip("_").lower() or "trigger"
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory, f"{self.prefix}_{stamp}_{name}")
+        path = base + ".trc"
+        n = 1
+        while os.path.exists(path):  # same millisecond (or a previous run's file)
+            n += 1
+            path = f"{base}_{n}.trc"
+
+        t0 = times[0] if times else window.start
+        slot = self.slot
+        with open(path, "w", encoding="latin-1") as f:
+            f.write(";$FILEVERSION=2.1\n")
+            # OLE automation date: days since 1899-12-30
+            f.write(f";$STARTTIME={(t0 + self._wall_offset) / 86400.0 + 25569.0:.10f}\n")
+            f.write(";$COLUMNS=N,O,T,I,d,l,D\n;\n")
+            for t, why in window.triggers:
+                f.write(f";   Trigger at {(t - t0) * 1000.0:.3f} ms: {why}\n")
+            if window.truncated:
+                f.write(";   Truncated: the window was longer than the capture ring\n")
+            f.write(";\n")
+            for k in range(len(times)):
+                n = lengths[k]
+                payload = " ".join(f"{b:02X}" for b in data[k * slot:k * slot + n])
+                kind = "FD" if n > 8 else "DT"
+                f.write(f"{k + 1:>7} {(times[k] - t0) * 1000.0:>13.3f} {kind} "
+                        f"{ids[k]:04X} Rx {n:>2}  {payload}\n")
+        window.path = path
+        self.saved.append(path)
+        print(f"Capture saved: {path} ({len(times)} frames, {len(window.triggers)} trigger(s))")
+        if self.on_saved:
+            self.on_saved(window)
+
+    def close(self):
+        """Save the open window (cut short) and wait for the pending writes."""
+        if self._open is not None:
+            self._close_window()
+        pending, self._pending = self._pending, []
+        for future in pending:
+            self._check(future)
+        self._executor.shutdown()
+        if self.error is not None:
+            raise RuntimeError(f"{self.failed} capture(s) could not be written") from self.error
@@ -0,0 +1,243 @@
+# tx_scheduler.py
+import heapq
+import itertools
+import threading
+import time
+
+from PCANBasic import (
+    TPCANMsg, TPCANMsgFD,
+    PCAN_ERROR_OK, PCAN_ERROR_QXMTFULL, PCAN_ERROR_XMTFULL,
+    PCAN_MESSAGE_STANDARD, PCAN_MESSAGE_RTR, PCAN_MESSAGE_FD,
+)
+from metrics import REGISTRY
+from profiling import HdrHistogram
+
+_LEN_TO_FD_DLC = {0: 0, 1: 1, 2: 2, 3: 3, 4: 4, 5: 5, 6: 6, 7: 7, 8: 8,
+                  12: 9, 16: 10, 20: 11, 24: 12, 32: 13, 48: 14, 64: 15}
+
+
+class TxJob:
+    """One periodic or one-shot frame owned by a TxScheduler."""
+
+    __slots__ = ("can_id", "msg", "period", "scheduled", "attempts", "cancelled",
+                 "sent", "retries", "failures", "missed", "jitter")
+
+    def __init__(self, can_id, msg, period, scheduled):
+        self.can_id = can_id
+        self.msg = msg
+        self.period = period        # seconds, None for a one-shot frame
+        self.scheduled = scheduled  # nominal send time (perf_counter seconds)
+        self.attempts = 0
+        self.cancelled = False
+        self.sent = 0
+        self.retries = 0
+        self.failures = 0
+        self.missed = 0             # periods skipped because we were late
+        self.jitter = HdrHistogram()  # send time - nominal time, in ns
+
+    def stats(self):
+        s = self.jitter.summary()
+        return {
+            "can_id": self.can_id,
+            "period": self.period,
+            "sent": self.sent,
+            "retries": self.retries,
+            "failures": self.failures,
+            "missed": self.missed,
+            "jitter_p50_us": s["p50_ns"] / 1e3,
+            "jitter_p99_us": s["p99_ns"] / 1e3,
+            "jitter_max_us": s["max_ns"] / 1e3,
+        }
+
+
+class TxScheduler:
+    """
+    Sends periodic and on-demand frames from a dedicated thread.
+
+    Jobs sit in a heap keyed by their next due time, so adding, removing
+    (lazily) and firing a job is O(log n) whatever the number of periodic
+    messages. The thread sleeps until the next due time. With `spin` > 0 it
+    wakes that much earlier and waits the rest on perf_counter, yielding the
+    GIL on every check so that the reader thread keeps running; this trims
+    the wake-up latency of slow periodic frames and costs at most `spin` of
+    CPU per frame, so leave it at 0 for many or fast jobs.
+
+    Periods are drift-free (next = nominal + period); a job that fell more
+    than one period behind skips the missed slots instead of bursting.
+    PCAN_ERROR_QXMTFULL is retried with exponential back-off.
+    """
+
+    def __init__(self, pcan, channel, fd=False, spin=0.0,
+                 retry_delay=0.0002, max_retries=5, registry=REGISTRY):
+        """
+        :param pcan: an initialized PCANBasic instance (usually listener.pcan)
+        :param channel: the PCAN channel handle
+        :param fd: True to send TPCANMsgFD frames with WriteFD
+        :param spin: seconds before each due time spent polling the clock
+                     instead of sleeping (0: sleep to the due time)
+        :param retry_delay: first back-off delay after a full transmit queue
+        :param max_retries: retries before a send counts as failed
+        :param registry: metrics.Registry for the transmit metrics
+        """
+        self.pcan = pcan
+        self.channel = channel
+        self.fd = fd
+        self.spin = spin
+        self.retry_delay = retry_delay
+        self.max_retries = max_retries
+
+        self._heap = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._jobs = []
+
+        self._m_sent = registry.counter("bms_tx_frames_total", "Frames transmitted, by CAN ID", ("id",))
+        self._m_retries = registry.counter("bms_tx_retries_total", "Transmit retries after QXMTFULL")
+        self._m_failures = registry.counter("bms_tx_failures_total", "Frames that could not be sent")
+        self._m_jitter = registry.histogram("bms_tx_jitter_seconds", "Send time minus nominal time")
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def add_periodic(self, can_id, data=b"", period=0.1, offset=0.0, rtr=False, dlc=None):
+        """
+        Send a frame every `period` seconds, first after `offset` seconds.
+        Returns the TxJob (pass it to remove(), read its stats()).
+        `dlc` is the length a remote frame requests (default: len(data)).
+        """
+        job = TxJob(can_id, self._build(can_id, data, rtr, dlc), period,
+                    time.perf_counter() + offset)
+        self._jobs.append(job)
+        self._push(job.scheduled, job)
+        return job
+
+    def send(self, can_id, data=b"", rtr=False, dlc=None):
+        """
+        Queue a one-shot frame, sent as soon as possible. `dlc` is the
+        length a remote frame requests (default: len(data)).
+        """
+        job = TxJob(can_id, self._build(can_id, data, rtr, dlc), None, time.perf_counter())
+        self._push(job.scheduled, job)
+        return job
+
+    def remove(self, job):
+        job.cancelled = True  # dropped when it reaches the top of the heap
+        if job in self._jobs:
+            self._jobs.remove(job)
+
+    def stats(self):
+        """Per periodic job statistics, including jitter percentiles."""
+        return [job.stats() for job in self._jobs]
+
+    def _build(self, can_id, data, rtr, dlc=None):
+        data = bytes(data)
+        if rtr:
+            # a remote frame carries no data, only the length it asks for
+            length = len(data) if dlc is None else dlc
+            if not 0 <= length <= 8:
+                raise ValueError(f"Invalid remote frame DLC {length}")
+            msg = TPCANMsgFD() if self.fd else TPCANMsg()
+            if self.fd:
+                msg.DLC = length
+            else:
+                msg.LEN = length
+            # remote frames only exist in classic CAN, even on an FD channel
+            msg.MSGTYPE = PCAN_MESSAGE_RTR.value
+            msg.ID = can_id
+            return msg
+        if dlc is not None and dlc != len(data):
+            raise ValueError("dlc is only for remote frames; data frames use len(data)")
+        if self.fd:
+            if len(data) not in _LEN_TO_FD_DLC:
+                raise ValueError(f"Invalid CAN FD payload length {len(data)}")
+            msg = TPCANMsgFD()
+            msg.DLC = _LEN_TO_FD_DLC[len(data)]
+            msg.MSGTYPE = PCAN_MESSAGE_FD.value
+        else:
+            if len(data) > 8:
+                raise ValueError("Classic CAN payloads are at most 8 bytes")
+            msg = TPCANMsg()
+            msg.LEN = len(data)
+            msg.MSGTYPE = PCAN_MESSAGE_STANDARD.value
+        msg.ID = can_id
+        for i, b in enumerate(data):
+            msg.DATA[i] = b
+        return msg
+
+    def _push(self, due, job):
+        with self._lock:
+            first = not self._heap or due < self._heap[0][0]
+            heapq.heappush(self._heap, (due, next(self._seq), job))
+        if first:
+            self._wake.set()
+
+    def _run(self):
+        heap = self._heap
+        while not self._stop.is_set():
+            with self._lock:
+                while heap and heap[0][2].cancelled:
+                    heapq.heappop(heap)
+                due = heap[0][0] if heap else None
+
+            if due is None:
+                self._wake.wait(0.5)
+                self._wake.clear()
+                continue
+            delay = due - time.perf_counter()
+            if delay > self.spin:
+                # coarse sleep; re-evaluate afterwards (an earlier job may have arrived)
+                self._wake.wait(delay - self.spin)
+                self._wake.clear()
+                continue
+            while time.perf_counter() < due:
+                time.sleep(0)  # let the reader thread have the GIL
+
+            with self._lock:
+                _, _, job = heapq.heappop(heap)
+            if not job.cancelled:
+                self._transmit(job)
+
+    def _transmit(self, job):
+        write = self.pcan.WriteFD if self.fd else self.pcan.Write
+        result = write(self.channel, job.msg)
+        now = time.perf_counter()
+
+        if result == PCAN_ERROR_OK:
+            lateness = now - job.scheduled
+            job.jitter.record(int(lateness * 1e9))
+            self._m_jitter.observe(lateness)
+            job.sent += 1
+            job.attempts = 0
+            self._m_sent.labels(f"0x{job.can_id:03X}").inc()
+        elif result & (PCAN_ERROR_QXMTFULL | PCAN_ERROR_XMTFULL) and job.attempts < self.max_retries:
+            job.retries += 1
+            self._m_retries.inc()
+            self._push(now + self.retry_delay * (1 << job.attempts), job)
+            job.attempts += 1
+            return
+        else:
+            job.failures += 1
+            job.attempts = 0
+            self._m_failures.inc()
+
+        if job.period is None:
+            return
+        nominal = job.scheduled + job.period
+        if nominal < now:
+            missed = int((now - nominal) / job.period) + 1
+            job.missed += missed
+            nominal += missed * job.period
+        job.scheduled = nominal
+        self._push(nominal, job)